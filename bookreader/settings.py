@@ -42,10 +42,15 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'core.middleware.PrecompressedStaticMiddleware',
+    'core.middleware.AnonymousPageCacheMiddleware',
+    'core.throttle.AdmissionControlMiddleware',
+    'core.querylog.QueryLogMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'core.profiling.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -80,6 +85,130 @@ DATABASES = {
     }
 }
 
+# Reading progress, its archive and bookmarks are stored per user on one of
+# the SHARDS databases (see core.sharding); everything else stays on
+# CATALOG_DATABASE. To add a shard, add it to DATABASES and SHARDS, run
+# `manage.py migrate --database <alias>`, then `manage.py rebalance_shards`
+# to move the users whose place on the hash ring changed.
+DATABASE_ROUTERS = ['core.sharding.UserShardRouter']
+SHARDING = {
+    'CATALOG_DATABASE': 'default',
+    'SHARDS': ['default'],
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Local memory is per process; point this at Redis or Memcached in production
+# so every worker shares the page cache and catalog change stamp.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'bookreader',
+    }
+}
+
+# Sessions are read from the cache and written through to the database, and
+# request.user (with its profile) is cached by core.auth.CachedModelBackend,
+# so a steady-state logged-in request runs no session or auth queries.
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+AUTHENTICATION_BACKENDS = [
+    'core.auth.CachedModelBackend',
+    # Still accepted for sessions created before the cached backend
+    'django.contrib.auth.backends.ModelBackend',
+]
+
+# Seconds a user is served from the cache without re-reading auth_user
+AUTH_USER_CACHE_TIMEOUT = 300
+
+# Seconds each process trusts its cached catalog stamp (see core.catalog)
+# before re-reading it from the database. Background workers change the
+# catalog too, and their cache may not be the web processes' cache.
+CATALOG_STAMP_TIMEOUT = 5
+
+# Full-page cache for anonymous visitors (see core.middleware)
+PAGE_CACHE = {
+    'VIEWS': ['home', 'book_detail', 'author_list', 'author_detail', 'genre_list', 'genre_detail'],
+    'TIMEOUT': 60,
+    'STALE_TIMEOUT': 600,
+}
+
+# Slow-query log (see core.querylog), browsable by staff at /admin/query-log/.
+# Statements on WATCH_TABLES are explained on first sight and logged when the
+# plan scans the whole table.
+QUERY_LOG = {
+    'ENABLED': DEBUG,
+    'THRESHOLD_MS': 100,
+    'BUFFER_SIZE': 500,
+    'WATCH_TABLES': ['core_readingprogress', 'core_bookmark', 'core_book_genres'],
+}
+
+# On-demand profiling (see core.profiling). Staff send `X-Profile: sample`,
+# `cprofile` or `memory`; results are listed with `manage.py profiles`.
+# Disabled, the middleware is not loaded at all.
+PROFILING = {
+    'ENABLED': False,
+    'SAMPLE_RATE': 0.0,
+    'DIRECTORY': BASE_DIR / 'profiles',
+}
+
+# Per-user token buckets for write endpoints (see core.throttle); a client
+# over its rate gets 429 with Retry-After.
+THROTTLE = {
+    'RATES': {
+        'reading_progress': '60/min',
+        'bookmarks': '30/min',
+    },
+}
+
+# Shed anonymous catalog renders while a worker is overloaded, so readers
+# keep the database to themselves. Shed counts are at /admin/traffic/.
+ADMISSION_CONTROL = {
+    'ENABLED': not DEBUG,
+    'MAX_IN_FLIGHT': 8,
+    'MAX_DB_LATENCY_MS': 250,
+    'LOW_PRIORITY_VIEWS': PAGE_CACHE['VIEWS'] + [
+        'book_list', 'book_list_json',
+        'opds_root', 'opds_root_json', 'opds_books', 'opds_books_json',
+        'opds_genres', 'opds_genres_json', 'opds_genre', 'opds_genre_json',
+        'opds_authors', 'opds_authors_json', 'opds_author', 'opds_author_json',
+    ],
+}
+
+# Worker startup (see core.startup). PRELOAD compiles URLs, templates and
+# model metadata when bookreader.wsgi is imported, i.e. once in the master
+# under gunicorn --preload. WARM_CACHES also renders the hot pages there,
+# for process-local caches; with a shared cache run `manage.py warm_caches`.
+STARTUP = {
+    'PRELOAD': not DEBUG,
+    'WARM_CACHES': False,
+}
+
+
+# Catalog facets (see core.facets): every worker filters and counts /books/
+# on in-memory bitsets. `manage.py build_facets` writes SNAPSHOT_PATH, which
+# workers load at startup instead of reading the whole catalog.
+FACETS = {
+    'SNAPSHOT_PATH': BASE_DIR / 'facets.snapshot',
+}
+
+# Page prefetching in the PDF reader (see core.prefetch). Saved page turns
+# are aggregated per book into how far ahead readers go and which pages they
+# jump to; the reader pre-renders those pages into an LRU of CACHE_SIZE pages.
+PREFETCH = {
+    'CACHE_SIZE': 6,
+}
+
+# Background tasks (see core.taskqueue); run workers with `manage.py run_workers`.
+# In development tasks run inline so no worker is needed.
+TASK_QUEUE = {
+    'EAGER': DEBUG,
+    'MAX_ATTEMPTS': 3,
+    'RETRY_DELAY': 10,
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -123,10 +252,65 @@ STATICFILES_DIRS = [
     # Add other apps' static directories here if needed
 ]
 
+# Stylesheets concatenated and minified by collectstatic; templates link them
+# with {% stylesheet_bundle %} (the individual sources are linked in DEBUG).
+STATIC_BUNDLES = {
+    'core/css/site.min.css': ['core/css/style.css'],
+    'core/css/dashboard.min.css': ['core/css/dashboard.css'],
+}
+
 # Media files (Uploaded files)
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Book files and covers are stored once per distinct content under
+# blobs/<aa>/<bb>/<sha256>.<ext> (see core.storage); `manage.py gc_blobs`
+# removes the ones no book references any more. Static files are
+# fingerprinted, bundled and precompressed (.gz/.br) by collectstatic.
+#
+# The reader downloads book files through short-lived signed URLs. On the
+# filesystem these are emulated under /storage/ (each 'alias' option must
+# match its key here). To keep media in an S3-compatible object store
+# instead, point the media storages at core.objectstorage, e.g.
+#
+#     'blobs': {
+#         'BACKEND': 'core.objectstorage.S3ContentAddressedStorage',
+#         'OPTIONS': {
+#             'prefix': 'blobs',
+#             'bucket': 'bookreader-media',
+#             'endpoint_url': 'https://minio.internal:9000',  # omit for AWS
+#             'region': 'us-east-1',
+#             'access_key': os.environ['S3_ACCESS_KEY'],
+#             'secret_key': os.environ['S3_SECRET_KEY'],
+#         },
+#     },
+#
+# and 'default' likewise with core.objectstorage.S3Storage. The bucket needs
+# a CORS rule for the site's origin; see the README.
+STORAGES = {
+    'default': {
+        'BACKEND': 'core.storage.SignedFileSystemStorage',
+        'OPTIONS': {
+            'alias': 'default',
+        },
+    },
+    'staticfiles': {
+        'BACKEND': 'core.storage.CompressedManifestStaticFilesStorage',
+    },
+    'blobs': {
+        'BACKEND': 'core.storage.ContentAddressedStorage',
+        'OPTIONS': {
+            'alias': 'blobs',
+            'prefix': 'blobs',
+        },
+    },
+}
+
+# Seconds the reader's signed book URL stays valid. PDF.js fetches pages
+# with range requests for as long as the book is open, so this covers a
+# reading session; the reader fetches a new URL if it expires anyway.
+READER_FILE_URL_EXPIRES = 4 * 60 * 60
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
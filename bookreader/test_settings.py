@@ -0,0 +1,26 @@
+"""
+Settings for the test suite: the per-user tables on two shards, so the
+sharding tests in ``core.tests`` run against more than one database.
+
+    python manage.py test --settings=bookreader.test_settings
+"""
+from .settings import *  # noqa: F401,F403
+
+DATABASES = {
+    alias: {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / f'{alias}.sqlite3',  # noqa: F405
+    }
+    for alias in ('default', 'shard1', 'shard2')
+}
+
+SHARDING = {
+    'CATALOG_DATABASE': 'default',
+    'SHARDS': ['shard1', 'shard2'],
+}
+
+# The runner sets DEBUG=False; pages must render without a collectstatic manifest
+STORAGES = {
+    **STORAGES,  # noqa: F405
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
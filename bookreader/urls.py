@@ -19,7 +19,12 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 
+from core import views as core_views
+
 urlpatterns = [
+    path('admin/query-log/', core_views.query_log, name='query_log'),
+    path('admin/profiling/memory/', core_views.memory_profile, name='memory_profile'),
+    path('admin/traffic/', core_views.traffic, name='traffic'),
     path('admin/', admin.site.urls),
     path('', include('core.urls')),
 ]
@@ -14,3 +14,11 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bookreader.settings')
 
 application = get_wsgi_application()
+
+# Pay for lazy imports and compilation once, before gunicorn --preload forks
+from core import startup  # noqa: E402
+
+if startup.startup_settings()['PRELOAD']:
+    startup.preload()
+    if startup.startup_settings()['WARM_CACHES']:
+        startup.warm_before_fork()
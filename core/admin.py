@@ -1,10 +1,308 @@
-from django.contrib import admin
-from .models import Book, Author, Genre, ReadingProgress, Review, UserProfile, Bookmark
-admin.site.register(Book)
-admin.site.register(Author)
-admin.site.register(Genre)
-admin.site.register(ReadingProgress)
-admin.site.register(Review)
-admin.site.register(UserProfile)
-admin.site.register(Bookmark)
+from django.contrib import admin, messages
+from django.core.paginator import Paginator
+from django.db import IntegrityError, connections, transaction
+from django.db.models import F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.http import QueryDict
+from django.utils import timezone
+from django.utils.functional import cached_property
 
+from . import reflow, sharding
+from .models import (
+    ArchivedReadingProgress, Author, Blob, Book, Bookmark, Genre, ReadingProgress, Review, Task, UserProfile,
+)
+
+
+def estimated_row_count(model, using='default'):
+    """Return the planner's row estimate for ``model``'s table, or ``None``.
+
+    Uses ``pg_class.reltuples`` on PostgreSQL, ``information_schema`` on
+    MySQL and ``sqlite_stat1`` (filled by ``ANALYZE``) on SQLite.
+    """
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [connection.ops.quote_name(table)])
+        elif connection.vendor == 'mysql':
+            cursor.execute(
+                'SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s',
+                [table],
+            )
+        elif connection.vendor == 'sqlite':
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+            if cursor.fetchone() is None:
+                return None
+            cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1', [table])
+            row = cursor.fetchone()
+            return int(row[0].split()[0]) if row else None
+        else:
+            return None
+        row = cursor.fetchone()
+    # PostgreSQL reports -1 for tables that were never analyzed
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that never runs an unbounded ``COUNT(*)``.
+
+    Unfiltered changelists of large tables use the database's row estimate.
+    Filtered ones (and small or never-analyzed tables) count at most
+    ``count_limit`` rows, so later pages beyond that are simply not linked.
+    """
+
+    exact_threshold = 10000
+    count_limit = 100000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_row_count(queryset.model, queryset.db)
+            if estimate is not None and estimate > self.exact_threshold:
+                return estimate
+        return queryset.order_by()[:self.count_limit].count()
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """Changelist settings for tables that grow with the number of users."""
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_per_page = 50
+
+
+class ShardListFilter(admin.SimpleListFilter):
+    """Picks the shard a sharded changelist reads; ``ShardedAdmin`` applies it."""
+    title = 'shard'
+    parameter_name = 'shard'
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in sharding.all_shards()]
+
+    def choices(self, changelist):
+        # There is no "All": a changelist shows one database at a time
+        current = self.value() or sharding.all_shards()[0]
+        for lookup, title in self.lookup_choices:
+            yield {
+                'selected': current == lookup,
+                'query_string': changelist.get_query_string({self.parameter_name: lookup}),
+                'display': title,
+            }
+
+    def queryset(self, request, queryset):
+        return queryset
+
+
+class ShardedAdmin(LargeTableAdmin):
+    """Admin of a per-user model, one shard at a time (see ``core.sharding``).
+
+    Users and books may be on another database, so they are prefetched
+    rather than joined, and ``=fk__field`` searches are resolved on the
+    catalog first.
+    """
+
+    def shard(self, request):
+        alias = request.GET.get(ShardListFilter.parameter_name)
+        if alias is None:
+            # Change views carry the changelist's filters along
+            alias = QueryDict(request.GET.get('_changelist_filters', '')).get(ShardListFilter.parameter_name)
+        shards = sharding.all_shards()
+        return alias if alias in shards else shards[0]
+
+    def joins_catalog(self, request):
+        return self.shard(request) == sharding.catalog_database()
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request).using(self.shard(request))
+        if not self.joins_catalog(request):
+            queryset = queryset.prefetch_related(*self.list_select_related)
+        return queryset
+
+    def get_list_select_related(self, request):
+        return self.list_select_related if self.joins_catalog(request) else ()
+
+    def get_list_filter(self, request):
+        return (ShardListFilter, *super().get_list_filter(request))
+
+    def get_search_results(self, request, queryset, search_term):
+        if self.joins_catalog(request) or not search_term:
+            return super().get_search_results(request, queryset, search_term)
+        condition = Q()
+        for field in self.search_fields:
+            relation, _, lookup = field.lstrip('=').partition('__')
+            related = self.model._meta.get_field(relation).related_model
+            ids = related._default_manager.filter(**{lookup: search_term.strip()}).values_list('pk', flat=True)
+            condition |= Q(**{f'{relation}_id__in': list(ids)})
+        return queryset.filter(condition), False
+
+
+@admin.register(Genre)
+class GenreAdmin(admin.ModelAdmin):
+    list_display = ('name', 'slug', 'book_count', 'average_rating', 'updated_at')
+    search_fields = ('name',)
+    prepopulated_fields = {'slug': ('name',)}
+    readonly_fields = ('book_count', 'average_rating')
+
+
+@admin.register(Author)
+class AuthorAdmin(admin.ModelAdmin):
+    list_display = ('name', 'book_count', 'average_rating', 'updated_at')
+    search_fields = ('name',)
+    readonly_fields = ('book_count', 'average_rating')
+
+
+@admin.register(Book)
+class BookAdmin(admin.ModelAdmin):
+    list_display = ('title', 'author', 'format', 'language', 'average_rating', 'review_count', 'is_featured', 'created_at')
+    list_select_related = ('author',)
+    list_filter = ('format', 'is_featured', 'is_popular', 'language')
+    search_fields = ('title', '=isbn', 'author__name')
+    autocomplete_fields = ('author', 'genres')
+    prepopulated_fields = {'slug': ('title',)}
+    readonly_fields = ('average_rating', 'review_count')
+    actions = ['recompute_ratings', 'reingest_files']
+
+    def get_queryset(self, request):
+        # Book.__str__ reads the author, e.g. in autocomplete results
+        return super().get_queryset(request).select_related('author')
+
+    @admin.action(description='Recompute ratings')
+    def recompute_ratings(self, request, queryset):
+        updated = Book.refresh_ratings(queryset)
+        self.message_user(request, f'Recomputed ratings for {updated} books.', messages.SUCCESS)
+
+    @admin.action(description='Re-ingest files for the reader')
+    def reingest_files(self, request, queryset):
+        from .tasks import ingest_book
+
+        book_ids = queryset.filter(format__in=reflow.REFLOWABLE_FORMATS).exclude(file='').values_list('pk', flat=True)
+        queued = ingest_book.delay_many((book_id,) for book_id in book_ids.iterator())
+        self.message_user(request, f'Queued {queued} books for ingestion.', messages.SUCCESS)
+
+
+@admin.register(ReadingProgress)
+class ReadingProgressAdmin(ShardedAdmin):
+    list_display = ('id', 'user', 'book_title', 'current_page', 'is_completed', 'last_read')
+    list_select_related = ('user', 'book')
+    list_filter = ('is_completed', 'last_read')
+    search_fields = ('=user__username', '=book__isbn')
+    raw_id_fields = ('user', 'book')
+    ordering = ('-last_read',)
+    actions = ['mark_completed', 'mark_in_progress']
+
+    @admin.display(description='Book', ordering='book__title')
+    def book_title(self, obj):
+        return obj.book.title
+
+    @admin.action(description='Mark as completed')
+    def mark_completed(self, request, queryset):
+        if queryset.db == sharding.catalog_database():
+            page_count = Subquery(Book.objects.filter(pk=OuterRef('book_id')).values('page_count'))
+            updated = queryset.update(
+                is_completed=True,
+                current_page=Coalesce(page_count, 'current_page'),
+                last_read=timezone.now(),
+            )
+        else:
+            # The books are on another database; one UPDATE per page count instead
+            page_counts = Book.objects.filter(pk__in=sharding.book_ids(queryset)).values_list('pk', 'page_count')
+            by_count = {}
+            for book_id, page_count in page_counts:
+                by_count.setdefault(page_count, []).append(book_id)
+            updated = 0
+            with transaction.atomic(using=queryset.db):
+                for page_count, book_ids in by_count.items():
+                    updated += queryset.filter(book_id__in=book_ids).update(
+                        is_completed=True,
+                        current_page=page_count if page_count is not None else F('current_page'),
+                        last_read=timezone.now(),
+                    )
+        self.message_user(request, f'Marked {updated} entries as completed.', messages.SUCCESS)
+
+    @admin.action(description='Mark as in progress')
+    def mark_in_progress(self, request, queryset):
+        updated = queryset.update(is_completed=False, last_read=timezone.now())
+        self.message_user(request, f'Marked {updated} entries as in progress.', messages.SUCCESS)
+
+
+@admin.register(ArchivedReadingProgress)
+class ArchivedReadingProgressAdmin(ShardedAdmin):
+    list_display = ('id', 'user', 'book_title', 'current_page', 'last_read', 'archived_at')
+    list_select_related = ('user', 'book')
+    search_fields = ('=user__username', '=book__isbn')
+    raw_id_fields = ('user', 'book')
+
+    @admin.display(description='Book', ordering='book__title')
+    def book_title(self, obj):
+        return obj.book.title
+
+
+@admin.register(Review)
+class ReviewAdmin(LargeTableAdmin):
+    list_display = ('id', 'title', 'user', 'book_title', 'rating', 'is_public', 'created_at')
+    list_select_related = ('user', 'book')
+    list_filter = ('rating', 'is_public', 'created_at')
+    search_fields = ('=user__username', '=book__isbn')
+    raw_id_fields = ('user', 'book')
+    actions = ['recompute_ratings']
+
+    @admin.display(description='Book', ordering='book__title')
+    def book_title(self, obj):
+        return obj.book.title
+
+    @admin.action(description='Recompute ratings of the reviewed books')
+    def recompute_ratings(self, request, queryset):
+        updated = Book.refresh_ratings(Book.objects.filter(pk__in=queryset.order_by().values('book_id')))
+        self.message_user(request, f'Recomputed ratings for {updated} books.', messages.SUCCESS)
+
+
+@admin.register(Bookmark)
+class BookmarkAdmin(ShardedAdmin):
+    list_display = ('id', 'user', 'book_title', 'created_at')
+    list_select_related = ('user', 'book')
+    list_filter = ('created_at',)
+    search_fields = ('=user__username', '=book__isbn')
+    raw_id_fields = ('user', 'book')
+
+    @admin.display(description='Book', ordering='book__title')
+    def book_title(self, obj):
+        return obj.book.title
+
+
+@admin.register(UserProfile)
+class UserProfileAdmin(LargeTableAdmin):
+    list_display = ('user', 'created_at', 'updated_at')
+    list_select_related = ('user',)
+    search_fields = ('=user__username', '=user__email')
+    raw_id_fields = ('user',)
+
+
+@admin.register(Task)
+class TaskAdmin(LargeTableAdmin):
+    list_display = ('id', 'name', 'status', 'attempts', 'max_attempts', 'run_at', 'locked_by')
+    list_filter = ('status',)
+    search_fields = ('name',)
+    ordering = ('run_at',)
+    actions = ['retry_tasks']
+
+    @admin.action(description='Retry failed tasks')
+    def retry_tasks(self, request, queryset):
+        failed = queryset.filter(status='failed').exclude(
+            dedup_key__in=Task.objects.filter(status='pending').values('dedup_key'),
+        )
+        try:
+            with transaction.atomic():
+                updated = failed.update(status='pending', attempts=0, run_at=timezone.now(), locked_by='', last_error='')
+        except IntegrityError:
+            self.message_user(request, 'Some of the selected tasks are duplicates; retry them one at a time.', messages.ERROR)
+            return
+        self.message_user(request, f'Queued {updated} tasks again.', messages.SUCCESS)
+
+
+@admin.register(Blob)
+class BlobAdmin(LargeTableAdmin):
+    list_display = ('name', 'size', 'ref_count', 'updated_at')
+    search_fields = ('=sha256',)
+    readonly_fields = ('name', 'sha256', 'size', 'ref_count', 'created_at', 'updated_at')
@@ -0,0 +1,97 @@
+"""
+Static asset bundles and vendored third-party scripts.
+
+Bundles are lists of project stylesheets that ``collectstatic`` concatenates
+and minifies into one file (see ``core.storage``); in development the
+source files are linked individually. Vendored packages are pinned copies of
+third-party files fetched into the static tree by ``manage.py vendor_assets``
+so pages never depend on a third-party CDN at runtime. Their SRI digests
+are pinned in ``vendor.lock.json`` next to them.
+"""
+import json
+import os
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+
+VENDOR_ROOT = 'core/vendor'
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+LOCK_FILE = os.path.join(STATIC_DIR, VENDOR_ROOT, 'vendor.lock.json')
+
+VENDOR_PACKAGES = {
+    'pdfjs': {
+        'version': '3.4.120',
+        'source': 'https://cdnjs.cloudflare.com/ajax/libs/pdf.js/{version}/{filename}',
+        'files': ['pdf.min.js', 'pdf.worker.min.js'],
+    },
+}
+
+STRING_RE = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')')
+# Strings are matched too, so comment markers inside them are not comments
+COMMENT_RE = re.compile(STRING_RE.pattern + r'|/\*(?!!).*?\*/', re.S)
+
+
+def bundles():
+    return getattr(settings, 'STATIC_BUNDLES', {})
+
+
+def minify_css(css):
+    """Strip comments and redundant whitespace from a stylesheet.
+
+    Quoted strings are left untouched and ``/*! ... */`` license comments
+    are kept.
+    """
+    parts = STRING_RE.split(COMMENT_RE.sub(lambda match: match.group(1) or '', css))
+    for index in range(0, len(parts), 2):
+        code = re.sub(r'\s+', ' ', parts[index])
+        code = re.sub(r'\s*([{};,>])\s*', r'\1', code)
+        # Only after colons: a space before one is a descendant selector
+        code = re.sub(r':\s+', ':', code)
+        code = code.replace(';}', '}')
+        parts[index] = code
+    return ''.join(parts).strip()
+
+
+def build_bundle(sources, read):
+    """Concatenate and minify ``sources``; ``read(path)`` returns their text."""
+    return '\n'.join(minify_css(read(path)) for path in sources) + '\n'
+
+
+def vendor_path(package, filename):
+    version = VENDOR_PACKAGES[package]['version']
+    return f'{VENDOR_ROOT}/{package}/{version}/{filename}'
+
+
+def vendor_source_url(package, filename):
+    spec = VENDOR_PACKAGES[package]
+    return spec['source'].format(version=spec['version'], filename=filename)
+
+
+@lru_cache(maxsize=None)
+def is_vendored(package, filename):
+    return finders.find(vendor_path(package, filename)) is not None
+
+
+def missing_vendor_files():
+    """Vendored paths not yet fetched by ``manage.py vendor_assets``."""
+    return [
+        vendor_path(package, filename)
+        for package, spec in VENDOR_PACKAGES.items()
+        for filename in spec['files']
+        if not is_vendored(package, filename)
+    ]
+
+
+@lru_cache(maxsize=None)
+def vendor_lock():
+    """``{path: 'sha384-...'}`` from the lock file, empty before the first fetch."""
+    if not os.path.exists(LOCK_FILE):
+        return {}
+    with open(LOCK_FILE) as fileobj:
+        return json.load(fileobj)
+
+
+def vendor_integrity(package, filename):
+    return vendor_lock().get(vendor_path(package, filename), '')
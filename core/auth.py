@@ -0,0 +1,47 @@
+"""
+Cached user lookup for ``AuthenticationMiddleware``.
+
+Django loads ``request.user`` with one query per request. The backend below
+keeps the user, with their profile attached, in the cache instead, so a
+logged-in request that only needs ``request.user`` (or ``request.user.profile``)
+does not touch the auth tables. Signals in ``core.signals`` drop the entry
+whenever the user or their profile is saved or deleted.
+"""
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+from django.db import transaction
+
+
+def user_cache_key(user_id):
+    return f'auth:user:{user_id}'
+
+
+def user_cache_timeout():
+    return getattr(settings, 'AUTH_USER_CACHE_TIMEOUT', 300)
+
+
+def invalidate_user(user_id):
+    """Forget the cached copy of a user."""
+    key = user_cache_key(user_id)
+    cache.delete(key)
+    # A request that read the old row before this transaction committed may
+    # cache it again in between; drop it once more after commit
+    transaction.on_commit(lambda: cache.delete(key))
+
+
+class CachedModelBackend(ModelBackend):
+    """``ModelBackend`` whose ``get_user()`` is served from the cache."""
+
+    def get_user(self, user_id):
+        key = user_cache_key(user_id)
+        user = cache.get(key)
+        if user is None:
+            UserModel = get_user_model()
+            try:
+                user = UserModel._default_manager.select_related('profile').get(pk=user_id)
+            except UserModel.DoesNotExist:
+                return None
+            cache.set(key, user, user_cache_timeout())
+        return user if self.user_can_authenticate(user) else None
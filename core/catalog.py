@@ -0,0 +1,60 @@
+"""
+Catalog-wide change tracking.
+
+A single "last modified" stamp covers every ``Book``, ``Author`` and
+``Genre`` row. It is bumped by signals on every save, delete and genre
+assignment, so conditional requests can be answered without touching the
+catalog tables. The stamp lives in the one ``CatalogStamp`` row, where
+changes made by background workers are seen by every web process, and is
+cached for ``CATALOG_STAMP_TIMEOUT`` seconds. Before the first change it is
+taken from the indexed ``updated_at`` columns.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Max
+from django.utils import timezone
+
+LAST_MODIFIED_KEY = 'catalog:last_modified'
+
+STAMP_PK = 1
+
+
+def stamp_timeout():
+    return getattr(settings, 'CATALOG_STAMP_TIMEOUT', 5)
+
+
+def _latest_update():
+    from .models import Author, Book, Genre
+
+    candidates = [
+        model.objects.aggregate(latest=Max('updated_at'))['latest']
+        for model in (Book, Author, Genre)
+    ]
+    return max((c for c in candidates if c is not None), default=timezone.now())
+
+
+def catalog_last_modified():
+    """Return the time of the most recent change to the catalog."""
+    stamp = cache.get(LAST_MODIFIED_KEY)
+    if stamp is None:
+        from .models import CatalogStamp
+
+        stamp = CatalogStamp.objects.filter(pk=STAMP_PK).values_list('modified_at', flat=True).first()
+        if stamp is None:
+            stamp = CatalogStamp.objects.get_or_create(
+                pk=STAMP_PK, defaults={'modified_at': _latest_update()},
+            )[0].modified_at
+        # add() so a concurrent touch_catalog() is never overwritten
+        cache.add(LAST_MODIFIED_KEY, stamp, stamp_timeout())
+        stamp = cache.get(LAST_MODIFIED_KEY, stamp)
+    return stamp
+
+
+def touch_catalog():
+    """Record that the catalog changed just now."""
+    from .models import CatalogStamp
+
+    now = timezone.now()
+    if not CatalogStamp.objects.filter(pk=STAMP_PK).update(modified_at=now):
+        CatalogStamp.objects.update_or_create(pk=STAMP_PK, defaults={'modified_at': now})
+    cache.set(LAST_MODIFIED_KEY, now, stamp_timeout())
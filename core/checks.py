@@ -0,0 +1,21 @@
+from django.core.checks import Error, Tags, register
+
+from . import assets
+
+
+@register(Tags.staticfiles, deploy=True)
+def check_vendored_assets(app_configs, **kwargs):
+    """Vendored scripts must be in the static tree before the site is deployed.
+
+    Pages fall back to the upstream copy of a missing file, so
+    ``manage.py check --deploy`` is where a deploy that forgot
+    ``vendor_assets`` gets stopped.
+    """
+    missing = assets.missing_vendor_files()
+    if not missing:
+        return []
+    return [Error(
+        f"Vendored static files are missing: {', '.join(missing)}",
+        hint='Run "manage.py vendor_assets" and commit core/static/core/vendor/.',
+        id='core.E001',
+    )]
@@ -0,0 +1,180 @@
+"""
+Personal-data export.
+
+A user's profile, reading progress, bookmarks and reviews are written as
+NDJSON or CSV files inside a zip archive. The archive is produced by a
+generator: rows are read with ``.iterator(chunk_size=...)`` and compressed
+into a zip stream that never seeks, so each chunk of output can be sent (or
+written to disk) as soon as it is ready and memory stays flat however much
+a user has read.
+"""
+import csv
+import io
+import itertools
+import json
+import zipfile
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from .sharding import catalog_database, user_database
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+EXPORT_CHUNK_SIZE = 2000
+# Bytes of compressed output collected before a chunk is handed on
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class _ZipStream:
+    """Write-only file object that collects what ``zipfile`` writes.
+
+    It reports a position but cannot seek, which makes ``zipfile`` emit data
+    descriptors after each member instead of rewriting local headers.
+    """
+
+    def __init__(self):
+        self.buffer = []
+        self.buffered = 0
+        self.position = 0
+
+    def write(self, data):
+        if data:
+            self.buffer.append(bytes(data))
+            self.buffered += len(data)
+            self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        return data
+
+
+def _profile(user):
+    from .models import UserProfile
+
+    profile = UserProfile.objects.filter(user=user).values('bio', 'avatar', 'created_at', 'updated_at').first()
+    return {
+        'username': user.username,
+        'email': user.email,
+        'first_name': user.first_name,
+        'last_name': user.last_name,
+        'date_joined': user.date_joined,
+        'last_login': user.last_login,
+        'profile': profile,
+    }
+
+
+def datasets(user):
+    """Return ``(name, fields, queryset)`` for every table exported for ``user``."""
+    from .models import ArchivedReadingProgress, Bookmark, ReadingProgress, Review
+
+    book_fields = ['book__title', 'book__isbn', 'book__author__name']
+    using = user_database(user)
+    return [
+        (
+            'reading_progress',
+            book_fields + ['current_page', 'is_completed', 'last_read', 'created_at'],
+            ReadingProgress.objects.using(using).filter(user=user).order_by('pk'),
+        ),
+        (
+            'archived_reading_progress',
+            book_fields + ['current_page', 'is_completed', 'last_read', 'created_at', 'archived_at'],
+            ArchivedReadingProgress.objects.using(using).filter(user=user).order_by('pk'),
+        ),
+        (
+            'bookmarks',
+            book_fields + ['created_at'],
+            Bookmark.objects.using(using).filter(user=user).order_by('pk'),
+        ),
+        (
+            'reviews',
+            book_fields + ['rating', 'title', 'content', 'is_public', 'created_at', 'updated_at'],
+            Review.objects.filter(user=user).order_by('pk'),
+        ),
+    ]
+
+
+def _values(fields, queryset):
+    """``queryset.values_list(*fields)``, with ``book__`` fields read from the catalog.
+
+    Rows on a shard other than the catalog database cannot join the book
+    tables, so each chunk of rows is matched with its books in one query.
+    """
+    rows = queryset.values_list(*fields).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    if queryset.db == catalog_database():
+        yield from rows
+        return
+
+    from .models import Book
+
+    book_fields = [field.removeprefix('book__') for field in fields if field.startswith('book__')]
+    own_fields = [field for field in fields if not field.startswith('book__')]
+    rows = queryset.values_list('book_id', *own_fields).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    while chunk := list(itertools.islice(rows, EXPORT_CHUNK_SIZE)):
+        books = {
+            pk: dict(zip(book_fields, values))
+            for pk, *values in Book.objects.filter(pk__in={row[0] for row in chunk}).values_list('pk', *book_fields)
+        }
+        for book_id, *values in chunk:
+            book, own = books.get(book_id, {}), dict(zip(own_fields, values))
+            yield tuple(book.get(field.removeprefix('book__')) if field.startswith('book__') else own[field]
+                        for field in fields)
+
+
+def _iter_rows(fields, queryset, fmt):
+    rows = _values(fields, queryset)
+    names = [field.replace('book__author__name', 'author').replace('book__', 'book_') for field in fields]
+    if fmt == 'csv':
+        line = io.StringIO()
+        writer = csv.writer(line)
+        writer.writerow(names)
+        yield line.getvalue()
+        for row in rows:
+            line.seek(0)
+            line.truncate()
+            writer.writerow([value.isoformat() if hasattr(value, 'isoformat') else value for value in row])
+            yield line.getvalue()
+    else:
+        for row in rows:
+            yield json.dumps(dict(zip(names, row)), cls=DjangoJSONEncoder) + '\n'
+
+
+def iter_export(user, fmt='ndjson'):
+    """Yield the bytes of a zip archive with all of ``user``'s data."""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f'Unknown export format: {fmt}')
+
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        with archive.open('profile.json', 'w') as member:
+            member.write(json.dumps(_profile(user), cls=DjangoJSONEncoder, indent=2).encode('utf-8'))
+
+        for name, fields, queryset in datasets(user):
+            # Sizes are unknown up front, so allow members past 4 GiB
+            with archive.open(f'{name}.{fmt}', 'w', force_zip64=True) as member:
+                for text in _iter_rows(fields, queryset, fmt):
+                    member.write(text.encode('utf-8'))
+                    if stream.buffered >= STREAM_CHUNK_SIZE:
+                        yield stream.drain()
+    # Closing the archive wrote the last member's trailer and the directory
+    yield stream.drain()
+
+
+def export_filename(user):
+    return f'bookreader-{user.username}-{timezone.now():%Y%m%d}.zip'
+
+
+def write_export(user, path, fmt='ndjson'):
+    """Write ``user``'s export archive to ``path``."""
+    with open(path, 'wb') as fileobj:
+        for chunk in iter_export(user, fmt):
+            fileobj.write(chunk)
+    return path
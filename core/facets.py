@@ -0,0 +1,412 @@
+"""
+Faceted catalog filtering over in-memory bitsets.
+
+``FacetIndex`` keeps, for every value of every facet (language, format,
+genre, star rating and publication year), a bitset of the books that have
+it: a Python int whose bit ``n`` is set for the book with id ``n``. A
+filter ORs the selected values of each facet and ANDs the facets together,
+and a count is a popcount, so neither touches the database. Counts are
+disjunctive: those of a facet apply the selection of every *other* facet,
+so they tell how many books ticking a value would give.
+
+Ratings are bucketed by whole stars (a 4.3 average is in bucket 4), so
+``rating`` ranges are exact for whole-star bounds; unreviewed books have no
+rating and no year is recorded for books without a publication date.
+
+Each process holds its own index. Signals update it in place for changes
+made in the process; changes made elsewhere are picked up when the catalog
+stamp (see ``core.catalog``) moves, by re-reading the books whose indexed
+``updated_at`` is newer than the last sync. A book count that disagrees
+with the index, i.e. a deletion, is settled with one scan of primary keys.
+
+``manage.py build_facets`` writes a snapshot to ``FACETS['SNAPSHOT_PATH']``;
+workers start from it and sync only what changed since, instead of reading
+the whole catalog.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import zlib
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .catalog import catalog_last_modified
+
+logger = logging.getLogger(__name__)
+
+FACETS_DEFAULTS = {
+    # Where build_facets writes the index and workers load it from (None: no snapshot)
+    'SNAPSHOT_PATH': None,
+    # Seconds before the last sync that are read again, for transactions committed late
+    'SYNC_OVERLAP': 5,
+}
+
+FACET_NAMES = ('language', 'format', 'genre', 'rating', 'year')
+# Facets filtered by a (min, max) range rather than by a set of values
+RANGE_FACETS = ('rating', 'year')
+# Book fields the index is built from; saves touching none of them leave it alone
+FACET_FIELDS = {'language', 'format', 'average_rating', 'review_count', 'publication_date'}
+GENRE = FACET_NAMES.index('genre')
+EMPTY_RECORD = ((),) * len(FACET_NAMES)
+# Changes applied at once above which rebuilding every bitset is cheaper
+REBUILD_THRESHOLD = 1000
+SNAPSHOT_VERSION = 1
+# Primary keys per query when reading back books missing from the index
+READ_CHUNK_SIZE = 500
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def facets_settings():
+    return {**FACETS_DEFAULTS, **getattr(settings, 'FACETS', {})}
+
+
+def make_record(language, format, average_rating, review_count, publication_date, genres=()):
+    """The facet values of a book, one tuple per facet in ``FACET_NAMES`` order."""
+    return (
+        (language,),
+        (format,),
+        tuple(sorted(genres)),
+        (min(int(float(average_rating)), 5),) if review_count else (),
+        (publication_date.year,) if publication_date else (),
+    )
+
+
+def read_books(queryset):
+    """``{pk: record}`` of the books in ``queryset``."""
+    from .models import Book
+
+    genres = defaultdict(list)
+    links = Book.genres.through.objects.filter(book_id__in=queryset.order_by().values('pk'))
+    for book_id, genre_id in links.values_list('book_id', 'genre_id').iterator(chunk_size=5000):
+        genres[book_id].append(genre_id)
+    rows = queryset.order_by().values_list(
+        'pk', 'language', 'format', 'average_rating', 'review_count', 'publication_date',
+    )
+    return {pk: make_record(*fields, genres.get(pk, ())) for pk, *fields in rows.iterator(chunk_size=5000)}
+
+
+def ids_descending(bits, offset=0, limit=None):
+    """Positions of the set bits of ``bits``, highest first, skipping ``offset`` of them."""
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+    ids = []
+    for position in range(len(data) - 1, -1, -1):
+        byte = data[position]
+        if not byte:
+            continue
+        if offset >= byte.bit_count():
+            offset -= byte.bit_count()
+            continue
+        for bit in range(7, -1, -1):
+            if not byte >> bit & 1:
+                continue
+            if offset:
+                offset -= 1
+                continue
+            ids.append(position * 8 + bit)
+            if limit is not None and len(ids) == limit:
+                return ids
+    return ids
+
+
+class Matches:
+    """Ids of the books in a bitset, newest (highest id) first; a ``Paginator`` can slice it."""
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.total = bits.bit_count()
+
+    def __len__(self):
+        return self.total
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step is not None:
+            raise TypeError('Matches only supports slicing')
+        start, stop, _ = key.indices(self.total)
+        return ids_descending(self.bits, start, max(stop - start, 0))
+
+
+class FacetIndex:
+    """Per-value bitsets of book ids for every facet, plus each book's record."""
+
+    def __init__(self):
+        self.bitsets = {name: {} for name in FACET_NAMES}
+        self.books = {}
+        self.all = 0
+        # Catalog stamp the index reflects, and the time its last sync started
+        self.stamp = None
+        self.synced_at = None
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.books)
+
+    # Building
+
+    @classmethod
+    def build(cls):
+        """Read the whole catalog."""
+        from .models import Book
+
+        index = cls()
+        index.stamp = catalog_last_modified()
+        index.synced_at = timezone.now()
+        index._build(read_books(Book.objects.all()))
+        return index
+
+    def _build(self, books):
+        """Replace every bitset, setting bits in byte arrays rather than one big int at a time."""
+        size = (max(books, default=0) >> 3) + 1
+        everything = bytearray(size)
+        arrays = {name: {} for name in FACET_NAMES}
+        for pk, record in books.items():
+            position, bit = pk >> 3, 1 << (pk & 7)
+            everything[position] |= bit
+            for name, values in zip(FACET_NAMES, record):
+                for value in values:
+                    array = arrays[name].get(value)
+                    if array is None:
+                        array = arrays[name][value] = bytearray(size)
+                    array[position] |= bit
+        with self.lock:
+            self.books = books
+            self.bitsets = {
+                name: {value: int.from_bytes(array, 'little') for value, array in values.items()}
+                for name, values in arrays.items()
+            }
+            self.all = int.from_bytes(everything, 'little')
+
+    # Snapshots
+
+    def save(self, path):
+        """Write the index to ``path``, atomically."""
+        with self.lock:
+            data = {
+                'version': SNAPSHOT_VERSION,
+                'stamp': self.stamp.isoformat(),
+                'synced_at': self.synced_at.isoformat(),
+                'books': [[pk, *record] for pk, record in self.books.items()],
+            }
+        payload = zlib.compress(json.dumps(data, separators=(',', ':')).encode())
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(dir=directory, prefix='.facets-')
+        try:
+            with os.fdopen(descriptor, 'wb') as snapshot:
+                snapshot.write(payload)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        return len(payload)
+
+    @classmethod
+    def load(cls, path):
+        """Read an index written by ``save()``; it still needs a ``sync()``."""
+        with open(path, 'rb') as snapshot:
+            data = json.loads(zlib.decompress(snapshot.read()))
+        if data.get('version') != SNAPSHOT_VERSION:
+            raise ValueError(f'unsupported snapshot version {data.get("version")!r}')
+        index = cls()
+        index.stamp = parse_datetime(data['stamp'])
+        index.synced_at = parse_datetime(data['synced_at'])
+        index._build({pk: tuple(tuple(values) for values in record) for pk, *record in data['books']})
+        return index
+
+    # Updates
+
+    def apply(self, changes):
+        """Replace the records of the books in ``changes`` (``None`` removes a book)."""
+        with self.lock:
+            if len(changes) > REBUILD_THRESHOLD:
+                books = dict(self.books)
+                for pk, record in changes.items():
+                    if record is None:
+                        books.pop(pk, None)
+                    else:
+                        books[pk] = record
+                self._build(books)
+                return
+            # Readers may be iterating the current dicts; swap in updated copies
+            bitsets = {name: dict(values) for name, values in self.bitsets.items()}
+            everything = self.all
+            for pk, record in changes.items():
+                old = self.books.get(pk)
+                if old == record:
+                    continue
+                bit = 1 << pk
+                for name, before, after in zip(FACET_NAMES, old or EMPTY_RECORD, record or EMPTY_RECORD):
+                    values = bitsets[name]
+                    for value in set(before) - set(after):
+                        remaining = values.get(value, 0) & ~bit
+                        if remaining:
+                            values[value] = remaining
+                        else:
+                            values.pop(value, None)
+                    for value in set(after) - set(before):
+                        values[value] = values.get(value, 0) | bit
+                if record is None:
+                    self.books.pop(pk, None)
+                    everything &= ~bit
+                else:
+                    self.books[pk] = record
+                    everything |= bit
+            self.bitsets = bitsets
+            self.all = everything
+
+    def update_book(self, book):
+        """Take a saved book's fields; its genres are kept (``m2m_changed`` reports those)."""
+        record = self.books.get(book.pk, EMPTY_RECORD)
+        self.apply({book.pk: make_record(
+            book.language, book.format, book.average_rating, book.review_count, book.publication_date,
+            record[GENRE],
+        )})
+
+    def change_genres(self, book_pks, genre_pks, add=True):
+        changes = {}
+        for pk in book_pks:
+            record = self.books.get(pk)
+            if record is None:
+                continue
+            genres = set(record[GENRE])
+            if add:
+                genres.update(genre_pks)
+            else:
+                genres.difference_update(genre_pks)
+            changes[pk] = record[:GENRE] + (tuple(sorted(genres)),) + record[GENRE + 1:]
+        self.apply(changes)
+
+    def sync(self):
+        """Catch up with changes made by other processes; returns whether anything was read."""
+        from .models import Book
+
+        stamp = catalog_last_modified()
+        if stamp == self.stamp:
+            return False
+        with self.lock:
+            if stamp == self.stamp:
+                return False
+            started = timezone.now()
+            since = self.synced_at - timedelta(seconds=facets_settings()['SYNC_OVERLAP'])
+            self.apply(read_books(Book.objects.filter(updated_at__gte=since)))
+            if Book.objects.count() != len(self.books):
+                # Deleted books leave no trace in updated_at
+                live = set(Book.objects.values_list('pk', flat=True).iterator(chunk_size=5000))
+                changes = dict.fromkeys(self.books.keys() - live)
+                missing = list(live - self.books.keys())
+                for start in range(0, len(missing), READ_CHUNK_SIZE):
+                    changes.update(read_books(Book.objects.filter(pk__in=missing[start:start + READ_CHUNK_SIZE])))
+                self.apply(changes)
+            self.stamp = stamp
+            self.synced_at = started
+        return True
+
+    # Queries
+
+    def values(self, name):
+        return list(self.bitsets[name])
+
+    def _matching(self, name, wanted, values):
+        if name in RANGE_FACETS:
+            low, high = wanted
+            return [value for value in values if (low is None or value >= low) and (high is None or value <= high)]
+        return [value for value in wanted if value in values]
+
+    def select(self, selection, bitsets=None):
+        """Bitset of the books matching ``selection``.
+
+        ``selection`` maps facet names to the values wanted, or to a
+        ``(min, max)`` pair (either may be ``None``) for ``RANGE_FACETS``.
+        """
+        bitsets = bitsets or self.bitsets
+        matches = self.all
+        for name, wanted in selection.items():
+            values = bitsets[name]
+            union = 0
+            for value in self._matching(name, wanted, values):
+                union |= values[value]
+            matches &= union
+        return matches
+
+    def counts(self, selection):
+        """``{facet: {value: count}}`` of the books each value would leave selected."""
+        bitsets = self.bitsets
+        counts = {}
+        for name in FACET_NAMES:
+            others = {other: wanted for other, wanted in selection.items() if other != name}
+            mask = self.select(others, bitsets)
+            counts[name] = {value: (bits & mask).bit_count() for value, bits in bitsets[name].items()}
+        return counts
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_selection(query, genre_ids):
+    """Selection from request parameters.
+
+    ``language``, ``format`` and ``genre`` (slugs, looked up in
+    ``genre_ids``) repeat; ``rating_min``, ``rating_max``, ``year_min`` and
+    ``year_max`` bound the ranges. Unparseable bounds are ignored.
+    """
+    selection = {}
+    for name in ('language', 'format'):
+        values = {value for value in query.getlist(name) if value}
+        if values:
+            selection[name] = values
+    slugs = [slug for slug in query.getlist('genre') if slug]
+    if slugs:
+        selection['genre'] = {genre_ids[slug] for slug in slugs if slug in genre_ids}
+    for name in RANGE_FACETS:
+        bounds = (_int(query.get(f'{name}_min')), _int(query.get(f'{name}_max')))
+        if bounds != (None, None):
+            selection[name] = bounds
+    return selection
+
+
+def loaded_index():
+    """This process's index if it has one, without loading it."""
+    return _index
+
+
+def load_index():
+    """The snapshot at ``SNAPSHOT_PATH`` if there is a usable one, else a fresh build (saved there)."""
+    path = facets_settings()['SNAPSHOT_PATH']
+    if path:
+        try:
+            index = FacetIndex.load(path)
+            logger.info('Loaded facet index of %d books from %s', len(index), path)
+            return index
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, KeyError, zlib.error) as exc:
+            logger.warning('Ignoring facet snapshot %s: %s', path, exc)
+    index = FacetIndex.build()
+    if path:
+        try:
+            index.save(path)
+        except OSError as exc:
+            logger.warning('Could not write facet snapshot %s: %s', path, exc)
+    return index
+
+
+def get_index():
+    """This process's index, loaded on first use and synced with the catalog."""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = load_index()
+    _index.sync()
+    return _index
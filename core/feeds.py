@@ -0,0 +1,239 @@
+"""
+OPDS catalog feeds (Atom, OPDS 1.2) and their OPDS 2.0 JSON equivalents.
+
+Feeds are produced by generators so they can be sent with a
+``StreamingHttpResponse``: rows are read with ``.iterator(chunk_size=...)``
+and written out one entry at a time, keeping memory flat no matter how large
+the catalog grows.
+"""
+import json
+from xml.sax.saxutils import escape, quoteattr
+
+from django.conf import settings
+from django.urls import reverse
+
+FEED_CHUNK_SIZE = getattr(settings, 'OPDS_CHUNK_SIZE', 500)
+
+ATOM_CONTENT_TYPE = 'application/atom+xml;charset=utf-8'
+NAVIGATION_TYPE = 'application/atom+xml;profile=opds-catalog;kind=navigation'
+ACQUISITION_TYPE = 'application/atom+xml;profile=opds-catalog;kind=acquisition'
+JSON_CONTENT_TYPE = 'application/opds+json'
+
+FORMAT_MIME_TYPES = {
+    'pdf': 'application/pdf',
+    'epub': 'application/epub+zip',
+    'mobi': 'application/x-mobipocket-ebook',
+    'txt': 'text/plain',
+}
+
+ATOM_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<feed xmlns="http://www.w3.org/2005/Atom" '
+    'xmlns:dc="http://purl.org/dc/terms/" '
+    'xmlns:opds="http://opds-spec.org/2010/catalog">\n'
+)
+
+
+def _isoformat(value):
+    return value.isoformat() if value else ''
+
+
+def _atom_link(rel, href, link_type, title=None):
+    title_attr = f' title={quoteattr(title)}' if title else ''
+    return f'<link rel={quoteattr(rel)} href={quoteattr(href)} type={quoteattr(link_type)}{title_attr}/>'
+
+
+class Feed:
+    """Description of a single catalog feed.
+
+    ``entries`` is an iterable of model instances; ``kind`` is either
+    ``'navigation'`` (entries are genres/authors linking to sub-feeds) or
+    ``'acquisition'`` (entries are books).
+    """
+
+    def __init__(self, request, feed_id, title, kind, entries, updated, self_url, json_url):
+        self.request = request
+        self.feed_id = feed_id
+        self.title = title
+        self.kind = kind
+        self.entries = entries
+        self.updated = updated
+        self.self_url = request.build_absolute_uri(self_url)
+        self.json_url = request.build_absolute_uri(json_url)
+        self.start_url = request.build_absolute_uri(reverse('opds_root'))
+
+    def absolute(self, url):
+        return self.request.build_absolute_uri(url)
+
+    @property
+    def feed_type(self):
+        return NAVIGATION_TYPE if self.kind == 'navigation' else ACQUISITION_TYPE
+
+
+def iter_atom(feed):
+    """Yield the Atom document for ``feed`` piece by piece."""
+    yield ATOM_HEADER
+    yield f'<id>{escape(feed.feed_id)}</id>\n'
+    yield f'<title>{escape(feed.title)}</title>\n'
+    yield f'<updated>{_isoformat(feed.updated)}</updated>\n'
+    yield _atom_link('self', feed.self_url, feed.feed_type) + '\n'
+    yield _atom_link('start', feed.start_url, NAVIGATION_TYPE) + '\n'
+    yield _atom_link('alternate', feed.json_url, JSON_CONTENT_TYPE) + '\n'
+    render = _atom_book_entry if feed.kind == 'acquisition' else _atom_navigation_entry
+    for obj in feed.entries:
+        yield render(feed, obj)
+    yield '</feed>\n'
+
+
+def _atom_navigation_entry(feed, entry):
+    return (
+        '<entry>'
+        f'<id>{escape(entry["id"])}</id>'
+        f'<title>{escape(entry["title"])}</title>'
+        f'<updated>{_isoformat(entry.get("updated"))}</updated>'
+        f'<content type="text">{escape(entry.get("summary", ""))}</content>'
+        + _atom_link('subsection', feed.absolute(entry['href']), entry['type'])
+        + '</entry>\n'
+    )
+
+
+def _file_url(feed, book):
+    # Links go through the book views, which check access on every request,
+    # so cached feeds never hand out direct storage URLs
+    return feed.absolute(reverse('book_file', kwargs={'slug': book.slug}))
+
+
+def _cover_url(feed, book):
+    return feed.absolute(reverse('book_cover', kwargs={'slug': book.slug}))
+
+
+def _atom_book_entry(feed, book):
+    parts = [
+        '<entry>',
+        f'<id>urn:bookreader:book:{book.pk}</id>',
+        f'<title>{escape(book.title)}</title>',
+        f'<updated>{_isoformat(book.updated_at)}</updated>',
+        f'<author><name>{escape(book.author.name)}</name>'
+        f'<uri>{escape(feed.absolute(reverse("opds_author", kwargs={"pk": book.author_id})))}</uri></author>',
+        f'<dc:language>{escape(book.language)}</dc:language>',
+        f'<dc:identifier>urn:isbn:{escape(book.isbn)}</dc:identifier>',
+    ]
+    if book.publisher:
+        parts.append(f'<dc:publisher>{escape(book.publisher)}</dc:publisher>')
+    if book.publication_date:
+        parts.append(f'<dc:issued>{book.publication_date.isoformat()}</dc:issued>')
+    for genre in book.genres.all():
+        parts.append(f'<category term={quoteattr(genre.slug)} label={quoteattr(genre.name)}/>')
+    if book.description:
+        parts.append(f'<summary type="text">{escape(book.description)}</summary>')
+    parts.append(_atom_link('alternate', feed.absolute(book.get_absolute_url()), 'text/html'))
+    if book.cover_image:
+        parts.append(_atom_link('http://opds-spec.org/image', _cover_url(feed, book), 'image/*'))
+    if book.file:
+        parts.append(_atom_link(
+            'http://opds-spec.org/acquisition/open-access',
+            _file_url(feed, book),
+            FORMAT_MIME_TYPES.get(book.format, 'application/octet-stream'),
+        ))
+    parts.append('</entry>\n')
+    return ''.join(parts)
+
+
+def iter_json(feed):
+    """Yield the OPDS 2.0 JSON document for ``feed`` piece by piece."""
+    header = {
+        'metadata': {
+            'identifier': feed.feed_id,
+            'title': feed.title,
+            'modified': _isoformat(feed.updated),
+        },
+        'links': [
+            {'rel': 'self', 'href': feed.json_url, 'type': JSON_CONTENT_TYPE},
+            {'rel': 'alternate', 'href': feed.self_url, 'type': feed.feed_type},
+        ],
+    }
+    key = 'publications' if feed.kind == 'acquisition' else 'navigation'
+    # Emit the header object without its closing brace, then the entries
+    yield json.dumps(header)[:-1] + f', "{key}": ['
+    render = _json_book_entry if feed.kind == 'acquisition' else _json_navigation_entry
+    separator = ''
+    for obj in feed.entries:
+        yield separator + json.dumps(render(feed, obj))
+        separator = ','
+    yield ']}\n'
+
+
+def _json_navigation_entry(feed, entry):
+    json_href = entry['href'].rstrip('/') + '.json'
+    return {
+        'href': feed.absolute(json_href),
+        'title': entry['title'],
+        'type': JSON_CONTENT_TYPE,
+        'rel': 'subsection',
+    }
+
+
+def _json_book_entry(feed, book):
+    metadata = {
+        '@type': 'http://schema.org/Book',
+        'identifier': f'urn:isbn:{book.isbn}',
+        'title': book.title,
+        'author': {'name': book.author.name, 'identifier': f'urn:bookreader:author:{book.author_id}'},
+        'language': book.language,
+        'modified': _isoformat(book.updated_at),
+        'subject': [{'name': g.name, 'code': g.slug} for g in book.genres.all()],
+    }
+    if book.publisher:
+        metadata['publisher'] = book.publisher
+    if book.publication_date:
+        metadata['published'] = book.publication_date.isoformat()
+    if book.description:
+        metadata['description'] = book.description
+    if book.page_count:
+        metadata['numberOfPages'] = book.page_count
+
+    links = [{'rel': 'alternate', 'href': feed.absolute(book.get_absolute_url()), 'type': 'text/html'}]
+    if book.file:
+        links.append({
+            'rel': 'http://opds-spec.org/acquisition/open-access',
+            'href': _file_url(feed, book),
+            'type': FORMAT_MIME_TYPES.get(book.format, 'application/octet-stream'),
+        })
+    publication = {'metadata': metadata, 'links': links}
+    if book.cover_image:
+        publication['images'] = [{'href': _cover_url(feed, book)}]
+    return publication
+
+
+def book_entries(queryset):
+    """Stream books for an acquisition feed with their author and genres."""
+    return (
+        queryset.select_related('author')
+        .prefetch_related('genres')
+        .order_by('-created_at', '-pk')
+        .iterator(chunk_size=FEED_CHUNK_SIZE)
+    )
+
+
+def genre_entries(queryset):
+    for genre in queryset.order_by('name').iterator(chunk_size=FEED_CHUNK_SIZE):
+        yield {
+            'id': f'urn:bookreader:genre:{genre.pk}',
+            'title': genre.name,
+            'summary': genre.description,
+            'updated': genre.updated_at,
+            'href': reverse('opds_genre', kwargs={'slug': genre.slug}),
+            'type': ACQUISITION_TYPE,
+        }
+
+
+def author_entries(queryset):
+    for author in queryset.order_by('name', 'pk').iterator(chunk_size=FEED_CHUNK_SIZE):
+        yield {
+            'id': f'urn:bookreader:author:{author.pk}',
+            'title': author.name,
+            'summary': author.bio,
+            'updated': author.updated_at,
+            'href': reverse('opds_author', kwargs={'pk': author.pk}),
+            'type': ACQUISITION_TYPE,
+        }
@@ -49,13 +49,7 @@ class ProfileForm(forms.ModelForm):
         # Add placeholders and help text
         self.fields['bio'].widget.attrs['placeholder'] = 'Tell us about yourself...'
         # Custom labels
-        self.fields['profile_picture'].label = 'Profile Picture'
-        self.fields['date_of_birth'].label = 'Date of Birth'
-        self.fields['phone_number'].label = 'Phone Number'
-        self.fields['facebook_profile'].label = 'Facebook Profile URL'
-        self.fields['twitter_profile'].label = 'Twitter Profile URL'
-        self.fields['instagram_profile'].label = 'Instagram Profile URL'
-        self.fields['email_notifications'].label = 'Receive email notifications'
+        self.fields['avatar'].label = 'Profile Picture'
 
 
 class UserForm(forms.ModelForm):
@@ -0,0 +1,144 @@
+"""HTTP helpers for serving stored files."""
+import mimetypes
+import re
+
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+RANGE_RE = re.compile(r'^bytes=(?P<start>\d*)-(?P<end>\d*)$')
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def parse_range(header, size):
+    """Return ``(start, end)`` (inclusive) for a single byte range, if valid."""
+    match = RANGE_RE.match(header.strip())
+    if not match or size == 0:
+        return None
+    start, end = match.group('start'), match.group('end')
+    if start == '':
+        if end == '':
+            return None
+        # Suffix range: the last N bytes
+        length = min(int(end), size)
+        return size - length, size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start > end:
+        return None
+    return start, end
+
+
+def _aligned(offset, size, chunk_size):
+    start = offset // chunk_size * chunk_size
+    return [start, min(start + chunk_size, size) - 1]
+
+
+def page_range(size, page, page_count, chunk_size=STREAM_CHUNK_SIZE):
+    """The byte range (inclusive, ``chunk_size`` aligned) where ``page`` of a PDF probably starts.
+
+    Like ``suggested_ranges()``, assumes pages are spread evenly through the file.
+    """
+    return _aligned(size * (page - 1) // page_count, size, chunk_size)
+
+
+def suggested_ranges(size, page, page_count, chunk_size=STREAM_CHUNK_SIZE):
+    """Byte ranges (inclusive) a PDF reader needs first to open ``page``.
+
+    Readers start with the header and the cross-reference table at the end
+    of the file; the page itself is guessed by assuming pages are spread
+    evenly through the file. Ranges are aligned to ``chunk_size`` (PDF.js's
+    default range chunk size) and merged.
+    """
+    if not size:
+        return []
+
+    candidates = [_aligned(0, size, chunk_size), _aligned(size - 1, size, chunk_size)]
+    if page_count and 1 < page <= page_count:
+        candidates.append(page_range(size, page, page_count, chunk_size))
+
+    ranges = []
+    for start, end in sorted(candidates):
+        if ranges and start <= ranges[-1][1] + 1:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([start, end])
+    return ranges
+
+
+def _iter_range(fileobj, start, length):
+    try:
+        fileobj.seek(start)
+        while length > 0:
+            data = fileobj.read(min(STREAM_CHUNK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        fileobj.close()
+
+
+def serve_file(request, fieldfile, etag=None, filename=None, cache_control=None):
+    """Serve ``fieldfile`` with conditional GET and single-range support.
+
+    ``etag`` should be a strong validator (such as the content hash) when
+    one is known; ranges are only honoured against strong validators or the
+    modification time.
+    """
+    return serve_stored(request, fieldfile.storage, fieldfile.name, etag=etag, filename=filename,
+                        cache_control=cache_control)
+
+
+def serve_stored(request, storage, name, etag=None, filename=None, content_type=None, cache_control=None):
+    """Serve the file ``name`` of ``storage``; see ``serve_file``."""
+    size = storage.size(name)
+    try:
+        last_modified = storage.get_modified_time(name).timestamp()
+    except (NotImplementedError, OSError):
+        last_modified = None
+
+    etag = quote_etag(etag) if etag else None
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        return response
+
+    content_type = content_type or mimetypes.guess_type(filename or name)[0] or 'application/octet-stream'
+    range_header = request.headers.get('Range')
+    if_range = request.headers.get('If-Range')
+    byte_range = parse_range(range_header, size) if range_header and request.method == 'GET' else None
+    if byte_range and if_range and if_range not in (etag, http_date(last_modified) if last_modified else None):
+        # The client's copy is outdated; send the whole file instead
+        byte_range = None
+
+    if range_header and byte_range is None and not if_range and RANGE_RE.match(range_header.strip()):
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    if byte_range:
+        start, end = byte_range
+        length = end - start + 1
+        response = StreamingHttpResponse(
+            _iter_range(storage.open(name, 'rb'), start, length),
+            status=206,
+            content_type=content_type,
+        )
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = str(length)
+    else:
+        response = FileResponse(
+            storage.open(name, 'rb'),
+            content_type=content_type,
+            filename=filename,
+        )
+        response['Content-Length'] = str(size)
+
+    response['Accept-Ranges'] = 'bytes'
+    if etag:
+        response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    if cache_control:
+        patch_cache_control(response, **cache_control)
+    return response
@@ -0,0 +1,202 @@
+"""
+Import a reading history from a Goodreads-style shelf export.
+
+Both the Goodreads CSV export and JSON (a list of objects with the same
+fields) are accepted. Rows are matched to catalog books through an
+in-memory index keyed by ISBN and by normalized title and author, then
+turned into bookmarks ("to-read"), reading progress ("currently-reading"
+and "read") and reviews (any row with a rating). Everything is written
+with ``bulk_create(ignore_conflicts=True)``, so existing rows are left
+alone and re-running an import is harmless. Ratings of the reviewed books
+are recomputed once, in bulk, at the end.
+"""
+import csv
+import io
+import json
+import re
+import unicodedata
+
+from django.db import transaction
+
+from .models import Book, Bookmark, ReadingProgress, Review
+from .sharding import user_database
+
+IMPORT_BATCH_SIZE = 500
+
+# Accepted spellings of each field, after normalize_key()
+FIELD_ALIASES = {
+    'isbn13': ('isbn13', 'isbn_13'),
+    'isbn': ('isbn', 'isbn10', 'isbn_10'),
+    'title': ('title',),
+    'author': ('author', 'authors', 'author_name'),
+    'rating': ('my_rating', 'rating'),
+    'review': ('my_review', 'review'),
+    'shelf': ('exclusive_shelf', 'shelf', 'status'),
+}
+
+
+class ImportFormatError(ValueError):
+    """The uploaded file is not a shelf export we understand."""
+
+
+def normalize_key(key):
+    return re.sub(r'[^a-z0-9]+', '_', str(key).strip().lower()).strip('_')
+
+
+def normalize_text(value):
+    """Lowercase ASCII words only, so punctuation and accents never matter."""
+    value = unicodedata.normalize('NFKD', str(value or '')).encode('ascii', 'ignore').decode()
+    return ' '.join(re.findall(r'[a-z0-9]+', value.lower()))
+
+
+def short_title(title):
+    """Drop series markers and subtitles: "Dune (Dune, #1): A Novel" -> "dune"."""
+    title = re.sub(r'\([^)]*#\d+[^)]*\)', '', str(title or ''))
+    return normalize_text(re.split(r'[:;]', title)[0])
+
+
+def clean_isbn(value):
+    """Return an ISBN-13 for an ISBN-10/13 in any notation (e.g. ``="0439023483"``)."""
+    digits = re.sub(r'[^0-9Xx]', '', str(value or '')).upper()
+    if len(digits) == 13 and digits.isdigit():
+        return digits
+    if len(digits) == 10 and digits[:9].isdigit():
+        core = '978' + digits[:9]
+        total = sum(int(d) * (1 if i % 2 == 0 else 3) for i, d in enumerate(core))
+        return core + str((10 - total % 10) % 10)
+    return None
+
+
+class BookIndex:
+    """In-memory lookup of catalog books by ISBN and by title and author."""
+
+    def __init__(self, rows):
+        self.by_isbn = {}
+        self.by_title_author = {}
+        self.by_short_title_author = {}
+        for pk, isbn, title, author, page_count in rows:
+            isbn13 = clean_isbn(isbn)
+            if isbn13:
+                self.by_isbn.setdefault(isbn13, (pk, page_count))
+            author_key = normalize_text(author)
+            self.by_title_author.setdefault((normalize_text(title), author_key), (pk, page_count))
+            self.by_short_title_author.setdefault((short_title(title), author_key), (pk, page_count))
+
+    @classmethod
+    def from_catalog(cls):
+        rows = Book.objects.order_by().values_list('pk', 'isbn', 'title', 'author__name', 'page_count')
+        return cls(rows.iterator(chunk_size=2000))
+
+    def match(self, entry):
+        """Return ``(book_id, page_count)`` for an import row, or ``None``."""
+        for field in ('isbn13', 'isbn'):
+            isbn = clean_isbn(entry.get(field))
+            if isbn and isbn in self.by_isbn:
+                return self.by_isbn[isbn]
+        author = normalize_text(entry.get('author'))
+        return (
+            self.by_title_author.get((normalize_text(entry.get('title')), author))
+            or self.by_short_title_author.get((short_title(entry.get('title')), author))
+        )
+
+
+def _canonical(record):
+    record = {normalize_key(key): value for key, value in record.items()}
+    entry = {}
+    for field, aliases in FIELD_ALIASES.items():
+        entry[field] = next((record[alias] for alias in aliases if record.get(alias) not in (None, '')), None)
+    return entry
+
+
+def parse_shelf(data, fmt=None):
+    """Parse an export (``bytes`` or ``str``) into canonical row dicts."""
+    if isinstance(data, bytes):
+        data = data.decode('utf-8-sig')
+    fmt = fmt or ('json' if data.lstrip()[:1] in ('[', '{') else 'csv')
+    if fmt == 'json':
+        try:
+            records = json.loads(data)
+        except ValueError as exc:
+            raise ImportFormatError(f'Invalid JSON: {exc}') from exc
+        if isinstance(records, dict):
+            records = records.get('books') or records.get('items') or []
+        if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+            raise ImportFormatError('Expected a list of book objects')
+    elif fmt == 'csv':
+        records = list(csv.DictReader(io.StringIO(data)))
+    else:
+        raise ImportFormatError(f'Unknown format: {fmt}')
+
+    entries = [_canonical(record) for record in records]
+    if entries and not any(entry['title'] or entry['isbn'] or entry['isbn13'] for entry in entries):
+        raise ImportFormatError('No title or ISBN column found')
+    return entries
+
+
+def _rating(value):
+    try:
+        rating = int(float(value))
+    except (TypeError, ValueError):
+        return None
+    return rating if 1 <= rating <= 5 else None
+
+
+def import_shelf(user, entries, index=None):
+    """Create bookmarks, progress and reviews for ``user`` from parsed rows.
+
+    Returns a summary dict with the counts of created rows and the titles
+    that did not match any book.
+    """
+    index = index or BookIndex.from_catalog()
+    bookmarks, progress, reviews = {}, {}, {}
+    unmatched = []
+
+    for entry in entries:
+        match = index.match(entry)
+        if match is None:
+            unmatched.append(entry['title'] or entry['isbn13'] or entry['isbn'])
+            continue
+        book_id, page_count = match
+        shelf = normalize_key(entry['shelf'] or '')
+        if shelf in ('read', 'completed', 'finished'):
+            progress[book_id] = ReadingProgress(
+                user=user, book_id=book_id, current_page=page_count or 0, is_completed=True,
+            )
+        elif shelf in ('currently_reading', 'reading'):
+            progress.setdefault(book_id, ReadingProgress(user=user, book_id=book_id, current_page=1))
+        else:
+            bookmarks[book_id] = Bookmark(user=user, book_id=book_id)
+
+        rating = _rating(entry['rating'])
+        if rating:
+            text = (entry['review'] or '').strip()
+            reviews[book_id] = Review(
+                user=user, book_id=book_id, rating=rating,
+                title=text.splitlines()[0][:200] if text else 'Imported rating',
+                content=text, is_public=bool(text),
+            )
+
+    # Bookmarks and progress live on the user's shard, reviews with the catalog
+    using = user_database(user)
+    managers = {
+        Bookmark: Bookmark.objects.using(using),
+        ReadingProgress: ReadingProgress.objects.using(using),
+        Review: Review.objects.all(),
+    }
+    models = ((Bookmark, bookmarks), (ReadingProgress, progress), (Review, reviews))
+    before = {model: managers[model].filter(user=user).count() for model, _ in models}
+    with transaction.atomic(using=using), transaction.atomic():
+        for model, rows in models:
+            managers[model].bulk_create(rows.values(), batch_size=IMPORT_BATCH_SIZE, ignore_conflicts=True)
+        if reviews:
+            # Review.save() is bypassed, so refresh the ratings here, once
+            Book.refresh_ratings(Book.objects.filter(pk__in=list(reviews)))
+
+    return {
+        'rows': len(entries),
+        'matched': len(entries) - len(unmatched),
+        'bookmarks': managers[Bookmark].filter(user=user).count() - before[Bookmark],
+        'reading_progress': managers[ReadingProgress].filter(user=user).count() - before[ReadingProgress],
+        'reviews': managers[Review].filter(user=user).count() - before[Review],
+        'unmatched': unmatched,
+    }
@@ -0,0 +1,47 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from core.models import ArchivedReadingProgress, ReadingProgress
+from core.sharding import all_shards
+
+ARCHIVED_FIELDS = ('user_id', 'book_id', 'current_page', 'is_completed', 'last_read', 'created_at')
+
+
+class Command(BaseCommand):
+    help = ('Move reading progress that never got past page 1 and has not been touched for months '
+            'into the archive table. It is restored when the user opens the book again.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months', type=int, default=6, help='Archive rows untouched for this long (default: 6).')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows moved per transaction (default: 1000).')
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many rows would be archived.')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=30 * options['months'])
+        for using in all_shards():
+            self.archive(using, cutoff, options)
+
+    def archive(self, using, cutoff, options):
+        stale = ReadingProgress.objects.using(using).filter(
+            last_read__lt=cutoff, current_page__lte=1, is_completed=False,
+        )
+        if options['dry_run']:
+            self.stdout.write(f'{stale.count()} reading progress rows on {using} would be archived')
+            return
+
+        total = 0
+        while True:
+            with transaction.atomic(using=using):
+                rows = list(stale.order_by('last_read').values('pk', *ARCHIVED_FIELDS)[:options['batch_size']])
+                if not rows:
+                    break
+                ArchivedReadingProgress.objects.using(using).bulk_create(
+                    [ArchivedReadingProgress(**{field: row[field] for field in ARCHIVED_FIELDS}) for row in rows],
+                    ignore_conflicts=True,
+                )
+                ReadingProgress.objects.using(using).filter(pk__in=[row['pk'] for row in rows]).delete()
+            total += len(rows)
+        self.stdout.write(f'Archived {total} reading progress rows on {using}')
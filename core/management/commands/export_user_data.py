@@ -0,0 +1,73 @@
+import multiprocessing
+import os
+
+import django
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from core import export
+
+
+def _export_batch(user_ids, output_dir, fmt):
+    if not django.apps.apps.ready:
+        # Spawned (rather than forked) children start without Django set up
+        django.setup()
+    written = 0
+    for user in User.objects.filter(pk__in=user_ids).iterator():
+        export.write_export(user, os.path.join(output_dir, f'{user.username}.zip'), fmt)
+        written += 1
+    connections.close_all()
+    return written
+
+
+def _batches(user_ids, size):
+    batch = []
+    for user_id in user_ids:
+        batch.append(user_id)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Command(BaseCommand):
+    help = "Export users' profile, reading progress, bookmarks and reviews as zip archives."
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='*', help='Users to export.')
+        parser.add_argument('--all', action='store_true', help='Export every user.')
+        parser.add_argument('--format', choices=export.EXPORT_FORMATS, default='ndjson',
+                            help='Format of the files inside each archive (default: ndjson).')
+        parser.add_argument('--output-dir', default='.', help='Directory to write <username>.zip files to.')
+        parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                            help='Worker processes for --all (default: one per CPU).')
+        parser.add_argument('--batch-size', type=int, default=100, help='Users per worker job (default: 100).')
+
+    def handle(self, *args, **options):
+        if options['all'] == bool(options['usernames']):
+            raise CommandError('Give either usernames or --all.')
+        output_dir = options['output_dir']
+        os.makedirs(output_dir, exist_ok=True)
+
+        if options['usernames']:
+            users = User.objects.filter(username__in=options['usernames'])
+            missing = set(options['usernames']) - set(users.values_list('username', flat=True))
+            if missing:
+                raise CommandError(f"Unknown users: {', '.join(sorted(missing))}")
+            for user in users:
+                path = export.write_export(user, os.path.join(output_dir, f'{user.username}.zip'), options['format'])
+                self.stdout.write(path)
+            return
+
+        user_ids = list(User.objects.order_by('pk').values_list('pk', flat=True))
+        jobs = [(batch, output_dir, options['format']) for batch in _batches(user_ids, options['batch_size'])]
+        if options['processes'] <= 1:
+            total = sum(_export_batch(*job) for job in jobs)
+        else:
+            # Forked children must not share the parent's database connections
+            connections.close_all()
+            with multiprocessing.Pool(options['processes']) as pool:
+                total = sum(pool.starmap(_export_batch, jobs, chunksize=1))
+        self.stdout.write(f'Exported {total} users to {output_dir}')
@@ -0,0 +1,75 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from django.utils import timezone
+
+from core.models import Blob, Book
+from core.storage import blob_storage, content_hash
+
+
+class Command(BaseCommand):
+    help = 'Delete content-addressed blobs that no book references any more.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-hours', type=float, default=24,
+                            help='Keep unreferenced blobs younger than this (default: 24).')
+        parser.add_argument('--reconcile', action='store_true',
+                            help='Recount references from the Book table before collecting.')
+        parser.add_argument('--dry-run', action='store_true', help='Report what would be deleted.')
+
+    def handle(self, *args, **options):
+        storage = blob_storage()
+        cutoff = timezone.now() - timedelta(hours=options['grace_hours'])
+
+        if options['reconcile']:
+            self.reconcile()
+
+        deleted = 0
+        for blob in Blob.objects.filter(ref_count=0, updated_at__lt=cutoff).iterator():
+            self.stdout.write(f'unreferenced: {blob.name}')
+            if not options['dry_run']:
+                storage.delete(blob.name)
+                blob.delete()
+            deleted += 1
+
+        # Files written by an upload whose book was never saved have no Blob row
+        known = set(Blob.objects.values_list('name', flat=True))
+        for name in self.walk(storage, storage.prefix):
+            if name in known or not content_hash(name):
+                continue
+            if storage.get_modified_time(name) >= cutoff:
+                continue
+            self.stdout.write(f'orphaned: {name}')
+            if not options['dry_run']:
+                storage.delete(name)
+            deleted += 1
+
+        verb = 'Would delete' if options['dry_run'] else 'Deleted'
+        self.stdout.write(f'{verb} {deleted} blob(s)')
+
+    def reconcile(self):
+        counts = {}
+        for field in ('file', 'cover_image'):
+            rows = Book.objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True})
+            for row in rows.values(field).annotate(n=Count('pk')).iterator():
+                name = row[field]
+                if content_hash(name):
+                    counts[name] = counts.get(name, 0) + row['n']
+
+        known = set(Blob.objects.values_list('name', flat=True))
+        for name in set(counts) - known:
+            Blob.adjust([name], 0)
+        for blob in Blob.objects.iterator():
+            actual = counts.get(blob.name, 0)
+            if blob.ref_count != actual:
+                Blob.objects.filter(pk=blob.pk).update(ref_count=actual, updated_at=timezone.now())
+
+    def walk(self, storage, path):
+        if not storage.exists(path):
+            return
+        directories, files = storage.listdir(path)
+        for name in files:
+            yield f'{path}/{name}'
+        for directory in directories:
+            yield from self.walk(storage, f'{path}/{directory}')
@@ -0,0 +1,32 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from core import library_import
+
+
+class Command(BaseCommand):
+    help = "Import a Goodreads-style CSV or JSON shelf export into a user's library."
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('path', help='CSV or JSON export file.')
+        parser.add_argument('--format', choices=('csv', 'json'), help='Default: detected from the content.')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError(f"Unknown user: {options['username']}")
+        with open(options['path'], 'rb') as fileobj:
+            try:
+                entries = library_import.parse_shelf(fileobj.read(), options['format'])
+            except library_import.ImportFormatError as exc:
+                raise CommandError(str(exc))
+
+        summary = library_import.import_shelf(user, entries)
+        self.stdout.write(
+            f"{summary['matched']} of {summary['rows']} rows matched: {summary['bookmarks']} bookmarks, "
+            f"{summary['reading_progress']} reading progress entries, {summary['reviews']} reviews created"
+        )
+        for title in summary['unmatched']:
+            self.stdout.write(f'  not found: {title}')
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from core import reflow
+from core.models import Book
+
+
+class Command(BaseCommand):
+    help = 'Split EPUB and TXT books into sanitized HTML chunks for the reader.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('slugs', nargs='*', help='Only ingest these books (default: all reflowable books).')
+        parser.add_argument('--force', action='store_true', help='Re-ingest books that already have a manifest.')
+
+    def handle(self, *args, **options):
+        books = Book.objects.filter(format__in=reflow.REFLOWABLE_FORMATS)
+        if options['slugs']:
+            books = books.filter(slug__in=options['slugs'])
+
+        for book in books.iterator():
+            if not book.file:
+                continue
+            if not options['force'] and reflow.load_manifest(book) is not None:
+                continue
+            try:
+                manifest = reflow.ingest_book(book)
+            except reflow.IngestError as exc:
+                self.stderr.write(f'{book.slug}: {exc}')
+                continue
+            self.stdout.write(f"{book.slug}: {len(manifest['chunks'])} chunks")
@@ -0,0 +1,68 @@
+import shutil
+import sys
+import tracemalloc
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.profiling import ProfileStore, describe, memory_report
+
+
+class Command(BaseCommand):
+    help = 'List, show, download, diff or delete stored request profiles and memory snapshots.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', nargs='?', default='list', choices=['list', 'show', 'download', 'diff', 'clear'])
+        parser.add_argument('names', nargs='*', help='Profile names, as printed by "list".')
+        parser.add_argument('--output', '-o', default=None,
+                            help='Where "download" writes the file (default: its name, "-" for stdout).')
+        parser.add_argument('--limit', type=int, default=30, help='Rows shown by "show" and "diff" (default: 30).')
+
+    def handle(self, *args, **options):
+        store = ProfileStore()
+        action, names = options['action'], options['names']
+        try:
+            if action == 'list':
+                self.list(store)
+            elif action == 'show':
+                for name in self.require(names, 1):
+                    self.stdout.write(describe(store.path(name), options['limit']))
+            elif action == 'download':
+                self.download(store, self.require(names, 1, exact=True)[0], options['output'])
+            elif action == 'diff':
+                first, second = self.require(names, 2, exact=True)
+                self.diff(store, first, second, options['limit'])
+            elif action == 'clear':
+                targets = names or [name for name, _, _ in store.entries()]
+                for name in targets:
+                    store.delete(name)
+                self.stdout.write(f'Deleted {len(targets)} profile(s)')
+        except FileNotFoundError as exc:
+            raise CommandError(f'No such profile: {exc}')
+
+    def require(self, names, count, exact=False):
+        if len(names) < count or (exact and len(names) != count):
+            raise CommandError(f'Expected {count} profile name(s)')
+        return names
+
+    def list(self, store):
+        entries = store.entries()
+        for name, size, modified in entries:
+            self.stdout.write(f'{datetime.fromtimestamp(modified):%Y-%m-%d %H:%M:%S}  {size:>10}  {name}')
+        self.stdout.write(f'{len(entries)} profile(s) in {store.directory}')
+
+    def download(self, store, name, output):
+        path = store.path(name)
+        if output == '-':
+            with open(path, 'rb') as fileobj:
+                shutil.copyfileobj(fileobj, sys.stdout.buffer)
+            return
+        shutil.copyfile(path, output or name)
+        self.stderr.write(f'Wrote {output or name}')
+
+    def diff(self, store, first, second, limit):
+        if not (first.endswith('.tracemalloc') and second.endswith('.tracemalloc')):
+            raise CommandError('diff compares two .tracemalloc snapshots')
+        before = tracemalloc.Snapshot.load(store.path(first))
+        after = tracemalloc.Snapshot.load(store.path(second))
+        self.stdout.write(memory_report(before, after, f'{first} -> {second}', limit))
@@ -0,0 +1,101 @@
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from core import sharding
+from core.models import UserShard
+
+
+class Command(BaseCommand):
+    help = ('Move users whose recorded shard differs from their place on the hash ring (or the given '
+            'users to --to) while they keep reading: copy their rows, switch them over, wait for cached '
+            'placements to expire, copy what changed meanwhile and delete the old rows.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', action='append', dest='usernames', help='Move only this user (repeatable).')
+        parser.add_argument('--to', help='Shard to move the --user users to (default: their place on the ring).')
+        parser.add_argument('--batch-size', type=int, default=100, help='Users switched over together (default: 100).')
+        parser.add_argument('--grace', type=float, default=None,
+                            help='Seconds to wait after switching a batch (default: DIRECTORY_CACHE_TIMEOUT + 5).')
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many users would move where.')
+
+    def handle(self, *args, **options):
+        config = sharding.sharding_settings()
+        grace = options['grace'] if options['grace'] is not None else config['DIRECTORY_CACHE_TIMEOUT'] + 5
+        if options['to'] and not options['usernames']:
+            raise CommandError('--to needs --user.')
+        if options['to'] and options['to'] not in settings.DATABASES:
+            raise CommandError(f'Unknown database {options["to"]!r}.')
+        directory = UserShard.objects.using(sharding.catalog_database())
+
+        unfinished = list(directory.exclude(previous_shard='').values_list('user_id', 'previous_shard', 'shard',
+                                                                            'moved_at'))
+        if unfinished and not options['dry_run']:
+            self.stdout.write(f'Finishing {len(unfinished)} interrupted moves')
+            self.finish([(user_id, source, target) for user_id, source, target, _ in unfinished],
+                        min(moved_at for *_, moved_at in unfinished), grace)
+
+        moves = self.plan(directory, options)
+        if options['dry_run']:
+            for (source, target), count in sorted(Counter((source, target) for _, source, target in moves).items()):
+                self.stdout.write(f'{count} users would move from {source} to {target}')
+            self.stdout.write(f'{len(moves)} users would move')
+            return
+
+        for start in range(0, len(moves), options['batch_size']):
+            self.move(moves[start:start + options['batch_size']], directory, grace)
+        self.stdout.write(f'Moved {len(moves)} users')
+
+    def plan(self, directory, options):
+        """``(user_id, source, target)`` of every user to move."""
+        ring = sharding.ring()
+        if options['usernames']:
+            users = dict(User.objects.filter(username__in=options['usernames']).values_list('username', 'pk'))
+            missing = set(options['usernames']) - set(users)
+            if missing:
+                raise CommandError(f"Unknown users: {', '.join(sorted(missing))}")
+            placements = [(user_id, sharding.user_database(user_id)) for user_id in users.values()]
+        else:
+            placements = directory.order_by('pk').values_list('user_id', 'shard').iterator()
+        moves = []
+        for user_id, shard in placements:
+            target = options['to'] or ring.shard(user_id)
+            if shard != target:
+                moves.append((user_id, shard, target))
+        return moves
+
+    def move(self, moves, directory, grace):
+        started = timezone.now()
+        for user_id, source, target in moves:
+            sharding.copy_user_rows(user_id, source, target)
+        # From here on reads and writes go to the new shard (once cached placements expire)
+        switched = []
+        with transaction.atomic(using=directory.db):
+            for user_id, source, target in moves:
+                # Skips users another run moved in the meantime
+                if directory.filter(user_id=user_id, shard=source).update(
+                    shard=target, previous_shard=source, moved_at=started,
+                ):
+                    switched.append((user_id, source, target))
+        for user_id, _, _ in switched:
+            sharding.forget_user(user_id)
+        self.finish(switched, started, grace)
+
+    def finish(self, moves, started, grace):
+        """Copy what was written to the old shards since ``started``, then delete it there."""
+        if grace:
+            self.stdout.write(f'Waiting {grace:g}s for {len(moves)} users to switch over')
+            time.sleep(grace)
+        directory = UserShard.objects.using(sharding.catalog_database())
+        for user_id, source, target in moves:
+            changed = sharding.copy_user_rows(user_id, source, target, since=started)
+            sharding.delete_user_rows(user_id, source)
+            directory.filter(user_id=user_id).update(previous_shard='')
+            sharding.forget_user(user_id)
+            self.stdout.write(f'User {user_id}: {source} -> {target}' + (f' ({changed} late changes)' if changed else ''),
+                              self.style.SUCCESS)
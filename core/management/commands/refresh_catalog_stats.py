@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Author, Genre
+
+
+class Command(BaseCommand):
+    help = 'Recompute the denormalized book counts and ratings on authors and genres.'
+
+    def handle(self, *args, **options):
+        authors = Author.refresh_stats()
+        genres = Genre.refresh_stats()
+        self.stdout.write(f'Refreshed {authors} authors and {genres} genres')
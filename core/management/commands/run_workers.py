@@ -0,0 +1,58 @@
+import multiprocessing
+import signal
+import threading
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from core import taskqueue
+
+
+def _worker_process(threads, poll_interval, burst):
+    if not django.apps.apps.ready:
+        # Spawned (rather than forked) children start without Django set up
+        django.setup()
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop_event.set())
+    signal.signal(signal.SIGINT, lambda *args: stop_event.set())
+    taskqueue.run_worker(threads, poll_interval, burst, stop_event)
+
+
+class Command(BaseCommand):
+    help = 'Run background task workers from the database queue.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1, help='Worker processes to start (default: 1).')
+        parser.add_argument('--threads', type=int, default=4, help='Threads per worker process (default: 4).')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to sleep when the queue is empty (default: 1).')
+        parser.add_argument('--burst', action='store_true', help='Exit once no task is due.')
+
+    def handle(self, *args, **options):
+        worker_args = (options['threads'], options['poll_interval'], options['burst'])
+        self.stdout.write(
+            f"Starting {options['processes']} worker process(es) with {options['threads']} thread(s) each"
+        )
+        if options['processes'] == 1:
+            _worker_process(*worker_args)
+            return
+
+        # Forked children must not share the parent's database connections
+        connections.close_all()
+        processes = [
+            multiprocessing.Process(target=_worker_process, args=worker_args, daemon=False)
+            for _ in range(options['processes'])
+        ]
+        for process in processes:
+            process.start()
+
+        def forward(signum, frame):
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+
+        signal.signal(signal.SIGTERM, forward)
+        signal.signal(signal.SIGINT, forward)
+        for process in processes:
+            process.join()
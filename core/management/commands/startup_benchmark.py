@@ -0,0 +1,127 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.startup import default_host
+
+# Runs in each fresh interpreter; prints one JSON line of timings
+WORKER_SCRIPT = r'''
+import io, json, sys, time
+started = time.time()
+options = json.loads(sys.argv[1])
+timings = {'started': started}
+
+def step(name, func):
+    begin = time.perf_counter()
+    result = func()
+    timings[name] = time.perf_counter() - begin
+    return result
+
+import django
+step('setup', django.setup)
+from django.core.wsgi import get_wsgi_application
+application = step('wsgi', get_wsgi_application)
+if options['preload']:
+    from core.startup import preload
+    step('preload', preload)
+timings['modules'] = len(sys.modules)
+
+def request(path):
+    environ = {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': '', 'SCRIPT_NAME': '',
+        'SERVER_NAME': options['host'], 'SERVER_PORT': '80', 'HTTP_HOST': options['host'],
+        'SERVER_PROTOCOL': 'HTTP/1.1', 'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr,
+        'wsgi.url_scheme': 'http', 'wsgi.multithread': False, 'wsgi.multiprocess': True,
+    }
+    status = []
+    body = application(environ, lambda code, headers, exc_info=None: status.append(code))
+    try:
+        for _ in body:
+            pass
+    finally:
+        getattr(body, 'close', lambda: None)()
+    return status[0]
+
+timings['requests'] = []
+for path in options['paths']:
+    begin = time.perf_counter()
+    status = request(path)
+    first = time.perf_counter() - begin
+    begin = time.perf_counter()
+    request(path)
+    timings['requests'].append([path, status, first, time.perf_counter() - begin])
+print(json.dumps(timings))
+'''
+
+
+class Command(BaseCommand):
+    help = 'Start fresh worker processes and report their import, setup and first-request latency.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Worker processes to start (default: 4).')
+        parser.add_argument('--sequential', action='store_true',
+                            help='Start workers one after another instead of all at once, as a deploy does.')
+        parser.add_argument('--preload', action='store_true', help='Run core.startup.preload() in each worker.')
+        parser.add_argument('--path', action='append', dest='paths',
+                            help='Path requested twice by each worker (repeatable; default: /).')
+        parser.add_argument('--host', default=None, help='Host header of the requests.')
+
+    def handle(self, *args, **options):
+        worker_options = json.dumps({
+            'preload': options['preload'],
+            'paths': options['paths'] or ['/'],
+            'host': options['host'] or default_host(),
+        })
+        env = {**os.environ, 'DJANGO_SETTINGS_MODULE': settings.SETTINGS_MODULE}
+        command = [sys.executable, '-c', WORKER_SCRIPT, worker_options]
+
+        results = []
+        if options['sequential']:
+            for _ in range(options['workers']):
+                results.append(self.collect(time.time(), subprocess.Popen(
+                    command, env=env, cwd=settings.BASE_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                )))
+        else:
+            spawned = time.time()
+            processes = [
+                subprocess.Popen(command, env=env, cwd=settings.BASE_DIR,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+                for _ in range(options['workers'])
+            ]
+            results = [self.collect(spawned, process) for process in processes]
+
+        self.report(results)
+
+    def collect(self, spawned, process):
+        stdout, stderr = process.communicate()
+        if process.returncode != 0:
+            raise CommandError(f'Worker failed:\n{stderr}')
+        timings = json.loads(stdout.strip().splitlines()[-1])
+        timings['interpreter'] = timings.pop('started') - spawned
+        return timings
+
+    def report(self, results):
+        ms = lambda seconds: f'{seconds * 1000:8.1f}'  # noqa: E731
+        self.stdout.write(f'{"worker":>6} {"python":>8} {"setup":>8} {"wsgi":>8} {"preload":>8} {"modules":>8}  first/second request (ms)')
+        for number, timings in enumerate(results, 1):
+            requests = '  '.join(f'{path} [{status}] {first * 1000:.1f}/{second * 1000:.1f}'
+                                 for path, status, first, second in timings['requests'])
+            preload = ms(timings['preload']) if 'preload' in timings else f'{"-":>8}'
+            self.stdout.write(
+                f'{number:>6} {ms(timings["interpreter"])} {ms(timings["setup"])} {ms(timings["wsgi"])} '
+                f'{preload} {timings["modules"]:>8}  {requests}'
+            )
+
+        ready = [timings['interpreter'] + timings['setup'] + timings['wsgi'] + timings.get('preload', 0)
+                 for timings in results]
+        first = [sum(request[2] for request in timings['requests']) for timings in results]
+        self.stdout.write(
+            f'median: ready in {statistics.median(ready) * 1000:.1f} ms, '
+            f'first requests took {statistics.median(first) * 1000:.1f} ms'
+        )
@@ -0,0 +1,46 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.catalog import catalog_last_modified
+from core.startup import default_host, hot_paths, startup_settings, warm_pages
+
+
+class Command(BaseCommand):
+    help = 'Render the hottest anonymous pages into the page cache, e.g. right after a deploy.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default=None,
+                            help='Host the pages are cached for (default: the first ALLOWED_HOSTS entry).')
+        parser.add_argument('--workers', type=int, default=4, help='Pages rendered in parallel (default: 4).')
+        parser.add_argument('--books', type=int, default=None, help='Number of book pages to warm.')
+        parser.add_argument('--authors', type=int, default=None, help='Number of author pages to warm.')
+        parser.add_argument('--genres', type=int, default=None, help='Number of genre pages to warm.')
+
+    def handle(self, *args, **options):
+        backend = settings.CACHES['default']['BACKEND']
+        if backend.endswith(('LocMemCache', 'DummyCache')):
+            self.stderr.write(self.style.WARNING(
+                f'{backend} is private to this process, so warming it here does not help the web workers. '
+                "Use a shared cache, or STARTUP['WARM_CACHES'] with gunicorn --preload."
+            ))
+
+        config = startup_settings()
+        for option, key in (('books', 'WARM_BOOKS'), ('authors', 'WARM_AUTHORS'), ('genres', 'WARM_GENRES')):
+            if options[option] is not None:
+                config[key] = options[option]
+
+        # Every cached page is checked against this stamp
+        catalog_last_modified()
+        paths = hot_paths(config)
+        host = options['host'] or default_host()
+        results = warm_pages(paths, host, options['workers'])
+
+        failed = 0
+        for path, status, state, seconds in results:
+            if status != 200:
+                failed += 1
+            if options['verbosity'] > 1 or status != 200:
+                self.stdout.write(f'{status} {state or "-":5} {seconds * 1000:7.1f} ms  {path}')
+        total = sum(seconds for _, _, _, seconds in results)
+        self.stdout.write(f'Warmed {len(results) - failed} of {len(results)} pages for {host} '
+                          f'({total:.2f}s of rendering)')
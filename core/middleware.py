@@ -0,0 +1,192 @@
+import hashlib
+import mimetypes
+import os
+import time
+from urllib.parse import parse_qsl, urlencode
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.cache import caches
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import FileResponse, HttpResponse
+from django.urls import Resolver404, resolve
+from django.utils._os import safe_join
+from django.utils.cache import patch_vary_headers
+
+from .catalog import catalog_last_modified
+
+PAGE_CACHE_DEFAULTS = {
+    # URL names whose anonymous responses may be cached
+    'VIEWS': [],
+    'CACHE_ALIAS': 'default',
+    # Seconds an entry is served without revalidation
+    'TIMEOUT': 60,
+    # Seconds past TIMEOUT an entry may still be served while one request re-renders it
+    'STALE_TIMEOUT': 600,
+    # Seconds a cold-miss request waits for another request already rendering the page
+    'MISS_WAIT': 2.0,
+    # Upper bound on how long one request may hold the re-render lock
+    'LOCK_TIMEOUT': 30,
+    # Query parameters that never change the page
+    'IGNORED_PARAMS': ['fbclid', 'gclid', 'mc_cid', 'mc_eid'],
+}
+
+
+def page_cache_settings():
+    return {**PAGE_CACHE_DEFAULTS, **getattr(settings, 'PAGE_CACHE', {})}
+
+
+class AnonymousPageCacheMiddleware:
+    """Full-page cache for anonymous GET requests.
+
+    Belongs near the top of ``MIDDLEWARE`` (before the session and messages
+    middleware) so a hit returns before any of them run. A request counts as
+    anonymous when it carries neither a session nor a messages cookie, which
+    means the cache key never has to include the session cookie.
+
+    Every entry is stamped with ``catalog_last_modified()``, so any change to
+    a Book, Author, Genre or Review marks all pages stale at once. Stale
+    entries keep being served while a single request (holding a short cache
+    lock) re-renders the page, so a hot page never stampedes the database.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.config = page_cache_settings()
+        self.views = set(self.config['VIEWS'])
+        self.cache = caches[self.config['CACHE_ALIAS']]
+
+    def __call__(self, request):
+        if not self.is_cacheable_request(request):
+            return self.get_response(request)
+
+        key = self.cache_key(request)
+        lock_key = f'{key}:lock'
+        stamp = catalog_last_modified()
+        entry = self.cache.get(key)
+
+        if entry is not None:
+            fresh = entry['stamp'] >= stamp and time.time() - entry['stored_at'] < self.config['TIMEOUT']
+            if fresh:
+                return self.build_response(entry, 'HIT')
+            if not self.cache.add(lock_key, 1, self.config['LOCK_TIMEOUT']):
+                return self.build_response(entry, 'STALE')
+        elif not self.cache.add(lock_key, 1, self.config['LOCK_TIMEOUT']):
+            # Another request is rendering this page; give it a moment
+            entry = self.wait_for_entry(key)
+            if entry is not None:
+                return self.build_response(entry, 'HIT')
+            return self.get_response(request)
+
+        try:
+            response = self.get_response(request)
+            if self.is_cacheable_response(response):
+                self.store(key, stamp, response)
+                response['X-Page-Cache'] = 'MISS'
+            return response
+        finally:
+            self.cache.delete(lock_key)
+
+    def is_cacheable_request(self, request):
+        if request.method not in ('GET', 'HEAD'):
+            return False
+        if settings.SESSION_COOKIE_NAME in request.COOKIES:
+            return False
+        if getattr(settings, 'MESSAGE_COOKIE_NAME', 'messages') in request.COOKIES:
+            return False
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return False
+        return match.url_name in self.views
+
+    def cache_key(self, request):
+        ignored = set(self.config['IGNORED_PARAMS'])
+        params = sorted(
+            (name, value) for name, value in parse_qsl(request.META.get('QUERY_STRING', ''), keep_blank_values=True)
+            if name not in ignored and not name.startswith('utm_')
+        )
+        raw = f'{request.get_host()}{request.path}?{urlencode(params)}'
+        return 'pagecache:' + hashlib.md5(raw.encode()).hexdigest()
+
+    def is_cacheable_response(self, response):
+        if response.status_code != 200 or response.streaming or response.cookies:
+            return False
+        cache_control = response.get('Cache-Control', '')
+        return 'private' not in cache_control and 'no-store' not in cache_control
+
+    def store(self, key, stamp, response):
+        entry = {
+            'stamp': stamp,
+            'stored_at': time.time(),
+            'status': response.status_code,
+            'headers': dict(response.items()),
+            'content': response.content,
+        }
+        self.cache.set(key, entry, self.config['TIMEOUT'] + self.config['STALE_TIMEOUT'])
+
+    def wait_for_entry(self, key):
+        deadline = time.monotonic() + self.config['MISS_WAIT']
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            entry = self.cache.get(key)
+            if entry is not None:
+                return entry
+        return None
+
+    def build_response(self, entry, state):
+        response = HttpResponse(entry['content'], status=entry['status'])
+        for header, value in entry['headers'].items():
+            response[header] = value
+        response['X-Page-Cache'] = state
+        return response
+
+
+class PrecompressedStaticMiddleware:
+    """Serve collected static files, preferring precompressed variants.
+
+    Only used when ``DEBUG`` is off (``runserver`` serves static files in
+    development) and a front-end server is not already answering for
+    ``STATIC_URL``. Fingerprinted names from the manifest are immutable and
+    cached for a year; anything else must be revalidated.
+    """
+
+    encodings = (('br', '.br'), ('gzip', '.gz'))
+
+    def __init__(self, get_response):
+        if settings.DEBUG or not settings.STATIC_ROOT:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.prefix = settings.STATIC_URL
+        self.root = str(settings.STATIC_ROOT)
+        hashed_files = getattr(staticfiles_storage, 'hashed_files', {}) or {}
+        self.immutable = set(hashed_files.values())
+
+    def __call__(self, request):
+        if request.method not in ('GET', 'HEAD') or not request.path.startswith(self.prefix):
+            return self.get_response(request)
+        name = request.path[len(self.prefix):]
+        try:
+            path = safe_join(self.root, name)
+        except ValueError:
+            return self.get_response(request)
+        if not os.path.isfile(path):
+            return self.get_response(request)
+
+        content_type, _ = mimetypes.guess_type(path)
+        accepted = request.headers.get('Accept-Encoding', '')
+        serve_path, encoding = path, None
+        for candidate, suffix in self.encodings:
+            if candidate in accepted and os.path.isfile(path + suffix):
+                serve_path, encoding = path + suffix, candidate
+                break
+
+        response = FileResponse(open(serve_path, 'rb'), content_type=content_type or 'application/octet-stream')
+        if encoding:
+            response['Content-Encoding'] = encoding
+        patch_vary_headers(response, ['Accept-Encoding'])
+        if name in self.immutable:
+            response['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            response['Cache-Control'] = 'public, max-age=60'
+        return response
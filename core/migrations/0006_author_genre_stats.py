@@ -0,0 +1,73 @@
+# Generated by Django 5.2.5 on 2026-10-19 09:27
+
+from django.db import migrations, models
+from django.db.models import Count, F, FloatField, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce, NullIf
+
+
+def populate_stats(apps, schema_editor):
+    Author = apps.get_model('core', 'Author')
+    Book = apps.get_model('core', 'Book')
+    Genre = apps.get_model('core', 'Genre')
+
+    for model, memberships, key, prefix in (
+        (Author, Book.objects.all(), 'author', ''),
+        (Genre, Book.genres.through.objects.all(), 'genre', 'book__'),
+    ):
+        grouped = memberships.filter(**{key: OuterRef('pk')}).order_by().values(key)
+        weighted = Sum(F(f'{prefix}average_rating') * F(f'{prefix}review_count'), output_field=FloatField())
+        model.objects.update(
+            book_count=Coalesce(Subquery(grouped.annotate(n=Count('pk')).values('n')), 0),
+            average_rating=Coalesce(
+                Subquery(grouped.annotate(avg=weighted / NullIf(Sum(f'{prefix}review_count'), 0)).values('avg')),
+                0.0,
+                output_field=FloatField(),
+            ),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_catalog_updated_at_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='author',
+            name='average_rating',
+            field=models.DecimalField(decimal_places=2, default=0.0, max_digits=3),
+        ),
+        migrations.AddField(
+            model_name='author',
+            name='book_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='genre',
+            name='average_rating',
+            field=models.DecimalField(decimal_places=2, default=0.0, max_digits=3),
+        ),
+        migrations.AddField(
+            model_name='genre',
+            name='book_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='author',
+            index=models.Index(fields=['name'], name='core_author_name_fca240_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='author',
+            index=models.Index(fields=['-book_count'], name='core_author_book_co_8aaf56_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['author', '-created_at'], name='core_book_author__b21316_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='genre',
+            index=models.Index(fields=['-book_count'], name='core_genre_book_co_ba63ed_idx'),
+        ),
+        migrations.RunPython(populate_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.5 on 2026-10-19 09:36
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_blobs'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bookmark',
+            index=models.Index(fields=['-created_at'], name='core_bookma_created_1c7cb1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='readingprogress',
+            index=models.Index(fields=['-last_read'], name='core_readin_last_re_8e44cc_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='readingprogress',
+            index=models.Index(fields=['is_completed', '-last_read'], name='core_readin_is_comp_5d0801_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['-created_at'], name='core_review_created_fff155_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['rating', '-created_at'], name='core_review_rating_2a3682_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['is_public', '-created_at'], name='core_review_is_publ_19b6bf_idx'),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.2.5 on 2026-10-19 09:50
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def populate_rating_counts(apps, schema_editor):
+    Book = apps.get_model('core', 'Book')
+    Review = apps.get_model('core', 'Review')
+
+    reviews = Review.objects.filter(book=OuterRef('pk')).order_by().values('book')
+    Book.objects.update(**{
+        f'rating_{stars}_count': Coalesce(
+            Subquery(reviews.filter(rating=stars).annotate(n=Count('pk')).values('n')), 0,
+        )
+        for stars in range(1, 6)
+    })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_reading_progress_archive'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='rating_1_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_2_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_3_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_4_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_5_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(condition=models.Q(('is_public', True)), fields=['book', '-created_at', '-id'], name='core_review_public_by_book'),
+        ),
+        migrations.RunPython(populate_rating_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 5.2.5 on 2026-10-19 10:00
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def record_existing_users(apps, schema_editor):
+    # Everyone's rows are on this (the catalog) database so far
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    UserShard = apps.get_model('core', 'UserShard')
+    using = schema_editor.connection.alias
+    user_ids = User.objects.using(using).order_by('pk').values_list('pk', flat=True)
+    UserShard.objects.using(using).bulk_create(
+        (UserShard(user_id=user_id, shard=using) for user_id in user_ids.iterator()),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('core', '0011_review_listing'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserShard',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('shard', models.CharField(db_index=True, max_length=100)),
+                ('previous_shard', models.CharField(blank=True, max_length=100)),
+                ('moved_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='archivedreadingprogress',
+            name='book',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='core.book'),
+        ),
+        migrations.AlterField(
+            model_name='archivedreadingprogress',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='archived_reading_progress', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='bookmark',
+            name='book',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='bookmarked_by', to='core.book'),
+        ),
+        migrations.AlterField(
+            model_name='bookmark',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='bookmarks', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='readingprogress',
+            name='book',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='reading_progress', to='core.book'),
+        ),
+        migrations.AlterField(
+            model_name='readingprogress',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='reading_progress', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(record_existing_users, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.5 on 2026-10-19 10:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_user_shards'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PageAccessStats',
+            fields=[
+                ('book', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='page_stats', serialize=False, to='core.book')),
+                ('steps', models.JSONField(default=dict)),
+                ('jumps', models.JSONField(default=dict)),
+                ('turns', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Page access stats',
+            },
+        ),
+    ]
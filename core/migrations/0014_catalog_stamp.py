@@ -0,0 +1,20 @@
+# Generated by Django 5.2.5 on 2026-10-19 10:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_page_access_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogStamp',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('modified_at', models.DateTimeField()),
+            ],
+        ),
+    ]
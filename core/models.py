@@ -1,25 +1,73 @@
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 from django.contrib.auth.models import User
-from django.db.models import Avg, Count
+from django.db.models import Avg, Count, F, FloatField, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce, NullIf
 from django.utils.text import slugify
 from django.urls import reverse
 
+from .storage import blob_storage, content_hash
+
+RATING_STARS = range(1, 6)
+
+
+def _refresh_catalog_stats(queryset, memberships, key, prefix=''):
+    """Recompute denormalized book counts and ratings for ``queryset``.
+
+    ``memberships`` yields one row per (owner, book) pair, ``key`` is the
+    name of its column pointing at the owner (``author`` or ``genre``) and
+    ``prefix`` is the lookup path from a membership row to its book. The
+    average is weighted by each book's review count and everything runs as a
+    single UPDATE, so it is safe to call for one row or for the whole table.
+    """
+    grouped = memberships.filter(**{key: OuterRef('pk')}).order_by().values(key)
+    weighted = Sum(F(f'{prefix}average_rating') * F(f'{prefix}review_count'), output_field=FloatField())
+    return queryset.update(
+        book_count=Coalesce(Subquery(grouped.annotate(n=Count('pk')).values('n')), 0),
+        average_rating=Coalesce(
+            Subquery(grouped.annotate(
+                avg=weighted / NullIf(Sum(f'{prefix}review_count'), 0)
+            ).values('avg')),
+            0.0,
+            output_field=FloatField(),
+        ),
+    )
+
 
 class Genre(models.Model):
     """Model representing a book genre."""
     name = models.CharField(max_length=100, unique=True)
     slug = models.SlugField(max_length=100, unique=True, blank=True)
     description = models.TextField(blank=True)
+    book_count = models.PositiveIntegerField(default=0)
+    average_rating = models.DecimalField(max_digits=3, decimal_places=2, default=0.00)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     
     class Meta:
         ordering = ['name']
+        indexes = [
+            models.Index(fields=['-book_count']),
+        ]
     
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = slugify(self.name)
         super().save(*args, **kwargs)
     
+    @classmethod
+    def refresh_stats(cls, queryset=None):
+        """Recompute book counts and average ratings for the given genres."""
+        queryset = cls.objects.all() if queryset is None else queryset
+        return _refresh_catalog_stats(queryset, Book.genres.through.objects.all(), 'genre', 'book__')
+    
+    def update_stats(self):
+        """Update the book count and average rating."""
+        Genre.refresh_stats(Genre.objects.filter(pk=self.pk))
+    
+    def get_absolute_url(self):
+        return reverse('genre_detail', kwargs={'slug': self.slug})
+    
     def __str__(self):
         return self.name
 
@@ -31,11 +79,27 @@ class Author(models.Model):
     birth_date = models.DateField(null=True, blank=True)
     death_date = models.DateField(null=True, blank=True)
     photo = models.ImageField(upload_to='authors/', null=True, blank=True)
+    book_count = models.PositiveIntegerField(default=0)
+    average_rating = models.DecimalField(max_digits=3, decimal_places=2, default=0.00)
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateTimeField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     
     class Meta:
         ordering = ['name']
+        indexes = [
+            models.Index(fields=['name']),
+            models.Index(fields=['-book_count']),
+        ]
+    
+    @classmethod
+    def refresh_stats(cls, queryset=None):
+        """Recompute book counts and average ratings for the given authors."""
+        queryset = cls.objects.all() if queryset is None else queryset
+        return _refresh_catalog_stats(queryset, Book.objects.all(), 'author')
+    
+    def update_stats(self):
+        """Update the book count and average rating."""
+        Author.refresh_stats(Author.objects.filter(pk=self.pk))
     
     def __str__(self):
         return self.name
@@ -75,33 +139,112 @@ class Book(models.Model):
     publisher = models.CharField(max_length=200, blank=True)
     publication_date = models.DateField(null=True, blank=True)
     page_count = models.PositiveIntegerField(null=True, blank=True)
-    cover_image = models.ImageField(upload_to='book_covers/', null=True, blank=True)
-    file = models.FileField(upload_to='books/')
+    cover_image = models.ImageField(upload_to='book_covers/', storage=blob_storage, null=True, blank=True)
+    file = models.FileField(upload_to='books/', storage=blob_storage)
     average_rating = models.DecimalField(max_digits=3, decimal_places=2, default=0.00)
     review_count = models.PositiveIntegerField(default=0)
+    # Reviews per star, kept with average_rating so the histogram is never aggregated on read
+    rating_1_count = models.PositiveIntegerField(default=0)
+    rating_2_count = models.PositiveIntegerField(default=0)
+    rating_3_count = models.PositiveIntegerField(default=0)
+    rating_4_count = models.PositiveIntegerField(default=0)
+    rating_5_count = models.PositiveIntegerField(default=0)
     is_featured = models.BooleanField(default=False)
     is_popular = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateTimeField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     
     class Meta:
         ordering = ['-created_at']
         indexes = [
             models.Index(fields=['-created_at']),
             models.Index(fields=['average_rating']),
+            models.Index(fields=['author', '-created_at']),
         ]
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the author as loaded so a reassignment can refresh both sides
+        instance._loaded_author_id = instance.__dict__.get('author_id')
+        # ...and the stored files, so blob reference counts can follow changes
+        instance._loaded_blobs = instance.blob_names()
+        return instance
+    
+    def blob_names(self):
+        """Names of the content-addressed blobs this book references."""
+        names = [self.__dict__.get('file'), self.__dict__.get('cover_image')]
+        return [str(name) for name in names if name and content_hash(str(name))]
+    
+    @property
+    def file_hash(self):
+        """SHA-256 of the book file, or ``None`` for files stored before hashing."""
+        return content_hash(self.file.name)
+    
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = slugify(self.title)
         super().save(*args, **kwargs)
     
+    @classmethod
+    def refresh_ratings(cls, queryset=None):
+        """Recompute average ratings and review counts for the given books.
+
+        Runs as one UPDATE for the books plus one each for their authors and
+        genres, so it scales to any number of rows. Signals do not fire for
+        queryset updates, so the catalog stamp is bumped here.
+        """
+        from .catalog import touch_catalog
+        
+        queryset = cls.objects.all() if queryset is None else queryset
+        books = queryset.order_by().values('pk')
+        reviews = Review.objects.filter(book=OuterRef('pk')).order_by().values('book')
+        updated = cls.objects.filter(pk__in=books).update(
+            average_rating=Coalesce(
+                Subquery(reviews.annotate(avg=Avg('rating')).values('avg')), 0.0, output_field=FloatField(),
+            ),
+            review_count=Coalesce(Subquery(reviews.annotate(n=Count('pk')).values('n')), 0),
+            **{
+                f'rating_{stars}_count': Coalesce(
+                    Subquery(reviews.filter(rating=stars).annotate(n=Count('pk')).values('n')), 0,
+                )
+                for stars in RATING_STARS
+            },
+            updated_at=timezone.now(),
+        )
+        Author.refresh_stats(Author.objects.filter(pk__in=cls.objects.filter(pk__in=books).values('author_id')))
+        Genre.refresh_stats(Genre.objects.filter(
+            pk__in=cls.genres.through.objects.filter(book__in=books).values('genre_id'),
+        ))
+        touch_catalog()
+        return updated
+    
     def update_rating(self):
-        """Update the average rating and review count."""
-        result = self.reviews.aggregate(average=Avg('rating'), count=Count('id'))
-        self.average_rating = result['average'] or 0
-        self.review_count = result['count'] or 0
-        self.save(update_fields=['average_rating', 'review_count'])
+        """Update the average rating, review count and per-star counts."""
+        result = self.reviews.aggregate(
+            average=Avg('rating'),
+            count=Count('id'),
+            **{f'rating_{stars}_count': Count('id', filter=Q(rating=stars)) for stars in RATING_STARS},
+        )
+        self.average_rating = result.pop('average') or 0
+        self.review_count = result.pop('count') or 0
+        for field, count in result.items():
+            setattr(self, field, count)
+        # updated_at too, so other processes' facet indexes notice the new rating
+        self.save(update_fields=['average_rating', 'review_count', *result, 'updated_at'])
+    
+    @property
+    def rating_histogram(self):
+        """``[{'stars', 'count', 'percent'}]`` from five stars down to one."""
+        total = self.review_count or 0
+        return [
+            {
+                'stars': stars,
+                'count': getattr(self, f'rating_{stars}_count'),
+                'percent': round(getattr(self, f'rating_{stars}_count') * 100 / total) if total else 0,
+            }
+            for stars in reversed(RATING_STARS)
+        ]
     
     def get_absolute_url(self):
         return reverse('book_detail', kwargs={'slug': self.slug})
@@ -146,27 +289,38 @@ class UserProfile(models.Model):
             return self.avatar.url
         return '/static/images/default-avatar.png'
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored avatar so save() can tell when it is replaced
+        instance._loaded_avatar = instance.__dict__.get('avatar')
+        return instance
+    
     def save(self, *args, **kwargs):
-        # Delete old avatar when updating to a new one
-        try:
-            old_avatar = UserProfile.objects.get(pk=self.pk).avatar
-            if old_avatar and old_avatar != self.avatar:
-                old_avatar.delete(save=False)
-        except UserProfile.DoesNotExist:
-            pass
-            
+        from .tasks import delete_stored_file
+        
         super().save(*args, **kwargs)
+        # Delete old avatar when updating to a new one, off the request thread
+        old_avatar = getattr(self, '_loaded_avatar', None)
+        if old_avatar and old_avatar != self.avatar.name:
+            delete_stored_file.delay(old_avatar)
+        self._loaded_avatar = self.avatar.name
 
 
 class Bookmark(models.Model):
     """Model for users to bookmark books."""
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='bookmarks')
-    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='bookmarked_by')
+    # Sharded by user (see core.sharding): no database-level foreign keys, and
+    # deletes of users and books are cascaded to every shard by core.signals
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name='bookmarks')
+    book = models.ForeignKey(Book, on_delete=models.DO_NOTHING, db_constraint=False, related_name='bookmarked_by')
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
         unique_together = ('user', 'book')
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-created_at']),
+        ]
     
     def __str__(self):
         return f"{self.user.username} bookmarked {self.book.title}"
@@ -194,15 +348,30 @@ class Review(models.Model):
     class Meta:
         ordering = ['-created_at']
         unique_together = ('user', 'book')
+        indexes = [
+            models.Index(fields=['-created_at']),
+            models.Index(fields=['rating', '-created_at']),
+            models.Index(fields=['is_public', '-created_at']),
+            # A book's public reviews, newest first; id breaks ties for keyset pagination.
+            # Partial because the ORM filters booleans as a bare "is_public",
+            # which a plain is_public index column cannot match.
+            models.Index(
+                fields=['book', '-created_at', '-id'], condition=Q(is_public=True), name='core_review_public_by_book',
+            ),
+        ]
     
     def save(self, *args, **kwargs):
+        from .tasks import update_book_rating
+        
         super().save(*args, **kwargs)
-        self.book.update_rating()
+        update_book_rating.delay(self.book_id)
     
     def delete(self, *args, **kwargs):
-        book = self.book
+        from .tasks import update_book_rating
+        
+        book_id = self.book_id
         super().delete(*args, **kwargs)
-        book.update_rating()
+        update_book_rating.delay(book_id)
     
     def __str__(self):
         return f"{self.rating} star review for {self.book.title} by {self.user.username}"
@@ -210,8 +379,9 @@ class Review(models.Model):
 
 class ReadingProgress(models.Model):
     """Model to track user's reading progress for each book."""
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='reading_progress')
-    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='reading_progress')
+    # Sharded by user, like Bookmark
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name='reading_progress')
+    book = models.ForeignKey(Book, on_delete=models.DO_NOTHING, db_constraint=False, related_name='reading_progress')
     current_page = models.PositiveIntegerField(default=0)
     is_completed = models.BooleanField(default=False)
     last_read = models.DateTimeField(auto_now=True)
@@ -220,6 +390,42 @@ class ReadingProgress(models.Model):
     class Meta:
         verbose_name_plural = 'Reading progress'
         unique_together = ('user', 'book')
+        indexes = [
+            models.Index(fields=['-last_read']),
+            models.Index(fields=['is_completed', '-last_read']),
+            # A user's library and dashboard, most recent first
+            models.Index(fields=['user', '-last_read']),
+            models.Index(fields=['user', 'is_completed', '-last_read']),
+        ]
+    
+    @classmethod
+    def restore(cls, user, book_id):
+        """Move ``user``'s archived progress on a book back into this table.
+
+        Returns the restored row, or ``None`` if nothing was archived.
+        """
+        from .sharding import user_database
+        
+        using = user_database(user)
+        with transaction.atomic(using=using):
+            archived = (ArchivedReadingProgress.objects.using(using).select_for_update()
+                        .filter(user=user, book_id=book_id).first())
+            if archived is None:
+                return None
+            progress, _ = cls.objects.using(using).get_or_create(
+                user=user,
+                book_id=book_id,
+                defaults={'current_page': archived.current_page, 'is_completed': archived.is_completed},
+            )
+            archived.delete()
+        return progress
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the page as loaded, so a save can report the page turn (see core.prefetch)
+        instance._loaded_page = instance.__dict__.get('current_page')
+        return instance
     
     def progress_percentage(self):
         if self.book.page_count and self.current_page > 0:
@@ -228,3 +434,145 @@ class ReadingProgress(models.Model):
     
     def __str__(self):
         return f"{self.user.username}'s progress on {self.book.title}"
+
+
+class ArchivedReadingProgress(models.Model):
+    """Cold reading progress moved out of ``ReadingProgress``.
+
+    Rows land here through ``manage.py archive_reading_progress`` and go back
+    with ``ReadingProgress.restore()`` when the user opens the book again.
+    """
+    # Sharded by user, like Bookmark
+    user = models.ForeignKey(
+        User, on_delete=models.DO_NOTHING, db_constraint=False, related_name='archived_reading_progress',
+    )
+    book = models.ForeignKey(Book, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    current_page = models.PositiveIntegerField(default=0)
+    is_completed = models.BooleanField(default=False)
+    last_read = models.DateTimeField()
+    created_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        verbose_name_plural = 'Archived reading progress'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'book'], name='unique_archived_progress'),
+        ]
+    
+    def __str__(self):
+        return f"Archived progress of user {self.user_id} on book {self.book_id}"
+
+
+class PageAccessStats(models.Model):
+    """How readers move through a book, counted from their page turns; see ``core.prefetch``."""
+    book = models.OneToOneField(Book, on_delete=models.CASCADE, primary_key=True, related_name='page_stats')
+    # Turns by distance ("1", "-1", ...) for short moves, by landing page for jumps
+    steps = models.JSONField(default=dict)
+    jumps = models.JSONField(default=dict)
+    turns = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        verbose_name_plural = 'Page access stats'
+    
+    def __str__(self):
+        return f"Page access stats of book {self.book_id}"
+
+
+class CatalogStamp(models.Model):
+    """The time of the last change to the catalog, shared by all processes; see ``core.catalog``."""
+    modified_at = models.DateTimeField()
+    
+    def __str__(self):
+        return f"Catalog modified at {self.modified_at}"
+
+
+class UserShard(models.Model):
+    """The database holding a user's per-user rows; see ``core.sharding``."""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='+')
+    shard = models.CharField(max_length=100, db_index=True)
+    # Set while ``manage.py rebalance_shards`` is moving the user off this database
+    previous_shard = models.CharField(max_length=100, blank=True)
+    moved_at = models.DateTimeField(null=True, blank=True)
+    
+    def __str__(self):
+        return f"User {self.user_id} on {self.shard}"
+
+
+class Task(models.Model):
+    """A unit of background work queued through ``core.taskqueue``."""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('failed', 'Failed'),
+    ]
+    
+    name = models.CharField(max_length=200)
+    args = models.JSONField(default=list, blank=True)
+    kwargs = models.JSONField(default=dict, blank=True)
+    dedup_key = models.CharField(max_length=64)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['run_at']
+        indexes = [
+            models.Index(fields=['status', 'run_at']),
+        ]
+        constraints = [
+            # Identical work is only queued once while it is waiting to run
+            models.UniqueConstraint(
+                fields=['dedup_key'],
+                condition=models.Q(status='pending'),
+                name='unique_pending_task',
+            ),
+        ]
+    
+    def __str__(self):
+        return f"{self.name} ({self.status})"
+
+
+class Blob(models.Model):
+    """A content-addressed file and the number of books referencing it."""
+    name = models.CharField(max_length=255, unique=True)
+    sha256 = models.CharField(max_length=64, db_index=True)
+    size = models.PositiveBigIntegerField(default=0)
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['ref_count', 'updated_at']),
+        ]
+    
+    @classmethod
+    def adjust(cls, names, delta):
+        """Add ``delta`` references to each blob in ``names``."""
+        for name in names:
+            blob, created = cls.objects.get_or_create(
+                name=name,
+                defaults={'sha256': content_hash(name), 'size': _stored_size(name)},
+            )
+            cls.objects.filter(pk=blob.pk).update(
+                ref_count=models.Case(
+                    models.When(ref_count__lt=-delta, then=0),
+                    default=F('ref_count') + delta,
+                ),
+                updated_at=timezone.now(),
+            )
+    
+    def __str__(self):
+        return f"{self.name} ({self.ref_count} refs)"
+
+
+def _stored_size(name):
+    storage = blob_storage()
+    return storage.size(name) if storage.exists(name) else 0
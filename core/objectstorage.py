@@ -0,0 +1,292 @@
+"""
+S3-compatible object storage.
+
+``S3Storage`` talks to Amazon S3, MinIO, Cloudflare R2, Backblaze B2 and
+other S3-compatible stores using only the standard library: requests are
+signed with AWS Signature Version 4. ``signed_url()`` returns a short-lived
+pre-signed GET URL, so clients download straight from the store while
+Django still decides who gets a URL. ``url()``, which templates use for
+covers and photos, is pre-signed for the longer ``url_expires`` (those URLs
+end up in cached pages), or is a plain URL on ``custom_domain`` (a CDN) when
+``querystring_auth`` is off.
+
+Signing times are rounded down to ``url_window`` seconds, so the URL of an
+object stays the same for that long and browsers can reuse cached bytes.
+HEAD results are cached for ``metadata_cache_timeout`` seconds, so asking
+for a size or modification time rarely costs a round trip.
+
+Direct downloads from a browser need a CORS rule on the bucket that allows
+GET and HEAD from the site's origin and exposes ``Content-Range``,
+``Content-Length`` and ``Accept-Ranges`` (PDF.js reads books in ranges).
+"""
+import hashlib
+import hmac
+import posixpath
+import tempfile
+import time
+import xml.etree.ElementTree as ElementTree
+from datetime import datetime, timezone as dt_timezone
+from email.utils import parsedate_to_datetime
+from urllib.error import HTTPError
+from urllib.parse import quote, urlsplit
+from urllib.request import Request, urlopen
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files import File
+from django.core.files.storage import Storage
+from django.utils.deconstruct import deconstructible
+
+from .storage import HASH_CHUNK_SIZE, ContentAddressedMixin, content_hash
+
+S3_NAMESPACE = '{http://s3.amazonaws.com/doc/2006-03-01/}'
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+# Files up to this size are read into memory by open(); larger ones spool to disk
+SPOOL_SIZE = 10 * 1024 * 1024
+
+
+class S3Error(OSError):
+    """The object store answered with an error status."""
+
+    def __init__(self, status, message):
+        super().__init__(f'{status}: {message}')
+        self.status = status
+
+
+def _hmac(key, message):
+    return hmac.new(key, message.encode(), hashlib.sha256).digest()
+
+
+def _quote(value, safe='-_.~'):
+    return quote(str(value), safe=safe)
+
+
+def _query_string(query):
+    """Canonical (sorted, strictly encoded) query string, as SigV4 signs it."""
+    return '&'.join(f'{_quote(k)}={_quote(v)}' for k, v in sorted(query.items()))
+
+
+@deconstructible
+class S3Storage(Storage):
+    """Django storage backed by an S3-compatible bucket.
+
+    Options (``STORAGES[alias]['OPTIONS']``): ``bucket``, ``access_key``,
+    ``secret_key``, ``region``, ``endpoint_url`` (for stores other than AWS),
+    ``addressing_style`` (``path`` or ``virtual``), ``location`` (a key
+    prefix), ``querystring_auth``, ``custom_domain``, ``url_expires``,
+    ``signed_url_expires``, ``url_window`` and ``metadata_cache_timeout``.
+    """
+
+    def __init__(self, bucket=None, access_key=None, secret_key=None, region='us-east-1', endpoint_url=None,
+                 addressing_style=None, location='', querystring_auth=True, custom_domain=None, url_expires=3600,
+                 signed_url_expires=300, url_window=60, metadata_cache_timeout=300, timeout=30):
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.location = location.strip('/')
+        self.querystring_auth = querystring_auth
+        self.custom_domain = custom_domain
+        self.url_expires = url_expires
+        self.signed_url_expires = signed_url_expires
+        self.url_window = url_window
+        self.metadata_cache_timeout = metadata_cache_timeout
+        self.timeout = timeout
+        if endpoint_url:
+            self.endpoint_url = endpoint_url.rstrip('/')
+            self.addressing_style = addressing_style or 'path'
+        else:
+            self.endpoint_url = f'https://s3.{region}.amazonaws.com'
+            self.addressing_style = addressing_style or 'virtual'
+
+    # Addressing and signing
+
+    def key(self, name):
+        name = name.replace('\\', '/').lstrip('/')
+        return posixpath.join(self.location, name) if self.location else name
+
+    def _endpoint(self, key=''):
+        """``(host, path)`` of ``key`` in the bucket."""
+        parts = urlsplit(self.endpoint_url)
+        path = parts.path.rstrip('/')
+        if self.addressing_style == 'virtual':
+            return f'{self.bucket}.{parts.netloc}', f'{path}/{_quote(key, safe="/-_.~")}'
+        return parts.netloc, f'{path}/{_quote(self.bucket)}/{_quote(key, safe="/-_.~")}'
+
+    def _signing_key(self, datestamp):
+        key = _hmac(f'AWS4{self.secret_key}'.encode(), datestamp)
+        for part in (self.region, 's3', 'aws4_request'):
+            key = _hmac(key, part)
+        return key
+
+    def _signature(self, method, path, query, headers, payload_hash, amz_date):
+        canonical_query = _query_string(query)
+        signed_headers = ';'.join(sorted(headers))
+        canonical_headers = ''.join(f'{name}:{str(headers[name]).strip()}\n' for name in sorted(headers))
+        canonical_request = '\n'.join(
+            [method, path, canonical_query, canonical_headers, signed_headers, payload_hash]
+        )
+        scope = f'{amz_date[:8]}/{self.region}/s3/aws4_request'
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical_request.encode()).hexdigest(),
+        ])
+        signature = hmac.new(self._signing_key(amz_date[:8]), string_to_sign.encode(), hashlib.sha256).hexdigest()
+        return signature, scope, signed_headers
+
+    def _request(self, method, key='', query=None, headers=None, body=None):
+        query = {k: v for k, v in (query or {}).items() if v is not None}
+        host, path = self._endpoint(key)
+        amz_date = datetime.now(dt_timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        signed = {'host': host, 'x-amz-content-sha256': UNSIGNED_PAYLOAD, 'x-amz-date': amz_date}
+        signed.update({name.lower(): value for name, value in (headers or {}).items()})
+        signature, scope, signed_headers = self._signature(method, path, query, signed, UNSIGNED_PAYLOAD, amz_date)
+        signed['authorization'] = (
+            f'AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, '
+            f'SignedHeaders={signed_headers}, Signature={signature}'
+        )
+        scheme = urlsplit(self.endpoint_url).scheme
+        url = f'{scheme}://{host}{path}' + (f'?{_query_string(query)}' if query else '')
+        request = Request(url, data=body, method=method, headers={k: v for k, v in signed.items() if k != 'host'})
+        try:
+            return urlopen(request, timeout=self.timeout)
+        except HTTPError as exc:
+            raise S3Error(exc.code, exc.read()[:500].decode('utf-8', 'replace')) from None
+
+    def signed_url(self, name, expires=None, filename=None, content_type=None):
+        """Pre-signed GET URL of ``name``, valid for at least ``expires`` seconds."""
+        expires = expires or self.signed_url_expires
+        host, path = self._endpoint(self.key(name))
+        now = int(time.time())
+        signed_at = now - now % self.url_window if self.url_window else now
+        amz_date = datetime.fromtimestamp(signed_at, dt_timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        query = {
+            'X-Amz-Algorithm': 'AWS4-HMAC-SHA256',
+            'X-Amz-Credential': f'{self.access_key}/{amz_date[:8]}/{self.region}/s3/aws4_request',
+            'X-Amz-Date': amz_date,
+            # Counted from the rounded signing time, so allow for the window
+            'X-Amz-Expires': str(expires + (self.url_window or 0)),
+            'X-Amz-SignedHeaders': 'host',
+        }
+        if filename:
+            query['response-content-disposition'] = f'inline; filename="{filename}"'
+        if content_type:
+            query['response-content-type'] = content_type
+        signature, _, _ = self._signature('GET', path, query, {'host': host}, UNSIGNED_PAYLOAD, amz_date)
+        query['X-Amz-Signature'] = signature
+        scheme = urlsplit(self.endpoint_url).scheme
+        return f'{scheme}://{host}{path}?{_query_string(query)}'
+
+    # Metadata
+
+    def _metadata_key(self, name):
+        return 's3meta:' + hashlib.md5(f'{self.bucket}/{self.key(name)}'.encode()).hexdigest()
+
+    def _head(self, name):
+        """``{'size', 'modified'}`` of ``name``, or ``None`` if it does not exist."""
+        cache_key = self._metadata_key(name)
+        metadata = cache.get(cache_key)
+        if metadata is not None:
+            return metadata or None
+        try:
+            with self._request('HEAD', self.key(name)) as response:
+                metadata = {
+                    'size': int(response.headers.get('Content-Length', 0)),
+                    'modified': parsedate_to_datetime(response.headers['Last-Modified']).timestamp(),
+                }
+        except S3Error as exc:
+            if exc.status != 404:
+                raise
+            metadata = {}
+        # Content-addressed objects never change, so their metadata can live longer
+        timeout = None if metadata and content_hash(name) else self.metadata_cache_timeout
+        cache.set(cache_key, metadata, timeout)
+        return metadata or None
+
+    def _forget(self, name):
+        cache.delete(self._metadata_key(name))
+
+    # Storage API
+
+    def _open(self, name, mode='rb'):
+        if 'w' in mode or 'a' in mode:
+            raise ValueError('S3Storage files are read-only; save() a new file instead')
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        try:
+            with self._request('GET', self.key(name)) as response:
+                while chunk := response.read(HASH_CHUNK_SIZE):
+                    spool.write(chunk)
+        except S3Error as exc:
+            spool.close()
+            if exc.status == 404:
+                raise FileNotFoundError(name) from None
+            raise
+        spool.seek(0)
+        return File(spool, name=name)
+
+    def _save(self, name, content):
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        headers = {'Content-Length': str(content.size)}
+        content_type = getattr(content, 'content_type', None)
+        if content_type:
+            headers['Content-Type'] = content_type
+        body = content.file if hasattr(content, 'file') else content
+        # urllib streams file objects in blocks when Content-Length is given
+        with self._request('PUT', self.key(name), headers=headers, body=body):
+            pass
+        self._forget(name)
+        return name
+
+    def delete(self, name):
+        try:
+            with self._request('DELETE', self.key(name)):
+                pass
+        except S3Error as exc:
+            if exc.status != 404:
+                raise
+        self._forget(name)
+
+    def exists(self, name):
+        return self._head(name) is not None
+
+    def size(self, name):
+        metadata = self._head(name)
+        if metadata is None:
+            raise FileNotFoundError(name)
+        return metadata['size']
+
+    def get_modified_time(self, name):
+        metadata = self._head(name)
+        if metadata is None:
+            raise FileNotFoundError(name)
+        modified = datetime.fromtimestamp(metadata['modified'], dt_timezone.utc)
+        return modified if settings.USE_TZ else modified.replace(tzinfo=None)
+
+    def listdir(self, path):
+        prefix = self.key(path).rstrip('/')
+        prefix = f'{prefix}/' if prefix else ''
+        directories, files = [], []
+        token = None
+        while True:
+            query = {'list-type': '2', 'prefix': prefix, 'delimiter': '/', 'continuation-token': token}
+            with self._request('GET', query=query) as response:
+                root = ElementTree.fromstring(response.read())
+            for entry in root.iter(f'{S3_NAMESPACE}CommonPrefixes'):
+                directories.append(entry.findtext(f'{S3_NAMESPACE}Prefix')[len(prefix):].rstrip('/'))
+            for entry in root.iter(f'{S3_NAMESPACE}Contents'):
+                files.append(entry.findtext(f'{S3_NAMESPACE}Key')[len(prefix):])
+            token = root.findtext(f'{S3_NAMESPACE}NextContinuationToken')
+            if not token:
+                return directories, files
+
+    def url(self, name):
+        if self.querystring_auth:
+            return self.signed_url(name, expires=self.url_expires)
+        if self.custom_domain:
+            return f'https://{self.custom_domain}/{_quote(self.key(name), safe="/-_.~")}'
+        host, path = self._endpoint(self.key(name))
+        return f'{urlsplit(self.endpoint_url).scheme}://{host}{path}'
+
+
+class S3ContentAddressedStorage(ContentAddressedMixin, S3Storage):
+    """Content-addressed blobs (see ``core.storage``) in an S3-compatible bucket."""
@@ -0,0 +1,186 @@
+"""
+Adaptive page prefetching for the PDF reader.
+
+Every saved page turn (a ``ReadingProgress`` save that moves
+``current_page``) is a sample of how a book is read. Moves of up to
+``MAX_STEP`` pages either way are counted by distance. Longer ones are
+jumps and are counted by the page landed on: the table of contents,
+chapter starts and the index, which readers reach from anywhere.
+
+Turns are counted in memory and merged into ``PageAccessStats`` by a
+background task every ``FLUSH_INTERVAL`` seconds or ``FLUSH_SIZE`` turns, so
+a page turn costs no extra write. Counts still held by a process when it
+exits are lost, which statistics can afford.
+
+``page_pattern()`` boils a book's counts down to how far ahead to warm
+(the distance covering ``READ_AHEAD_COVERAGE`` of forward moves), whether
+readers page back often enough to keep the previous page, and the jump
+targets worth holding. Books with fewer than ``MIN_TURNS`` samples get
+``DEFAULT_PATTERN``. ``page_hints()`` turns a pattern into the pages to warm
+from a given page. The reader pre-renders those into an LRU of
+``CACHE_SIZE`` canvases, so most page turns find their page already drawn.
+"""
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+PREFETCH_DEFAULTS = {
+    # Moves of up to this many pages are reading on (or back); longer ones are jumps
+    'MAX_STEP': 5,
+    'MAX_AHEAD': 3,
+    'READ_AHEAD_COVERAGE': 0.9,
+    # Share of short moves that go backwards above which the previous page is kept warm
+    'BACK_SHARE': 0.15,
+    # Jump targets suggested, and the share of all jumps a page needs to be one
+    'JUMP_TARGETS': 3,
+    'MIN_JUMP_SHARE': 0.1,
+    'MIN_TURNS': 20,
+    # Landing pages remembered per book; the rarest are dropped beyond this
+    'TRACKED_JUMPS': 50,
+    'FLUSH_INTERVAL': 30,
+    'FLUSH_SIZE': 500,
+    'PATTERN_CACHE_TIMEOUT': 300,
+    # Pre-rendered pages the reader keeps, the one on screen included
+    'CACHE_SIZE': 6,
+}
+
+# Until a book has been read enough: the next two pages and the previous one
+DEFAULT_PATTERN = {'ahead': 2, 'behind': True, 'jumps': [], 'turns': 0}
+
+_buffer = {}
+_buffered = 0
+_flushed_at = time.monotonic()
+_buffer_lock = threading.Lock()
+
+
+def prefetch_settings():
+    return {**PREFETCH_DEFAULTS, **getattr(settings, 'PREFETCH', {})}
+
+
+def record_turn(book_id, previous, page):
+    """Count a reader's move from page ``previous`` to ``page`` of a book."""
+    global _buffered
+    distance = page - previous
+    if not distance:
+        return
+    config = prefetch_settings()
+    with _buffer_lock:
+        # String keys, as they come back from JSON
+        sample = _buffer.setdefault(str(book_id), {'steps': Counter(), 'jumps': Counter()})
+        if abs(distance) <= config['MAX_STEP']:
+            sample['steps'][str(distance)] += 1
+        else:
+            sample['jumps'][str(page)] += 1
+        _buffered += 1
+        due = _buffered >= config['FLUSH_SIZE'] or time.monotonic() - _flushed_at >= config['FLUSH_INTERVAL']
+    if due:
+        flush()
+
+
+def flush():
+    """Queue the buffered turns for merging into ``PageAccessStats``."""
+    global _buffer, _buffered, _flushed_at
+    from .tasks import merge_page_stats
+
+    with _buffer_lock:
+        samples, _buffer = _buffer, {}
+        _buffered, _flushed_at = 0, time.monotonic()
+    if samples:
+        # A batch id keeps two identical batches from being deduplicated as one task
+        merge_page_stats.delay(
+            {book_id: {kind: dict(counts) for kind, counts in sample.items()} for book_id, sample in samples.items()},
+            batch=uuid.uuid4().hex,
+        )
+
+
+def merge(samples):
+    """Add ``{book_id: {'steps': {...}, 'jumps': {...}}}`` counts to the stored stats."""
+    from .models import Book, PageAccessStats
+
+    config = prefetch_settings()
+    # Books deleted since the turns were counted are skipped
+    books = Book.objects.filter(pk__in=[int(book_id) for book_id in samples]).values_list('pk', flat=True)
+    for book_id in books:
+        sample = samples[str(book_id)]
+        with transaction.atomic():
+            stats, _ = PageAccessStats.objects.select_for_update().get_or_create(book_id=book_id)
+            steps, jumps = Counter(stats.steps), Counter(stats.jumps)
+            steps.update(sample.get('steps', {}))
+            jumps.update(sample.get('jumps', {}))
+            stats.steps = dict(steps)
+            stats.jumps = dict(jumps.most_common(config['TRACKED_JUMPS']))
+            stats.turns += sum(sample.get('steps', {}).values()) + sum(sample.get('jumps', {}).values())
+            stats.save()
+        cache.delete(_pattern_key(book_id))
+
+
+def derive_pattern(steps, jumps, turns, config=None):
+    """``{'ahead', 'behind', 'jumps', 'turns'}`` from a book's counts."""
+    config = config or prefetch_settings()
+    if turns < config['MIN_TURNS']:
+        return DEFAULT_PATTERN
+    forward = sorted((int(distance), count) for distance, count in steps.items() if int(distance) > 0)
+    backward = sum(count for distance, count in steps.items() if int(distance) < 0)
+    total_forward = sum(count for _, count in forward)
+    ahead, covered = 1, 0
+    for distance, count in forward:
+        ahead = distance
+        covered += count
+        if covered >= total_forward * config['READ_AHEAD_COVERAGE']:
+            break
+    total_jumps = sum(jumps.values())
+    targets = [
+        int(page) for page, count in Counter(jumps).most_common(config['JUMP_TARGETS'])
+        if count >= max(total_jumps * config['MIN_JUMP_SHARE'], 2)
+    ]
+    return {
+        'ahead': min(ahead, config['MAX_AHEAD']),
+        'behind': backward >= (total_forward + backward) * config['BACK_SHARE'] if total_forward + backward else True,
+        'jumps': targets,
+        'turns': turns,
+    }
+
+
+def _pattern_key(book_id):
+    return f'pagepattern:{book_id}'
+
+
+def page_pattern(book_id):
+    """A book's reading pattern, cached for ``PATTERN_CACHE_TIMEOUT`` seconds."""
+    from .models import PageAccessStats
+
+    key = _pattern_key(book_id)
+    pattern = cache.get(key)
+    if pattern is None:
+        config = prefetch_settings()
+        stats = PageAccessStats.objects.filter(book_id=book_id).values('steps', 'jumps', 'turns').first()
+        pattern = derive_pattern(**stats, config=config) if stats else DEFAULT_PATTERN
+        cache.set(key, pattern, config['PATTERN_CACHE_TIMEOUT'])
+    return pattern
+
+
+def page_hints(pattern, page, page_count=None, limit=None):
+    """Pages to warm for a reader on ``page``, most likely next first.
+
+    Each hint is ``{'page', 'reason'}``, the reason being ``ahead``,
+    ``behind`` or ``jump``. ``read.html`` applies the same rules to the
+    pattern in its bootstrap.
+    """
+    if limit is None:
+        limit = prefetch_settings()['CACHE_SIZE'] - 1
+    candidates = [(page + distance, 'ahead') for distance in range(1, pattern['ahead'] + 1)]
+    if pattern['behind']:
+        candidates.append((page - 1, 'behind'))
+    candidates += [(target, 'jump') for target in pattern['jumps']]
+    seen, hints = {page}, []
+    for number, reason in candidates:
+        if number < 1 or (page_count and number > page_count) or number in seen:
+            continue
+        seen.add(number)
+        hints.append({'page': number, 'reason': reason})
+    return hints[:limit]
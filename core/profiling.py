@@ -0,0 +1,340 @@
+"""
+On-demand request profiling and memory snapshots.
+
+``ProfilingMiddleware`` profiles a request when a staff user sends the
+``X-Profile`` header, or at random for ``SAMPLE_RATE`` of all requests. The
+header value picks what is recorded:
+
+``sample``
+    A statistical sampler that reads the request thread's stack every
+    ``SAMPLE_INTERVAL`` seconds and writes collapsed stacks (``.collapsed``),
+    the input format of ``flamegraph.pl`` and speedscope.
+``cprofile``
+    A deterministic ``cProfile`` run, saved as a ``pstats`` file (``.prof``).
+``memory``
+    ``tracemalloc`` snapshots taken before and after the request; the
+    allocations still alive afterwards are written as a text report.
+
+Long-lived ``tracemalloc`` snapshots of a worker are taken through the
+staff-only ``/admin/profiling/memory/`` endpoint; each one is diffed against
+the previous snapshot of the same process.
+
+Everything is written to a ``ProfileStore`` directory that keeps at most
+``MAX_FILES`` files and ``MAX_BYTES`` bytes, oldest removed first. List,
+show and download results with ``manage.py profiles``. When ``ENABLED`` is
+false the middleware removes itself, so requests pay nothing.
+"""
+import cProfile
+import io
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+PROFILING_DEFAULTS = {
+    'ENABLED': False,
+    # Request header that asks for a profile (staff users only)
+    'HEADER': 'X-Profile',
+    # Fraction of all requests profiled with DEFAULT_MODE
+    'SAMPLE_RATE': 0.0,
+    'DEFAULT_MODE': 'sample',
+    # Seconds between two stack samples
+    'SAMPLE_INTERVAL': 0.005,
+    # Frames kept per tracemalloc traceback
+    'MEMORY_FRAMES': 10,
+    'DIRECTORY': os.path.join(settings.BASE_DIR, 'profiles'),
+    'MAX_FILES': 200,
+    'MAX_BYTES': 200 * 1024 * 1024,
+}
+
+MODES = ('sample', 'cprofile', 'memory')
+# Allocations reported per memory diff
+MEMORY_TOP = 40
+
+_memory_lock = threading.Lock()
+_last_snapshot = None
+
+
+def profiling_settings():
+    return {**PROFILING_DEFAULTS, **getattr(settings, 'PROFILING', {})}
+
+
+class ProfileStore:
+    """A directory of profiles with a cap on file count and total size."""
+
+    EXTENSIONS = ('.collapsed', '.prof', '.txt', '.tracemalloc')
+
+    def __init__(self, directory=None, max_files=None, max_bytes=None):
+        config = profiling_settings()
+        self.directory = directory or config['DIRECTORY']
+        self.max_files = max_files or config['MAX_FILES']
+        self.max_bytes = max_bytes or config['MAX_BYTES']
+
+    def new_path(self, label, extension):
+        """Return a fresh path for a profile named after ``label``."""
+        os.makedirs(self.directory, exist_ok=True)
+        label = re.sub(r'[^A-Za-z0-9_.-]+', '-', label).strip('-')[:60] or 'profile'
+        stamp = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+        return os.path.join(self.directory, f'{stamp}-{os.getpid()}-{label}{extension}')
+
+    def save(self, label, extension, data):
+        path = self.new_path(label, extension)
+        mode = 'wb' if isinstance(data, bytes) else 'w'
+        with open(path, mode) as fileobj:
+            fileobj.write(data)
+        self.prune()
+        return os.path.basename(path)
+
+    def entries(self):
+        """Stored profiles as ``(name, size, modified)``, newest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        rows = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(self.EXTENSIONS):
+                stat = entry.stat()
+                rows.append((entry.name, stat.st_size, stat.st_mtime))
+        rows.sort(key=lambda row: (row[2], row[0]), reverse=True)
+        return rows
+
+    def path(self, name):
+        if os.path.basename(name) != name or not name.endswith(self.EXTENSIONS):
+            raise FileNotFoundError(name)
+        path = os.path.join(self.directory, name)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(name)
+        return path
+
+    def delete(self, name):
+        os.remove(self.path(name))
+
+    def prune(self):
+        total = 0
+        for index, (name, size, _) in enumerate(self.entries()):
+            total += size
+            if index >= self.max_files or total > self.max_bytes:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+
+
+class StackSampler:
+    """Sample one thread's stack on a background thread, as collapsed stacks."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='stack-sampler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({short_path(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+def short_path(filename):
+    """Shorten a source path for display, without characters that break collapsed stacks."""
+    base = str(settings.BASE_DIR)
+    if filename.startswith(base):
+        filename = os.path.relpath(filename, base)
+    else:
+        parts = filename.split(os.sep + 'site-packages' + os.sep, 1)
+        filename = parts[-1]
+    return filename.replace(';', ':').replace(' ', '_')
+
+
+def memory_report(before, after, title, limit=MEMORY_TOP):
+    """Text report of the allocation sites that grew between two snapshots."""
+    filters = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    ]
+    before, after = before.filter_traces(filters), after.filter_traces(filters)
+    stats = after.compare_to(before, 'traceback')
+    growth = sum(stat.size_diff for stat in stats)
+    lines = [title, f'Net change: {growth / 1024:+.1f} KiB across {len(stats)} allocation sites', '']
+    for stat in stats[:limit]:
+        if not stat.size_diff:
+            continue
+        lines.append(f'{stat.size_diff / 1024:+.1f} KiB ({stat.count_diff:+d} blocks), {stat.size / 1024:.1f} KiB live')
+        lines.extend(f'    {line}' for line in stat.traceback.format(limit=6))
+    return '\n'.join(lines) + '\n'
+
+
+def take_memory_snapshot(store=None):
+    """Snapshot this worker's heap and diff it against its previous snapshot.
+
+    Returns the names of the stored snapshot and diff report (``None`` for
+    the first snapshot of a process).
+    """
+    global _last_snapshot
+    if not tracemalloc.is_tracing():
+        raise RuntimeError('tracemalloc is not tracing; start it first')
+    store = store or ProfileStore()
+    with _memory_lock:
+        snapshot = tracemalloc.take_snapshot()
+        path = store.new_path('heap', '.tracemalloc')
+        snapshot.dump(path)
+        store.prune()
+        report = None
+        if _last_snapshot is not None:
+            previous_name, previous = _last_snapshot
+            report = store.save(
+                'heap-diff', '.txt',
+                memory_report(previous, snapshot, f'Worker {os.getpid()}: {previous_name} -> {os.path.basename(path)}'),
+            )
+        _last_snapshot = (os.path.basename(path), snapshot)
+    return os.path.basename(path), report
+
+
+def start_memory_tracing():
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(profiling_settings()['MEMORY_FRAMES'])
+
+
+def stop_memory_tracing():
+    global _last_snapshot
+    with _memory_lock:
+        _last_snapshot = None
+    tracemalloc.stop()
+
+
+def memory_status():
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        'pid': os.getpid(),
+        'tracing': tracemalloc.is_tracing(),
+        'traced_bytes': current,
+        'peak_bytes': peak,
+        'last_snapshot': _last_snapshot[0] if _last_snapshot else None,
+    }
+
+
+class ProfilingMiddleware:
+    """Profile requests on demand; see the module docstring.
+
+    Goes after ``AuthenticationMiddleware``, which the header check needs.
+    """
+
+    def __init__(self, get_response):
+        self.config = profiling_settings()
+        if not self.config['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.header = 'HTTP_' + self.config['HEADER'].upper().replace('-', '_')
+        self.store = ProfileStore()
+
+    def __call__(self, request):
+        mode = self.requested_mode(request)
+        if mode is None:
+            return self.get_response(request)
+
+        started = time.perf_counter()
+        if mode == 'cprofile':
+            profiler = cProfile.Profile()
+            response = profiler.runcall(self.get_response, request)
+            path = self.store.new_path(self.label(request, mode), '.prof')
+            profiler.dump_stats(path)
+            self.store.prune()
+            name = os.path.basename(path)
+        elif mode == 'memory':
+            response, name = self.profile_memory(request)
+        else:
+            sampler = StackSampler(threading.get_ident(), self.config['SAMPLE_INTERVAL']).start()
+            try:
+                response = self.get_response(request)
+            finally:
+                sampler.stop()
+            name = self.store.save(self.label(request, mode), '.collapsed', sampler.collapsed())
+
+        response['X-Profile-Id'] = name
+        response['X-Profile-Duration'] = f'{(time.perf_counter() - started) * 1000:.1f}ms'
+        return response
+
+    def requested_mode(self, request):
+        value = request.META.get(self.header)
+        if value is not None:
+            user = getattr(request, 'user', None)
+            if user is None or not user.is_staff:
+                return None
+            value = value.strip().lower()
+            return value if value in MODES else self.config['DEFAULT_MODE']
+        if self.config['SAMPLE_RATE'] and random.random() < self.config['SAMPLE_RATE']:
+            return self.config['DEFAULT_MODE']
+        return None
+
+    def label(self, request, mode):
+        match = getattr(request, 'resolver_match', None)
+        return f'{match.view_name if match else request.path}-{mode}'
+
+    def profile_memory(self, request):
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(self.config['MEMORY_FRAMES'])
+        try:
+            before = tracemalloc.take_snapshot()
+            response = self.get_response(request)
+            after = tracemalloc.take_snapshot()
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+        name = self.store.save(self.label(request, 'memory'), '.txt', memory_report(before, after, f'{request.method} {request.path}'))
+        return response, name
+
+
+def describe(path, limit=30):
+    """Human-readable summary of a stored profile."""
+    if path.endswith('.prof'):
+        output = io.StringIO()
+        pstats.Stats(path, stream=output).sort_stats('cumulative').print_stats(limit)
+        return output.getvalue()
+    if path.endswith('.tracemalloc'):
+        snapshot = tracemalloc.Snapshot.load(path)
+        stats = snapshot.statistics('lineno')
+        total = sum(stat.size for stat in stats)
+        lines = [f'{total / 1024:.1f} KiB in {len(stats)} allocation sites']
+        lines.extend(str(stat) for stat in stats[:limit])
+        return '\n'.join(lines) + '\n'
+    if path.endswith('.collapsed'):
+        # Self time per frame: the last entry of every stack
+        counts = Counter()
+        with open(path) as fileobj:
+            for line in fileobj:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                counts[stack.rsplit(';', 1)[-1]] += int(count)
+        total = sum(counts.values()) or 1
+        lines = [f'{sum(counts.values())} samples; top frames by self time']
+        lines.extend(f'{count * 100 / total:5.1f}%  {frame}' for frame, count in counts.most_common(limit))
+        return '\n'.join(lines) + '\n'
+    with open(path) as fileobj:
+        return fileobj.read()
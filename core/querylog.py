@@ -0,0 +1,227 @@
+"""
+Slow-query log.
+
+``QueryLogMiddleware`` installs a ``connection.execute_wrapper`` around each
+request. Statements slower than ``THRESHOLD_MS`` are recorded with their
+call site: the view, the innermost template line being rendered and the
+closest line of project code. The first time a statement shape (its
+fingerprint) is recorded, its plan is captured with ``EXPLAIN QUERY PLAN``
+(SQLite) or ``EXPLAIN`` (PostgreSQL, MySQL).
+
+Statements touching one of ``WATCH_TABLES`` are explained on first sight
+even when they are fast, and recorded if the plan shows a full table scan,
+so a missing index shows up before the table is big enough to hurt.
+
+Entries are kept in a per-process ring buffer, browsable by staff at
+``/admin/query-log/``, and logged to the ``core.querylog`` logger.
+"""
+import hashlib
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+QUERY_LOG_DEFAULTS = {
+    'ENABLED': False,
+    # Statements at least this slow are recorded
+    'THRESHOLD_MS': 100,
+    # Entries kept per process
+    'BUFFER_SIZE': 500,
+    # Distinct statement plans kept per process
+    'MAX_PLANS': 1000,
+    # Tables whose statements are explained even when fast
+    'WATCH_TABLES': [],
+}
+
+_entries = None
+_plans = OrderedDict()
+_lock = threading.Lock()
+_local = threading.local()
+
+PROJECT_ROOT = str(settings.BASE_DIR)
+THIS_FILE = os.path.abspath(__file__)
+
+IN_LIST_RE = re.compile(r'IN \((?:%s, )*%s\)')
+LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+SPACE_RE = re.compile(r'\s+')
+
+
+def query_log_settings():
+    return {**QUERY_LOG_DEFAULTS, **getattr(settings, 'QUERY_LOG', {})}
+
+
+def fingerprint(sql):
+    """Identify the shape of a statement, ignoring values and IN-list lengths."""
+    shape = SPACE_RE.sub(' ', LITERAL_RE.sub('?', IN_LIST_RE.sub('IN (...)', sql))).strip()
+    return hashlib.md5(shape.encode()).hexdigest()[:16]
+
+
+def call_site(request):
+    """Return ``(view, template line, code line)`` for the running statement."""
+    match = getattr(request, 'resolver_match', None) if request is not None else None
+    view = match.view_name if match else (request.path if request is not None else None)
+    template = code = None
+    frame = sys._getframe(1)
+    while frame is not None and (template is None or code is None):
+        filename = frame.f_code.co_filename
+        if template is None and frame.f_code.co_name == 'render_annotated':
+            # django.template.base.Node.render_annotated; innermost node first
+            node = frame.f_locals.get('self')
+            origin, token = getattr(node, 'origin', None), getattr(node, 'token', None)
+            if origin is not None and token is not None:
+                template = f'{origin.template_name}:{token.lineno}'
+        if (code is None and filename.startswith(PROJECT_ROOT) and filename != THIS_FILE
+                and 'site-packages' not in filename):
+            code = f'{os.path.relpath(filename, PROJECT_ROOT)}:{frame.f_lineno} in {frame.f_code.co_name}'
+        frame = frame.f_back
+    return view, template, code
+
+
+def explain(connection, sql, params):
+    """Return the plan of a SELECT as a list of lines, or ``None``."""
+    if not sql.lstrip().upper().startswith('SELECT'):
+        return None
+    prefix = {'sqlite': 'EXPLAIN QUERY PLAN ', 'postgresql': 'EXPLAIN ', 'mysql': 'EXPLAIN '}.get(connection.vendor)
+    if prefix is None:
+        return None
+    _local.explaining = True
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + sql, params)
+            rows = cursor.fetchall()
+    except Exception as exc:
+        return [f'EXPLAIN failed: {exc}']
+    finally:
+        _local.explaining = False
+    if connection.vendor == 'sqlite':
+        # (id, parent, notused, detail)
+        return [row[-1] for row in rows]
+    return [' | '.join(str(value) for value in row) for row in rows]
+
+
+def full_scans(plan):
+    """Plan lines that read a whole table."""
+    scans = []
+    for line in plan or ():
+        detail = line.strip()
+        if (detail.startswith('SCAN ') and 'USING' not in detail) or 'Seq Scan' in detail or 'type: ALL' in detail:
+            scans.append(detail)
+    return scans
+
+
+class QueryRecorder:
+    """``execute_wrapper`` that records slow statements of one request."""
+
+    def __init__(self, request=None, config=None):
+        self.request = request
+        self.config = config or query_log_settings()
+        self.watch_tables = tuple(self.config['WATCH_TABLES'])
+
+    def __call__(self, execute, sql, params, many, context):
+        if getattr(_local, 'explaining', False):
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        result = execute(sql, params, many, context)
+        duration_ms = (time.perf_counter() - start) * 1000
+        watched = any(f'"{table}"' in sql or f'`{table}`' in sql for table in self.watch_tables)
+        if duration_ms >= self.config['THRESHOLD_MS'] or watched:
+            self.record(context['connection'], sql, None if many else params, duration_ms, watched)
+        return result
+
+    def record(self, connection, sql, params, duration_ms, watched):
+        global _entries
+        key = fingerprint(sql)
+        with _lock:
+            known = key in _plans
+        plan = None
+        if not known and params is not None:
+            plan = explain(connection, sql, params)
+            with _lock:
+                _plans[key] = plan
+                while len(_plans) > self.config['MAX_PLANS']:
+                    _plans.popitem(last=False)
+        else:
+            with _lock:
+                plan = _plans.get(key)
+
+        slow = duration_ms >= self.config['THRESHOLD_MS']
+        scans = full_scans(plan)
+        if not slow and not (watched and scans and not known):
+            return
+
+        view, template, code = call_site(self.request)
+        entry = {
+            'time': timezone.now(),
+            'fingerprint': key,
+            'sql': sql if params is None else _interpolate(sql, params),
+            'duration_ms': round(duration_ms, 2),
+            'alias': connection.alias,
+            'view': view,
+            'template': template,
+            'code': code,
+            'plan': plan,
+            'full_scans': scans,
+            'reason': 'slow' if slow else 'full scan',
+        }
+        with _lock:
+            if _entries is None:
+                _entries = deque(maxlen=self.config['BUFFER_SIZE'])
+            _entries.append(entry)
+        logger.warning(
+            'Query %s (%s, %.1f ms) in %s [%s] %s: %s',
+            key, entry['reason'], duration_ms, view, template or '-', code or '-', sql[:500],
+        )
+
+
+def _interpolate(sql, params):
+    try:
+        return sql % tuple(repr(value) for value in params)
+    except (TypeError, ValueError):
+        return sql
+
+
+def entries():
+    """Recorded entries, newest first."""
+    with _lock:
+        return list(reversed(_entries or ()))
+
+
+def clear():
+    with _lock:
+        if _entries is not None:
+            _entries.clear()
+        _plans.clear()
+
+
+@contextmanager
+def query_logging(request=None):
+    """Record slow statements on every database connection inside the block."""
+    recorder = QueryRecorder(request)
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(recorder))
+        yield recorder
+
+
+class QueryLogMiddleware:
+    """Wrap every request in :func:`query_logging` when ``QUERY_LOG`` is enabled."""
+
+    def __init__(self, get_response):
+        if not query_log_settings()['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with query_logging(request):
+            return self.get_response(request)
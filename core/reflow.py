@@ -0,0 +1,333 @@
+"""
+Ingest pipeline for reflowable book formats (EPUB and plain text).
+
+A reflowable book is parsed once into sanitized HTML chunks (one per EPUB
+spine item, or one per page of text) which are written to storage next to a
+JSON manifest. The reader then fetches a single chunk at a time, and a chunk
+number doubles as the ``ReadingProgress.current_page`` for these formats.
+"""
+import hashlib
+import json
+import posixpath
+import re
+import zipfile
+from html import escape
+from html.parser import HTMLParser
+from urllib.parse import unquote, urlsplit
+from xml.etree import ElementTree
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.urls import reverse
+
+REFLOWABLE_FORMATS = ('epub', 'txt')
+
+# 2: images are linked through the book_asset view instead of MEDIA_URL
+MANIFEST_VERSION = 2
+
+ASSET_NAME_RE = re.compile(r'^[0-9a-f]{16}(\.\w+)?$')
+
+# Roughly a printed page of prose; overridable with READER_TXT_CHUNK_CHARS.
+TXT_CHUNK_CHARS = getattr(settings, 'READER_TXT_CHUNK_CHARS', 6000)
+
+ALLOWED_TAGS = {
+    'a', 'abbr', 'b', 'blockquote', 'br', 'caption', 'cite', 'code', 'dd',
+    'del', 'div', 'dl', 'dt', 'em', 'figcaption', 'figure', 'h1', 'h2', 'h3',
+    'h4', 'h5', 'h6', 'hr', 'i', 'img', 'ins', 'li', 'ol', 'p', 'pre', 'q',
+    's', 'section', 'small', 'span', 'strong', 'sub', 'sup', 'table', 'tbody',
+    'td', 'tfoot', 'th', 'thead', 'tr', 'u', 'ul',
+}
+VOID_TAGS = {'br', 'hr', 'img'}
+DROPPED_TAGS = {'script', 'style', 'head', 'title', 'iframe', 'object', 'embed', 'svg', 'math'}
+ALLOWED_ATTRS = {
+    'a': {'href', 'title'},
+    'img': {'src', 'alt', 'title'},
+    'td': {'colspan', 'rowspan'},
+    'th': {'colspan', 'rowspan'},
+}
+
+CONTAINER_NS = {'c': 'urn:oasis:names:tc:opendocument:xmlns:container'}
+OPF_NS = {'opf': 'http://www.idpf.org/2007/opf'}
+
+
+class IngestError(Exception):
+    """Raised when a book file cannot be parsed into chunks."""
+
+
+class HTMLSanitizer(HTMLParser):
+    """Whitelist-based HTML cleaner used on every chunk before it is stored.
+
+    ``resolve_src`` is called for each ``img`` source and returns the URL to
+    emit, or ``None`` to drop the image.
+    """
+
+    def __init__(self, resolve_src=None):
+        super().__init__(convert_charrefs=True)
+        self.resolve_src = resolve_src
+        self.parts = []
+        self.skip_depth = 0
+        self.title = ''
+        self._heading = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROPPED_TAGS:
+            self.skip_depth += 1
+            return
+        if self.skip_depth or tag not in ALLOWED_TAGS:
+            return
+        if tag in ('h1', 'h2', 'h3') and not self.title:
+            self._heading = []
+        clean = []
+        for name, value in attrs:
+            if name not in ALLOWED_ATTRS.get(tag, ()) or value is None:
+                continue
+            if name == 'href':
+                scheme = urlsplit(value).scheme
+                if scheme not in ('', 'http', 'https', 'mailto'):
+                    continue
+                if not scheme and not value.startswith('#'):
+                    # Links between spine items do not survive chunking.
+                    continue
+            if name == 'src':
+                value = self.resolve_src(value) if self.resolve_src else None
+                if value is None:
+                    continue
+            clean.append(f' {name}="{escape(value)}"')
+        self.parts.append(f'<{tag}{"".join(clean)}>')
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag in DROPPED_TAGS:
+            self.skip_depth -= 1
+        elif tag not in VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in DROPPED_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+            return
+        if self.skip_depth or tag not in ALLOWED_TAGS or tag in VOID_TAGS:
+            return
+        if self._heading is not None and tag in ('h1', 'h2', 'h3'):
+            self.title = ' '.join(''.join(self._heading).split())
+            self._heading = None
+        self.parts.append(f'</{tag}>')
+
+    def handle_data(self, data):
+        if self.skip_depth:
+            return
+        if self._heading is not None:
+            self._heading.append(data)
+        self.parts.append(escape(data, quote=False))
+
+    def get_html(self):
+        return ''.join(self.parts).strip()
+
+
+def sanitize_html(markup, resolve_src=None):
+    """Return ``(html, title)`` for a fragment of untrusted markup."""
+    sanitizer = HTMLSanitizer(resolve_src=resolve_src)
+    sanitizer.feed(markup)
+    sanitizer.close()
+    return sanitizer.get_html(), sanitizer.title
+
+
+def chunk_dir(book):
+    return f'book_chunks/{book.pk}'
+
+
+def manifest_path(book):
+    return f'{chunk_dir(book)}/manifest.json'
+
+
+def chunk_path(book, number):
+    return f'{chunk_dir(book)}/{number:05d}.html'
+
+
+def asset_path(book, name):
+    return f'{chunk_dir(book)}/assets/{name}'
+
+
+def _manifest_cache_key(book):
+    return f'reflow:manifest:{book.pk}:{book.file.name}'
+
+
+def is_reflowable(book):
+    return book.format in REFLOWABLE_FORMATS
+
+
+def split_text(text, size=TXT_CHUNK_CHARS):
+    """Split plain text into page-sized lists of paragraphs."""
+    paragraphs = [p.strip() for p in re.split(r'\n\s*\n', text) if p.strip()]
+    pages, current, length = [], [], 0
+    for paragraph in paragraphs:
+        if current and length + len(paragraph) > size:
+            pages.append(current)
+            current, length = [], 0
+        current.append(paragraph)
+        length += len(paragraph)
+    if current:
+        pages.append(current)
+    return pages
+
+
+def parse_txt(fileobj):
+    """Yield ``(title, html)`` chunks for a plain text file."""
+    raw = fileobj.read()
+    for encoding in ('utf-8-sig', 'cp1252', 'latin-1'):
+        try:
+            text = raw.decode(encoding)
+            break
+        except UnicodeDecodeError:
+            continue
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    for number, page in enumerate(split_text(text), start=1):
+        html = ''.join(
+            '<p>{}</p>'.format(escape(p, quote=False).replace('\n', '<br>'))
+            for p in page
+        )
+        yield f'Page {number}', html
+
+
+def parse_epub(fileobj, asset_writer):
+    """Yield ``(title, html)`` chunks for each item in an EPUB spine.
+
+    ``asset_writer(zip_path, data)`` stores an embedded image and returns the
+    URL it should be referenced by.
+    """
+    try:
+        archive = zipfile.ZipFile(fileobj)
+    except zipfile.BadZipFile as exc:
+        raise IngestError('Not a valid EPUB archive') from exc
+
+    with archive:
+        try:
+            container = ElementTree.fromstring(archive.read('META-INF/container.xml'))
+            rootfile = container.find('.//c:rootfile', CONTAINER_NS).get('full-path')
+            opf = ElementTree.fromstring(archive.read(rootfile))
+        except (KeyError, AttributeError, ElementTree.ParseError) as exc:
+            raise IngestError('EPUB package document is missing or malformed') from exc
+
+        base = posixpath.dirname(rootfile)
+        items = {
+            item.get('id'): posixpath.normpath(posixpath.join(base, unquote(item.get('href', ''))))
+            for item in opf.findall('.//opf:manifest/opf:item', OPF_NS)
+        }
+        names = set(archive.namelist())
+        assets = {}
+
+        for itemref in opf.findall('.//opf:spine/opf:itemref', OPF_NS):
+            href = items.get(itemref.get('idref'))
+            if href is None or href not in names or itemref.get('linear') == 'no':
+                continue
+            chapter_dir = posixpath.dirname(href)
+
+            def resolve_src(src, chapter_dir=chapter_dir):
+                path = posixpath.normpath(posixpath.join(chapter_dir, unquote(urlsplit(src).path)))
+                if path not in names:
+                    return None
+                if path not in assets:
+                    assets[path] = asset_writer(path, archive.read(path))
+                return assets[path]
+
+            markup = archive.read(href).decode('utf-8', errors='replace')
+            html, title = sanitize_html(markup, resolve_src=resolve_src)
+            if html:
+                yield title, html
+
+
+def ingest_book(book):
+    """Parse ``book.file`` into stored chunks and return the manifest.
+
+    Also sets ``book.page_count`` to the number of chunks so reading progress
+    works the same way as it does for PDFs.
+    """
+    if not is_reflowable(book):
+        raise IngestError(f'{book.get_format_display()} books are not reflowable')
+
+    delete_chunks(book)
+
+    def asset_writer(zip_path, data):
+        digest = hashlib.sha1(zip_path.encode()).hexdigest()[:16]
+        extension = posixpath.splitext(zip_path)[1].lower()
+        if not ASSET_NAME_RE.match(digest + extension):
+            extension = ''
+        name = posixpath.basename(default_storage.save(asset_path(book, digest + extension), ContentFile(data)))
+        # Served by the reader's access-checked view, never straight from storage
+        return reverse('book_asset', kwargs={'slug': book.slug, 'name': name})
+
+    with book.file.open('rb') as fileobj:
+        if book.format == 'epub':
+            parsed = list(parse_epub(fileobj, asset_writer))
+        else:
+            parsed = list(parse_txt(fileobj))
+
+    if not parsed:
+        raise IngestError('No readable content found')
+
+    chunks = []
+    for number, (title, html) in enumerate(parsed, start=1):
+        data = html.encode('utf-8')
+        default_storage.save(chunk_path(book, number), ContentFile(data))
+        chunks.append({
+            'number': number,
+            'title': title or f'Section {number}',
+            'size': len(data),
+            'etag': hashlib.sha1(data).hexdigest(),
+        })
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'source': book.file.name,
+        'format': book.format,
+        'chunks': chunks,
+    }
+    default_storage.save(manifest_path(book), ContentFile(json.dumps(manifest).encode('utf-8')))
+    cache.set(_manifest_cache_key(book), manifest, None)
+
+    # Queryset update so the post_save ingest hook is not re-triggered.
+    type(book).objects.filter(pk=book.pk).update(page_count=len(chunks))
+    book.page_count = len(chunks)
+    return manifest
+
+
+def delete_chunks(book):
+    """Remove every stored chunk, asset and the manifest for ``book``."""
+    directory = chunk_dir(book)
+    if not default_storage.exists(directory):
+        return
+    subdirs, files = default_storage.listdir(directory)
+    for name in files:
+        default_storage.delete(f'{directory}/{name}')
+    if 'assets' in subdirs:
+        for name in default_storage.listdir(f'{directory}/assets')[1]:
+            default_storage.delete(f'{directory}/assets/{name}')
+    cache.delete(_manifest_cache_key(book))
+
+
+def load_manifest(book):
+    """Return the stored manifest for ``book``, or ``None`` if not ingested.
+
+    Manifests whose source file no longer matches ``book.file`` are stale and
+    also return ``None``.
+    """
+    key = _manifest_cache_key(book)
+    manifest = cache.get(key)
+    if manifest is not None:
+        return manifest
+    path = manifest_path(book)
+    if not default_storage.exists(path):
+        return None
+    with default_storage.open(path, 'rb') as fileobj:
+        manifest = json.loads(fileobj.read().decode('utf-8'))
+    if manifest.get('source') != book.file.name or manifest.get('version') != MANIFEST_VERSION:
+        return None
+    cache.set(key, manifest, None)
+    return manifest
+
+
+def read_chunk(book, number):
+    with default_storage.open(chunk_path(book, number), 'rb') as fileobj:
+        return fileobj.read()
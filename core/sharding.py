@@ -0,0 +1,224 @@
+"""
+User-sharded storage of per-user tables.
+
+``ReadingProgress``, ``ArchivedReadingProgress`` and ``Bookmark`` grow with
+users times books and take nearly all of the writes, so their rows are
+spread over the ``SHARDS`` databases by user; every other table (the
+catalog, users, reviews, sessions, ...) stays on ``CATALOG_DATABASE``.
+
+A user's shard is picked once, by consistent hashing of the user id onto a
+ring of ``VNODES`` points per shard, and recorded in ``UserShard`` on the
+catalog database. The record is authoritative: adding a shard to
+``SHARDS`` only changes where *new* users go until ``manage.py
+rebalance_shards`` moves existing users whose ring position changed (which,
+thanks to the ring, is about ``1/N`` of them). Lookups are cached for
+``DIRECTORY_CACHE_TIMEOUT`` seconds.
+
+Queries on sharded tables must say which database to use, with
+``.using(user_database(user))``. ``UserShardRouter`` routes saves,
+``user.bookmarks``-style related managers and foreign key access by
+themselves; unhinted queries on sharded models fall through to
+``default``. Sharded rows are not joined to catalog tables (they may live
+in another database); when a user's shard *is* the catalog database,
+``book_ids()`` still hands back a subquery instead of a list of ids.
+"""
+import bisect
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+
+SHARDING_DEFAULTS = {
+    'CATALOG_DATABASE': 'default',
+    # Databases (DATABASES aliases) that hold the per-user tables
+    'SHARDS': ['default'],
+    # Ring points per shard; more points spread users more evenly
+    'VNODES': 128,
+    'DIRECTORY_CACHE_TIMEOUT': 60,
+}
+
+# Per-user models and the timestamp rebalancing uses to pick the newer copy of a row
+SHARDED_MODELS = {
+    'readingprogress': 'last_read',
+    'archivedreadingprogress': 'archived_at',
+    'bookmark': 'created_at',
+}
+
+_rings = {}
+
+
+def sharding_settings():
+    return {**SHARDING_DEFAULTS, **getattr(settings, 'SHARDING', {})}
+
+
+def catalog_database():
+    return sharding_settings()['CATALOG_DATABASE']
+
+
+def is_sharded(model):
+    """Whether ``model`` (a class or an instance) is stored per user."""
+    return model._meta.app_label == 'core' and model._meta.model_name in SHARDED_MODELS
+
+
+def sharded_models():
+    from django.apps import apps
+
+    return [apps.get_model('core', name) for name in SHARDED_MODELS]
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent-hash ring of database aliases."""
+
+    def __init__(self, shards, vnodes):
+        if not shards:
+            raise ValueError('SHARDING["SHARDS"] must name at least one database')
+        points = sorted((_hash(f'{alias}#{index}'), alias) for alias in shards for index in range(vnodes))
+        self.keys = [key for key, _ in points]
+        self.aliases = [alias for _, alias in points]
+
+    def shard(self, user_id):
+        index = bisect.bisect(self.keys, _hash(user_id)) % len(self.keys)
+        return self.aliases[index]
+
+
+def ring():
+    config = sharding_settings()
+    key = (tuple(config['SHARDS']), config['VNODES'])
+    if key not in _rings:
+        _rings[key] = HashRing(*key)
+    return _rings[key]
+
+
+def _directory_key(user_id):
+    return f'usershard:{user_id}'
+
+
+def forget_user(user_id):
+    """Drop the cached shard of a user, e.g. after moving them."""
+    cache.delete(_directory_key(user_id))
+
+
+def user_database(user):
+    """Alias of the database holding ``user``'s (a ``User`` or an id) per-user rows."""
+    from .models import UserShard
+
+    user_id = getattr(user, 'pk', user)
+    key = _directory_key(user_id)
+    alias = cache.get(key)
+    if alias is not None:
+        return alias
+    directory = UserShard.objects.using(catalog_database())
+    alias = directory.filter(user_id=user_id).values_list('shard', flat=True).first()
+    if alias is None:
+        alias = ring().shard(user_id)
+        try:
+            alias = directory.get_or_create(user_id=user_id, defaults={'shard': alias})[0].shard
+        except IntegrityError:
+            # No such user (yet); answer without recording or caching anything
+            return alias
+    cache.set(key, alias, sharding_settings()['DIRECTORY_CACHE_TIMEOUT'])
+    return alias
+
+
+def all_shards():
+    """Every database that may hold per-user rows: ``SHARDS`` and any a user is still recorded on."""
+    from .models import UserShard
+
+    recorded = UserShard.objects.using(catalog_database()).order_by().values_list('shard', flat=True).distinct()
+    aliases = dict.fromkeys(sharding_settings()['SHARDS'])
+    aliases.update(dict.fromkeys(recorded))
+    return list(aliases)
+
+
+def book_ids(queryset):
+    """The ``book_id`` values of ``queryset``, in a form ``Book.objects.filter(pk__in=...)`` accepts.
+
+    A subquery when the rows share the catalog's database, a list otherwise.
+    """
+    if queryset.db == catalog_database():
+        return queryset.order_by().values('book_id')
+    return list(queryset.order_by().values_list('book_id', flat=True))
+
+
+def copy_user_rows(user_id, source, target, since=None):
+    """Bring ``user_id``'s rows on ``target`` up to date with ``source``.
+
+    Rows are matched on their ``(user, book)`` key, and of two copies the one
+    with the newer timestamp (see ``SHARDED_MODELS``) wins. With ``since``
+    (when the first copy began), a row missing on one side is only copied
+    if it was written after that. An older one was deleted on ``target``,
+    so it stays deleted. Rows on ``target`` that vanished from ``source``
+    are removed too. Timestamps are copied as they are (``raw`` saves skip
+    ``auto_now``). Returns the number of rows written or deleted.
+    """
+    changed = 0
+    with transaction.atomic(using=target):
+        for model in sharded_models():
+            stamp = SHARDED_MODELS[model._meta.model_name]
+            fields = [field.attname for field in model._meta.concrete_fields if not field.primary_key]
+            rows = {row.book_id: row for row in model._base_manager.using(source).filter(user_id=user_id)}
+            existing = {row.book_id: row for row in model._base_manager.using(target).filter(user_id=user_id)}
+            for book_id, row in rows.items():
+                current = existing.get(book_id)
+                if current is None:
+                    if since is None or getattr(row, stamp) >= since:
+                        row.pk = None
+                        row.save_base(raw=True, force_insert=True, using=target)
+                        changed += 1
+                elif getattr(row, stamp) > getattr(current, stamp):
+                    model._base_manager.using(target).filter(pk=current.pk).update(
+                        **{field: getattr(row, field) for field in fields},
+                    )
+                    changed += 1
+            if since is not None:
+                gone = [row.pk for book_id, row in existing.items()
+                        if book_id not in rows and getattr(row, stamp) < since]
+                changed += model._base_manager.using(target).filter(pk__in=gone).delete()[0]
+    return changed
+
+
+def delete_user_rows(user_id, alias):
+    for model in sharded_models():
+        model._base_manager.using(alias).filter(user_id=user_id).delete()
+
+
+class UserShardRouter:
+    """Send per-user models to the user's shard and everything else to the catalog database."""
+
+    def _database(self, model, hints):
+        if not is_sharded(model):
+            return catalog_database()
+        instance = hints.get('instance')
+        if instance is None:
+            return None
+        if is_sharded(instance) and instance.user_id is not None:
+            return user_database(instance.user_id)
+        if instance._meta.label == settings.AUTH_USER_MODEL and instance.pk is not None:
+            # Related managers such as user.bookmarks
+            return user_database(instance.pk)
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._database(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._database(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Per-user rows point at users and books on the catalog database
+        if is_sharded(obj1) or is_sharded(obj2):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        config = sharding_settings()
+        if app_label == 'core' and model_name in SHARDED_MODELS:
+            return db in config['SHARDS']
+        if db != config['CATALOG_DATABASE'] and db in config['SHARDS']:
+            return False
+        return None
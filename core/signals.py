@@ -0,0 +1,184 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import facets, prefetch, reflow, sharding
+from .auth import invalidate_user
+from .catalog import touch_catalog
+from .models import Author, Blob, Book, Genre, ReadingProgress, Review, UserProfile, UserShard
+from .tasks import ingest_book
+
+
+@receiver(post_save, sender=Book)
+def ingest_reflowable_book(sender, instance, raw=False, update_fields=None, **kwargs):
+    """Split newly uploaded EPUB/TXT files into reader chunks."""
+    if raw or not instance.file or not reflow.is_reflowable(instance):
+        return
+    if update_fields and 'file' not in update_fields and 'format' not in update_fields:
+        return
+    if reflow.load_manifest(instance) is None:
+        ingest_book.delay(instance.pk)
+
+
+@receiver(post_delete, sender=Book)
+def delete_reflowable_chunks(sender, instance, **kwargs):
+    if reflow.is_reflowable(instance):
+        reflow.delete_chunks(instance)
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+@receiver(post_save, sender=Author)
+@receiver(post_delete, sender=Author)
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Genre)
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def catalog_changed(sender, **kwargs):
+    # Also marks every cached anonymous page as stale
+    touch_catalog()
+
+
+@receiver(m2m_changed, sender=Book.genres.through)
+def book_genres_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Genre assignments count as a change to the books and genres involved."""
+    if action == 'pre_clear':
+        # clear() does not report which rows it removes, so look before it runs
+        related = instance.books if reverse else instance.genres
+        instance._cleared_pks = list(related.values_list('pk', flat=True))
+        return
+    if not action.startswith('post_'):
+        return
+    if action == 'post_clear':
+        pk_set = getattr(instance, '_cleared_pks', [])
+    if reverse:
+        book_pks, genre_pks = pk_set or [], [instance.pk]
+    else:
+        book_pks, genre_pks = [instance.pk], pk_set or []
+    Book.objects.filter(pk__in=book_pks).update(updated_at=timezone.now())
+    Genre.refresh_stats(Genre.objects.filter(pk__in=genre_pks))
+    touch_catalog()
+
+
+@receiver(post_save, sender=Book)
+def update_book_facets(sender, instance, update_fields=None, **kwargs):
+    index = facets.loaded_index()
+    if index is None or (update_fields and not facets.FACET_FIELDS & set(update_fields)):
+        return
+    index.update_book(instance)
+
+
+@receiver(post_delete, sender=Book)
+def remove_book_facets(sender, instance, **kwargs):
+    index = facets.loaded_index()
+    if index is not None:
+        index.apply({instance.pk: None})
+
+
+@receiver(m2m_changed, sender=Book.genres.through)
+def update_genre_facets(sender, instance, action, reverse, pk_set, **kwargs):
+    index = facets.loaded_index()
+    if index is None or action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if action == 'post_clear':
+        # Recorded by book_genres_changed on pre_clear
+        pk_set = getattr(instance, '_cleared_pks', [])
+    if reverse:
+        book_pks, genre_pks = pk_set or [], [instance.pk]
+    else:
+        book_pks, genre_pks = [instance.pk], pk_set or []
+    index.change_genres(book_pks, genre_pks, add=action == 'post_add')
+
+
+@receiver(pre_delete, sender=Genre)
+def touch_genre_books(sender, instance, **kwargs):
+    # Its M2M rows go without m2m_changed; this makes every facet index re-read the books
+    instance.books.update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=Book)
+def refresh_author_and_genre_stats(sender, instance, raw=False, created=False, update_fields=None, **kwargs):
+    """Keep the denormalized counters on Author and Genre in step with books."""
+    if raw:
+        return
+    if update_fields and not {'author', 'average_rating', 'review_count'} & set(update_fields):
+        return
+    author_ids = {instance.author_id, getattr(instance, '_loaded_author_id', None)} - {None}
+    Author.refresh_stats(Author.objects.filter(pk__in=author_ids))
+    instance._loaded_author_id = instance.author_id
+    if not created:
+        Genre.refresh_stats(instance.genres.all())
+
+
+@receiver(pre_delete, sender=Book)
+def remember_deleted_book_genres(sender, instance, **kwargs):
+    # The M2M rows are gone (without m2m_changed) by the time post_delete runs
+    instance._deleted_genre_pks = list(instance.genres.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Book)
+def refresh_stats_after_book_delete(sender, instance, **kwargs):
+    Author.refresh_stats(Author.objects.filter(pk=instance.author_id))
+    Genre.refresh_stats(Genre.objects.filter(pk__in=getattr(instance, '_deleted_genre_pks', [])))
+
+
+@receiver(post_save, sender=Book)
+def track_blob_references(sender, instance, **kwargs):
+    """Move blob reference counts along with the files a book points at."""
+    loaded = set(getattr(instance, '_loaded_blobs', []))
+    current = set(instance.blob_names())
+    Blob.adjust(current - loaded, 1)
+    Blob.adjust(loaded - current, -1)
+    instance._loaded_blobs = list(current)
+
+
+@receiver(post_delete, sender=Book)
+def release_blob_references(sender, instance, **kwargs):
+    loaded = getattr(instance, '_loaded_blobs', None)
+    Blob.adjust(set(instance.blob_names() if loaded is None else loaded), -1)
+
+
+@receiver(post_delete, sender=Book)
+def delete_sharded_book_rows(sender, instance, **kwargs):
+    """Cascade to per-user rows, which may be on any shard."""
+    for alias in sharding.all_shards():
+        for model in sharding.sharded_models():
+            model._base_manager.using(alias).filter(book_id=instance.pk).delete()
+
+
+@receiver(post_save, sender=ReadingProgress)
+def record_page_turn(sender, instance, created=False, raw=False, **kwargs):
+    """Feed page turns to the prefetch statistics."""
+    previous = getattr(instance, '_loaded_page', None)
+    instance._loaded_page = instance.current_page
+    if raw or created or not previous:
+        return
+    prefetch.record_turn(instance.book_id, previous, instance.current_page)
+
+
+@receiver(pre_delete, sender=User)
+def remember_user_shards(sender, instance, **kwargs):
+    # The UserShard row is deleted along with the user
+    placement = UserShard.objects.using(sharding.catalog_database()).filter(user_id=instance.pk).first()
+    instance._shards = {placement.shard, placement.previous_shard} - {''} if placement else set()
+
+
+@receiver(post_delete, sender=User)
+def delete_sharded_user_rows(sender, instance, **kwargs):
+    for alias in getattr(instance, '_shards', ()):
+        sharding.delete_user_rows(instance.pk, alias)
+    sharding.forget_user(instance.pk)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    invalidate_user(instance.pk)
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def invalidate_cached_profile(sender, instance, **kwargs):
+    # The cached user carries their profile
+    invalidate_user(instance.user_id)
@@ -0,0 +1,157 @@
+"""
+Worker startup: preloading and cache warming.
+
+Django resolves URLs, compiles templates and fills model metadata lazily,
+so every fresh worker pays for it on its first requests. ``preload()`` does
+that work up front, and loads the catalog facet index. It is called from
+``bookreader/wsgi.py`` when ``STARTUP['PRELOAD']`` is on, so under
+``gunicorn --preload`` it runs once in the master and forked workers
+inherit the result. Doing it in the WSGI entry point rather than
+``AppConfig.ready()`` keeps it out of management commands.
+
+``warm_pages()`` renders the hottest anonymous pages through the normal
+middleware stack, which stores them in the page cache. ``manage.py
+warm_caches`` runs it after a deploy for shared cache backends; with a
+process-local cache, ``STARTUP['WARM_CACHES']`` warms the master before the
+fork instead.
+"""
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connections
+from django.template import engines
+from django.template.backends.django import DjangoTemplates
+from django.urls import get_resolver, reverse
+
+logger = logging.getLogger(__name__)
+
+STARTUP_DEFAULTS = {
+    'PRELOAD': False,
+    'WARM_CACHES': False,
+    # Pages of each kind warmed by warm_caches and WARM_CACHES
+    'WARM_BOOKS': 50,
+    'WARM_AUTHORS': 20,
+    'WARM_GENRES': 20,
+}
+
+
+def startup_settings():
+    return {**STARTUP_DEFAULTS, **getattr(settings, 'STARTUP', {})}
+
+
+def preload_urls():
+    """Import every URLconf and build the resolver's reverse lookup tables."""
+    resolver = get_resolver()
+    return len(resolver.reverse_dict)
+
+
+def preload_templates():
+    """Compile every template the Django template engines can find."""
+    count = 0
+    for engine in engines.all():
+        if not isinstance(engine, DjangoTemplates):
+            continue
+        for directory in engine.template_dirs:
+            for root, _, files in os.walk(directory):
+                for filename in files:
+                    if not filename.endswith(('.html', '.txt', '.xml')):
+                        continue
+                    name = os.path.relpath(os.path.join(root, filename), directory).replace(os.sep, '/')
+                    try:
+                        engine.get_template(name)
+                        count += 1
+                    except Exception as exc:
+                        logger.warning('Could not preload template %s: %s', name, exc)
+    return count
+
+
+def preload_models():
+    """Fill the field and relation caches of every model's ``_meta``."""
+    models = apps.get_models(include_auto_created=True)
+    for model in models:
+        model._meta.get_fields()
+        model._meta.related_objects
+    return len(models)
+
+
+def preload_facets():
+    """Load the facet index (from its snapshot when there is one) for the workers to inherit."""
+    from . import facets
+
+    try:
+        return len(facets.get_index())
+    finally:
+        connections.close_all()
+
+
+def preload():
+    """Preload URLs, templates, models and facets; return the seconds each took."""
+    timings = {}
+    steps = (
+        ('models', preload_models), ('urls', preload_urls), ('templates', preload_templates),
+        ('facets', preload_facets),
+    )
+    for name, step in steps:
+        started = time.perf_counter()
+        count = step()
+        timings[name] = (count, time.perf_counter() - started)
+    logger.info('Preloaded %s', ', '.join(f'{count} {name} in {seconds * 1000:.0f} ms'
+                                          for name, (count, seconds) in timings.items()))
+    return timings
+
+
+def hot_paths(config=None):
+    """Paths of the pages most likely to be requested right after a deploy."""
+    from .models import Author, Book, Genre
+
+    config = config or startup_settings()
+    paths = [reverse('home'), reverse('author_list'), reverse('genre_list')]
+    books = Book.objects.order_by('-is_featured', '-is_popular', '-review_count', '-average_rating')
+    paths += [reverse('book_detail', args=[slug]) for slug in books.values_list('slug', flat=True)[:config['WARM_BOOKS']]]
+    authors = Author.objects.order_by('-book_count').values_list('pk', flat=True)[:config['WARM_AUTHORS']]
+    paths += [reverse('author_detail', args=[pk]) for pk in authors]
+    genres = Genre.objects.order_by('-book_count').values_list('slug', flat=True)[:config['WARM_GENRES']]
+    paths += [reverse('genre_detail', args=[slug]) for slug in genres]
+    return paths
+
+
+def _render(client, path, host):
+    started = time.perf_counter()
+    try:
+        response = client.get(path, HTTP_HOST=host)
+        return path, response.status_code, response.get('X-Page-Cache', ''), time.perf_counter() - started
+    finally:
+        # Each pool thread has its own connections
+        connections.close_all()
+
+
+def warm_pages(paths, host, workers=4):
+    """Request ``paths`` anonymously in parallel.
+
+    Returns ``(path, status, X-Page-Cache, seconds)`` for each path.
+    """
+    from django.test import Client
+
+    def render(path):
+        return _render(Client(), path, host)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(render, paths))
+
+
+def default_host():
+    return next((host.lstrip('.') for host in settings.ALLOWED_HOSTS if host and host != '*'), 'localhost')
+
+
+def warm_before_fork():
+    """Warm this process's caches, then drop connections so forks don't share them."""
+    try:
+        results = warm_pages(hot_paths(), default_host())
+    finally:
+        connections.close_all()
+    logger.info('Warmed %d pages before forking', len(results))
+    return results
@@ -0,0 +1,241 @@
+"""
+Storage backends: content-addressed blobs for book files and covers, and a
+fingerprinting, precompressing backend for static files.
+
+Content-addressed storage
+-------------------------
+
+Every upload is hashed (SHA-256) while it streams to disk and stored once
+under ``<prefix>/<aa>/<bb>/<sha256><ext>``. Uploading the same bytes again,
+under any title or filename, resolves to the existing blob. The ``Blob``
+model counts how many ``Book`` rows reference each blob, and
+``manage.py gc_blobs`` removes those nobody references any more.
+
+Signed URLs
+-----------
+
+Storages that can hand out expiring download links have a
+``signed_url(name, expires=None, filename=None, content_type=None)``
+method. ``core.objectstorage`` implements it for S3-compatible stores.
+``SignedFileSystemStorage`` emulates it on the local filesystem: its links
+point at ``/storage/<token>/<filename>``, where the token is signed with
+``SECRET_KEY`` and served by the ``signed_media`` view.
+"""
+import gzip
+import hashlib
+import os
+import re
+import tempfile
+import time
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core import signing
+from django.core.files.storage import FileSystemStorage, storages
+from django.urls import reverse
+from django.utils.deconstruct import deconstructible
+
+from . import assets
+
+try:
+    import brotli
+except ImportError:  # optional: only gzip variants are written without it
+    brotli = None
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+SIGNED_URL_SALT = 'core.storage.signed_url'
+
+BLOB_NAME_RE = re.compile(r'(?:^|/)[0-9a-f]{2}/[0-9a-f]{2}/(?P<digest>[0-9a-f]{64})(?:\.[\w]+)?$')
+
+
+def content_hash(name):
+    """Return the SHA-256 encoded in a blob name, or ``None`` for other files."""
+    match = BLOB_NAME_RE.search(name or '')
+    return match.group('digest') if match else None
+
+
+class _HashedTemporaryFile(File):
+    """A spooled-to-disk copy of an upload that storage can move into place."""
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+class ContentAddressedMixin:
+    """Storage mixin that names files after the SHA-256 of their content.
+
+    The requested name only contributes its extension. Content is read in
+    chunks and hashed in the same pass that copies it to a temporary file, so
+    even very large uploads are never held in memory.
+    """
+
+    prefix = 'blobs'
+
+    def __init__(self, *args, prefix=None, **kwargs):
+        if prefix is not None:
+            self.prefix = prefix.strip('/')
+        super().__init__(*args, **kwargs)
+
+    def blob_name(self, digest, extension=''):
+        return f'{self.prefix}/{digest[:2]}/{digest[2:4]}/{digest}{extension.lower()}'
+
+    def get_available_name(self, name, max_length=None):
+        # Names are derived from content, so an existing name already holds
+        # the same bytes; never rename.
+        return name
+
+    def _save(self, name, content):
+        extension = os.path.splitext(name)[1][:16]
+        digest = hashlib.sha256()
+        if hasattr(content, 'seek'):
+            content.seek(0)
+
+        if hasattr(content, 'temporary_file_path'):
+            # Already on disk (large uploads): hash it, then let storage move it
+            for chunk in content.chunks(HASH_CHUNK_SIZE):
+                digest.update(chunk)
+            content.seek(0)
+            return self._store_blob(self.blob_name(digest.hexdigest(), extension), content)
+
+        temp_dir = getattr(settings, 'FILE_UPLOAD_TEMP_DIR', None)
+        with tempfile.NamedTemporaryFile(dir=temp_dir, delete=False) as spool:
+            try:
+                for chunk in content.chunks(HASH_CHUNK_SIZE):
+                    digest.update(chunk)
+                    spool.write(chunk)
+                spool.flush()
+                spool.seek(0)
+                return self._store_blob(self.blob_name(digest.hexdigest(), extension), _HashedTemporaryFile(spool))
+            finally:
+                if os.path.exists(spool.name):
+                    os.unlink(spool.name)
+
+    def _store_blob(self, target, content):
+        if self.exists(target):
+            return target
+        return super()._save(target, content)
+
+
+@deconstructible
+class SignedFileSystemStorage(FileSystemStorage):
+    """Filesystem storage with expiring download links, like an object store's.
+
+    ``alias`` must be the storage's key in ``STORAGES`` so the link can name
+    it. Expiry times are rounded up to ``url_window`` seconds, so a file's
+    link stays the same for that long and browsers can reuse cached bytes.
+    """
+
+    def __init__(self, *args, alias='default', signed_url_expires=300, url_window=60, **kwargs):
+        self.alias = alias
+        self.signed_url_expires = signed_url_expires
+        self.url_window = url_window
+        super().__init__(*args, **kwargs)
+
+    def signed_url(self, name, expires=None, filename=None, content_type=None):
+        expires_at = int(time.time()) + (expires or self.signed_url_expires)
+        if self.url_window:
+            expires_at += -expires_at % self.url_window
+        payload = {'s': self.alias, 'n': name, 'e': expires_at}
+        if content_type:
+            payload['t'] = content_type
+        # A plain Signer: a timestamped one would change the link every second
+        token = signing.Signer(salt=SIGNED_URL_SALT).sign_object(payload, compress=True)
+        filename = filename or os.path.basename(name)
+        return reverse('signed_media', kwargs={'token': token, 'filename': filename})
+
+
+def load_signed_url(token):
+    """Return ``(storage, name, expires_at, content_type)`` of a ``SignedFileSystemStorage`` token.
+
+    Raises ``signing.BadSignature`` for tampered or expired tokens.
+    """
+    payload = signing.Signer(salt=SIGNED_URL_SALT).unsign_object(token)
+    if payload['e'] < time.time():
+        raise signing.BadSignature('Signed URL expired')
+    return storages[payload['s']], payload['n'], payload['e'], payload.get('t')
+
+
+def signed_url(fieldfile, filename=None, content_type=None, expires=None):
+    """An expiring direct-download URL of ``fieldfile``, or ``None`` if its storage has none."""
+    sign = getattr(fieldfile.storage, 'signed_url', None)
+    if not fieldfile or sign is None:
+        return None
+    return sign(fieldfile.name, expires=expires, filename=filename, content_type=content_type)
+
+
+class ContentAddressedStorage(ContentAddressedMixin, SignedFileSystemStorage):
+    """Content-addressed blobs on the local filesystem (``MEDIA_ROOT``)."""
+
+    def __init__(self, *args, **kwargs):
+        # Two uploads of the same bytes may race to the same path; either wins
+        kwargs.setdefault('allow_overwrite', True)
+        super().__init__(*args, **kwargs)
+
+
+def blob_storage():
+    """Storage for ``Book.file`` and ``Book.cover_image`` (the ``blobs`` alias)."""
+    return storages['blobs']
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """Manifest storage that also bundles CSS and precompresses output.
+
+    During ``collectstatic`` the ``STATIC_BUNDLES`` are concatenated and
+    minified first, so they are fingerprinted like any other file. Every
+    hashed text asset then gets ``.gz`` (and, when the optional ``brotli``
+    package is installed, ``.br``) siblings, so nothing is compressed at
+    request time.
+    """
+
+    manifest_strict = False
+    compressible_extensions = ('.css', '.js', '.mjs', '.map', '.json', '.svg', '.txt', '.xml', '.html')
+    min_compress_size = 512
+
+    def post_process(self, paths, dry_run=False, **options):
+        if not dry_run:
+            self.write_bundles(paths)
+
+        hashed_names = []
+        for name, hashed_name, processed in super().post_process(paths, dry_run, **options):
+            if hashed_name and not isinstance(processed, Exception):
+                hashed_names.append(hashed_name)
+            yield name, hashed_name, processed
+
+        if not dry_run:
+            for hashed_name in dict.fromkeys(hashed_names):
+                self.write_compressed(hashed_name)
+
+    def write_bundles(self, paths):
+        def read(path):
+            storage, source_path = paths[path]
+            with storage.open(source_path) as source:
+                return source.read().decode('utf-8')
+
+        for bundle, sources in assets.bundles().items():
+            missing = [path for path in sources if path not in paths]
+            if missing:
+                raise ValueError(f"Bundle {bundle} refers to missing files: {', '.join(missing)}")
+            if self.exists(bundle):
+                self.delete(bundle)
+            self._save(bundle, ContentFile(assets.build_bundle(sources, read).encode('utf-8')))
+            paths[bundle] = (self, bundle)
+
+    def write_compressed(self, name):
+        if not name.endswith(self.compressible_extensions) or not self.exists(name):
+            return
+        with self.open(name) as original:
+            data = original.read()
+        if len(data) < self.min_compress_size:
+            return
+        variants = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            variants['.br'] = brotli.compress(data, quality=11)
+        for suffix, compressed in variants.items():
+            if len(compressed) >= len(data):
+                continue
+            if self.exists(name + suffix):
+                self.delete(name + suffix)
+            self._save(name + suffix, ContentFile(compressed))
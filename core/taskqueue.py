@@ -0,0 +1,241 @@
+"""
+A small database-backed task queue.
+
+Functions decorated with :func:`task` gain a ``delay()`` method that stores
+the call as a :class:`core.models.Task` row instead of running it. Rows are
+picked up by ``manage.py run_workers``, which needs nothing but the database:
+no broker and no extra services.
+
+Because tasks live in the same database as everything else, a task queued
+inside a transaction only becomes visible to workers once that transaction
+commits. Identical calls (same task and arguments) are de-duplicated while
+they are still pending. Failures are retried with exponential backoff.
+"""
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+TASK_QUEUE_DEFAULTS = {
+    # Run tasks inline (after commit) instead of queueing them
+    'EAGER': False,
+    'MAX_ATTEMPTS': 3,
+    # Seconds before the first retry; doubled on every further attempt
+    'RETRY_DELAY': 10,
+    'MAX_RETRY_DELAY': 3600,
+    # Seconds after which a running task whose worker died is picked up again
+    'VISIBILITY_TIMEOUT': 600,
+}
+
+_registry = {}
+
+
+def queue_settings():
+    return {**TASK_QUEUE_DEFAULTS, **getattr(settings, 'TASK_QUEUE', {})}
+
+
+def task(func=None, *, name=None, max_attempts=None, retry_delay=None):
+    """Register ``func`` as a background task.
+
+    The function can still be called directly; ``func.delay(*args, **kwargs)``
+    queues it instead and ``func.delay_many(calls)`` queues a batch of
+    positional argument tuples. Arguments must be JSON serializable.
+    """
+    def decorate(func):
+        func.task_name = name or f'{func.__module__}.{func.__qualname__}'
+        func.max_attempts = max_attempts
+        func.retry_delay = retry_delay
+        func.delay = lambda *args, **kwargs: enqueue(func, *args, **kwargs)
+        func.delay_many = lambda calls: enqueue_many(func, calls)
+        _registry[func.task_name] = func
+        return func
+
+    if func is not None:
+        return decorate(func)
+    return decorate
+
+
+def get_task(name):
+    if name not in _registry:
+        # Importing the task's module registers it
+        import_string(name)
+    return _registry[name]
+
+
+def dedup_key(name, args, kwargs):
+    payload = json.dumps([name, args, kwargs], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def enqueue(func, *args, **kwargs):
+    """Queue a call to a registered task and return its ``Task`` row.
+
+    If an identical call is already pending, that row is returned instead.
+    """
+    from .models import Task
+
+    config = queue_settings()
+    args, kwargs = list(args), dict(kwargs)
+    if config['EAGER']:
+        transaction.on_commit(lambda: func(*args, **kwargs))
+        return None
+
+    key = dedup_key(func.task_name, args, kwargs)
+    try:
+        with transaction.atomic():
+            return Task.objects.create(
+                name=func.task_name,
+                args=args,
+                kwargs=kwargs,
+                dedup_key=key,
+                max_attempts=func.max_attempts or config['MAX_ATTEMPTS'],
+            )
+    except IntegrityError:
+        return Task.objects.filter(dedup_key=key, status='pending').first()
+
+
+def enqueue_many(func, calls):
+    """Queue many calls to ``func`` with a single INSERT.
+
+    ``calls`` yields argument tuples. Calls identical to one already pending
+    are skipped. Returns the number of calls considered.
+    """
+    from .models import Task
+
+    config = queue_settings()
+    calls = [list(args) for args in calls]
+    if config['EAGER']:
+        for args in calls:
+            transaction.on_commit(lambda args=args: func(*args))
+        return len(calls)
+
+    max_attempts = func.max_attempts or config['MAX_ATTEMPTS']
+    Task.objects.bulk_create(
+        [
+            Task(name=func.task_name, args=args, kwargs={}, dedup_key=dedup_key(func.task_name, args, {}),
+                 max_attempts=max_attempts)
+            for args in calls
+        ],
+        batch_size=500,
+        ignore_conflicts=True,
+    )
+    return len(calls)
+
+
+def retry_delay(func, attempts):
+    config = queue_settings()
+    base = getattr(func, 'retry_delay', None)
+    if base is None:
+        base = config['RETRY_DELAY']
+    return timedelta(seconds=min(base * 2 ** max(attempts - 1, 0), config['MAX_RETRY_DELAY']))
+
+
+def worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+def release_expired():
+    """Return tasks held by workers that died mid-run to the pending state."""
+    from .models import Task
+
+    cutoff = timezone.now() - timedelta(seconds=queue_settings()['VISIBILITY_TIMEOUT'])
+    for task_row in Task.objects.filter(status='running', locked_at__lt=cutoff):
+        try:
+            with transaction.atomic():
+                Task.objects.filter(pk=task_row.pk, status='running').update(status='pending', locked_by='')
+        except IntegrityError:
+            # An identical call was queued meanwhile and will do the same work
+            task_row.delete()
+
+
+def claim(limit, owner):
+    """Atomically take up to ``limit`` due tasks and return them."""
+    from .models import Task
+
+    now = timezone.now()
+    candidates = Task.objects.filter(status='pending', run_at__lte=now).values_list('pk', flat=True)[:limit * 2]
+    claimed = []
+    for pk in candidates:
+        # The status guard makes the UPDATE a compare-and-set between workers
+        updated = Task.objects.filter(pk=pk, status='pending').update(
+            status='running', locked_by=owner, locked_at=now, attempts=F('attempts') + 1,
+        )
+        if updated:
+            claimed.append(pk)
+            if len(claimed) >= limit:
+                break
+    return list(Task.objects.filter(pk__in=claimed))
+
+
+def execute(task_row):
+    """Run a claimed task, then delete it or schedule a retry."""
+    from .models import Task
+
+    close_old_connections()
+    try:
+        func = get_task(task_row.name)
+        func(*task_row.args, **task_row.kwargs)
+    except Exception:
+        error = traceback.format_exc()
+        logger.exception('Task %s (%s) failed', task_row.name, task_row.pk)
+        if task_row.attempts >= task_row.max_attempts:
+            Task.objects.filter(pk=task_row.pk).update(status='failed', last_error=error)
+            return False
+        delay = retry_delay(_registry.get(task_row.name), task_row.attempts)
+        try:
+            with transaction.atomic():
+                Task.objects.filter(pk=task_row.pk).update(
+                    status='pending', locked_by='', run_at=timezone.now() + delay, last_error=error,
+                )
+        except IntegrityError:
+            Task.objects.filter(pk=task_row.pk).delete()
+        return False
+    else:
+        Task.objects.filter(pk=task_row.pk).delete()
+        return True
+    finally:
+        close_old_connections()
+
+
+def run_worker(threads=4, poll_interval=1.0, burst=False, stop_event=None):
+    """Claim and run tasks on a pool of ``threads`` until stopped.
+
+    With ``burst`` the worker exits as soon as no task is due.
+    """
+    stop_event = stop_event or threading.Event()
+    owner = f'{socket.gethostname()}:{os.getpid()}'
+    running = set()
+    last_release = 0.0
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while not stop_event.is_set():
+            if time.monotonic() - last_release > 60:
+                release_expired()
+                last_release = time.monotonic()
+
+            running = {future for future in running if not future.done()}
+            free = threads - len(running)
+            claimed = claim(free, owner) if free else []
+            for task_row in claimed:
+                running.add(pool.submit(execute, task_row))
+
+            if not claimed:
+                if burst and not running:
+                    break
+                stop_event.wait(poll_interval)
+        wait(running)
+    close_old_connections()
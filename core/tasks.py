@@ -0,0 +1,40 @@
+"""Background tasks run by ``manage.py run_workers``."""
+from django.core.files.storage import default_storage
+
+from . import prefetch, reflow
+from .models import Book
+from .taskqueue import task
+
+
+@task
+def update_book_rating(book_id):
+    """Recompute a book's average rating and review count."""
+    book = Book.objects.filter(pk=book_id).first()
+    if book is not None:
+        book.update_rating()
+
+
+@task
+def delete_stored_file(name):
+    """Remove a file that is no longer referenced from storage."""
+    if name and default_storage.exists(name):
+        default_storage.delete(name)
+
+
+@task(max_attempts=2)
+def ingest_book(book_id):
+    """Split an EPUB/TXT book into reader chunks."""
+    book = Book.objects.filter(pk=book_id).first()
+    if book is None or not book.file or not reflow.is_reflowable(book):
+        return
+    try:
+        reflow.ingest_book(book)
+    except reflow.IngestError:
+        # Retrying will not fix a malformed file; the reader offers a download
+        pass
+
+
+@task
+def merge_page_stats(samples, batch=None):
+    """Add page-turn counts buffered by ``core.prefetch`` to the books' stats."""
+    prefetch.merge(samples)
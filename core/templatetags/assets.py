@@ -0,0 +1,52 @@
+import logging
+
+from django import template
+from django.conf import settings
+from django.templatetags.static import static
+from django.utils.html import format_html, format_html_join
+
+from core import assets
+
+logger = logging.getLogger(__name__)
+
+register = template.Library()
+
+
+@register.simple_tag
+def stylesheet_bundle(name):
+    """Link a CSS bundle, or its individual sources while debugging."""
+    sources = assets.bundles()[name]
+    if settings.DEBUG:
+        return format_html_join('\n', '<link rel="stylesheet" href="{}">', ((static(path),) for path in sources))
+    return format_html('<link rel="stylesheet" href="{}">', static(name))
+
+
+def _vendor_url(package, filename):
+    if assets.is_vendored(package, filename):
+        return static(assets.vendor_path(package, filename))
+    if not settings.DEBUG:
+        logger.warning('%s is not vendored; serving it from upstream', assets.vendor_path(package, filename))
+    return assets.vendor_source_url(package, filename)
+
+
+@register.simple_tag
+def vendor_static(package, filename):
+    """URL of a vendored third-party file.
+
+    A file that ``manage.py vendor_assets`` has not fetched yet comes from
+    upstream, which ``check --deploy`` reports (``core.E001``).
+    """
+    return _vendor_url(package, filename)
+
+
+@register.simple_tag
+def vendor_script(package, filename):
+    """``<script>`` tag for a vendored file, pinned to its locked SRI digest."""
+    url = _vendor_url(package, filename)
+    integrity = assets.vendor_integrity(package, filename)
+    if not integrity:
+        return format_html('<script src="{}" crossorigin="anonymous" referrerpolicy="no-referrer"></script>', url)
+    return format_html(
+        '<script src="{}" integrity="{}" crossorigin="anonymous" referrerpolicy="no-referrer"></script>',
+        url, integrity,
+    )
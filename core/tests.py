@@ -1,3 +1,1873 @@
-from django.test import TestCase
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from datetime import date, timedelta
+from xml.etree import ElementTree
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import signing
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.checks import run_checks
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.db import connection
+from django.http import HttpResponse, StreamingHttpResponse
+from django.template import Context, Template
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from django.utils import timezone
+
+from . import (
+    assets, export, facets, library_import, prefetch, profiling, querylog, reflow, sharding, startup, taskqueue,
+    throttle,
+)
+from .admin import EstimatedCountPaginator
+from .auth import user_cache_key
+from .catalog import LAST_MODIFIED_KEY, catalog_last_modified, touch_catalog
+from .http import parse_range, serve_file, suggested_ranges
+from .storage import SIGNED_URL_SALT, load_signed_url
+from .middleware import AnonymousPageCacheMiddleware
+from .models import (
+    ArchivedReadingProgress, Author, Blob, Book, Bookmark, CatalogStamp, Genre, PageAccessStats, ReadingProgress,
+    Review, Task, UserProfile, UserShard,
+)
+
+SHARDS = ['shard1', 'shard2']
+# Only configured aliases: Django resolves ``databases`` before any skip applies
+DATABASES = {'default', *(alias for alias in SHARDS if alias in settings.DATABASES)}
+
+
+@skipUnless(set(SHARDS) <= set(settings.DATABASES), 'Run with --settings=bookreader.test_settings')
+class ShardedTestCase(TestCase):
+    databases = DATABASES
+
+    def setUp(self):
+        # Placements are cached, and user ids come back after each rollback
+        cache.clear()
+        author = Author.objects.create(name='Author')
+        self.books = [
+            Book.objects.create(title=f'Book {number}', author=author, isbn=f'978000000000{number}')
+            for number in range(3)
+        ]
+
+    def make_user(self, username, shard=None):
+        """A user, placed on ``shard`` instead of their ring position if given."""
+        user = User.objects.create_user(username, f'{username}@example.com', 'password')
+        if shard:
+            UserShard.objects.update_or_create(user=user, defaults={'shard': shard})
+            sharding.forget_user(user.pk)
+        return user
+
+    def other_shard(self, alias):
+        return next(shard for shard in SHARDS if shard != alias)
+
+    def rows(self, user, alias):
+        return {
+            'progress': set(ReadingProgress.objects.using(alias).filter(user=user)
+                            .values_list('book_id', 'current_page', 'is_completed', 'last_read')),
+            'archived': set(ArchivedReadingProgress.objects.using(alias).filter(user=user)
+                            .values_list('book_id', 'current_page', 'last_read', 'archived_at')),
+            'bookmarks': set(Bookmark.objects.using(alias).filter(user=user)
+                             .values_list('book_id', 'created_at')),
+        }
+
+    def add_rows(self, user):
+        using = sharding.user_database(user)
+        ReadingProgress.objects.using(using).create(user=user, book=self.books[0], current_page=12)
+        ReadingProgress.objects.using(using).create(user=user, book=self.books[1], current_page=300, is_completed=True)
+        long_ago = timezone.now() - timedelta(days=400)
+        ArchivedReadingProgress.objects.using(using).create(user=user, book=self.books[2], current_page=7,
+                                                            last_read=long_ago, created_at=long_ago)
+        Bookmark.objects.using(using).create(user=user, book=self.books[0])
+
+
+class HashRingTests(SimpleTestCase):
+    def test_placement_is_stable(self):
+        ring = sharding.HashRing(SHARDS, 128)
+        self.assertEqual([ring.shard(user_id) for user_id in range(100)],
+                         [sharding.HashRing(SHARDS, 128).shard(user_id) for user_id in range(100)])
+
+    def test_new_shard_only_takes_users(self):
+        before = sharding.HashRing(SHARDS, 128)
+        after = sharding.HashRing(SHARDS + ['shard3'], 128)
+        moved = [user_id for user_id in range(3000) if before.shard(user_id) != after.shard(user_id)]
+        self.assertTrue(all(after.shard(user_id) == 'shard3' for user_id in moved))
+        self.assertAlmostEqual(len(moved) / 3000, 1 / 3, delta=0.1)
+
+    def test_needs_a_shard(self):
+        with self.assertRaises(ValueError):
+            sharding.HashRing([], 128)
+
+
+class UserShardRouterTests(ShardedTestCase):
+    def test_rows_follow_the_users_shard(self):
+        for alias in SHARDS:
+            user = self.make_user(f'reader-{alias}', shard=alias)
+            progress = ReadingProgress(user=user, book=self.books[0], current_page=3)
+            progress.save()
+            self.assertEqual(progress._state.db, alias)
+            self.assertEqual(user.reading_progress.get().pk, progress.pk)
+            self.assertEqual(user.bookmarks.all().db, alias)
+            self.assertFalse(ReadingProgress.objects.using(self.other_shard(alias)).filter(user=user).exists())
+
+    def test_catalog_tables_stay_on_the_catalog_database(self):
+        router = sharding.UserShardRouter()
+        self.assertEqual(router.db_for_write(Book, instance=self.books[0]), 'default')
+        self.assertEqual(router.db_for_read(User), 'default')
+        self.assertIsNone(router.db_for_read(ReadingProgress))
+
+    def test_migrations(self):
+        router = sharding.UserShardRouter()
+        for alias in SHARDS:
+            self.assertTrue(router.allow_migrate(alias, 'core', 'bookmark'))
+            self.assertFalse(router.allow_migrate(alias, 'core', 'book'))
+            self.assertFalse(router.allow_migrate(alias, 'auth', 'user'))
+        self.assertFalse(router.allow_migrate('default', 'core', 'readingprogress'))
+        self.assertIsNone(router.allow_migrate('default', 'core', 'book'))
+
+
+class PlacementTests(ShardedTestCase):
+    def test_first_lookup_records_the_ring_position(self):
+        user = self.make_user('reader')
+        alias = sharding.user_database(user)
+        self.assertEqual(alias, sharding.ring().shard(user.pk))
+        self.assertEqual(UserShard.objects.get(user=user).shard, alias)
+
+    def test_recorded_shard_wins_over_the_ring(self):
+        user = self.make_user('reader')
+        other = self.other_shard(sharding.ring().shard(user.pk))
+        UserShard.objects.create(user=user, shard=other)
+        self.assertEqual(sharding.user_database(user), other)
+
+    def test_lookups_are_cached_until_forgotten(self):
+        user = self.make_user('reader')
+        alias = sharding.user_database(user)
+        UserShard.objects.filter(user=user).update(shard=self.other_shard(alias))
+        with self.assertNumQueries(0):
+            self.assertEqual(sharding.user_database(user.pk), alias)
+        sharding.forget_user(user.pk)
+        self.assertEqual(sharding.user_database(user.pk), self.other_shard(alias))
+
+
+class RebalanceTests(ShardedTestCase):
+    def misplaced_user(self, username):
+        """A user with rows on the shard their ring position does not point at."""
+        user = self.make_user(username)
+        source = self.other_shard(sharding.ring().shard(user.pk))
+        UserShard.objects.create(user=user, shard=source)
+        self.add_rows(user)
+        return user, source, sharding.ring().shard(user.pk)
+
+    def test_rows_move_intact(self):
+        user, source, target = self.misplaced_user('reader')
+        before = self.rows(user, source)
+
+        call_command('rebalance_shards', grace=0, stdout=mock.Mock())
+
+        self.assertEqual(self.rows(user, target), before)
+        self.assertEqual(self.rows(user, source), {'progress': set(), 'archived': set(), 'bookmarks': set()})
+        placement = UserShard.objects.get(user=user)
+        self.assertEqual((placement.shard, placement.previous_shard), (target, ''))
+        self.assertEqual(sharding.user_database(user), target)
+
+    def test_only_misplaced_users_move(self):
+        user, source, target = self.misplaced_user('moving')
+        settled = self.make_user('settled')
+        home = sharding.user_database(settled)
+        ReadingProgress.objects.using(home).create(user=settled, book=self.books[0], current_page=5)
+
+        call_command('rebalance_shards', grace=0, stdout=mock.Mock())
+
+        self.assertEqual(sharding.user_database(user), target)
+        self.assertEqual(ReadingProgress.objects.using(home).get(user=settled).current_page, 5)
+
+    def test_writes_during_the_move_are_kept(self):
+        user, source, target = self.misplaced_user('reader')
+        progress = ReadingProgress.objects.using(source).get(user=user, book=self.books[0])
+
+        def write_with_stale_placement(seconds):
+            # A worker that still has the old shard cached keeps writing there
+            progress.current_page = 40
+            progress.save(using=source)
+            Bookmark.objects.using(source).create(user=user, book=self.books[1])
+            Bookmark.objects.using(source).filter(user=user, book=self.books[0]).delete()
+
+        with mock.patch('core.management.commands.rebalance_shards.time.sleep', write_with_stale_placement):
+            call_command('rebalance_shards', grace=1, stdout=mock.Mock())
+
+        self.assertEqual(ReadingProgress.objects.using(target).get(user=user, book=self.books[0]).current_page, 40)
+        self.assertEqual(set(Bookmark.objects.using(target).filter(user=user).values_list('book_id', flat=True)),
+                         {self.books[1].pk})
+        self.assertFalse(ReadingProgress.objects.using(source).filter(user=user).exists())
+
+    def test_interrupted_moves_are_finished(self):
+        user, source, target = self.misplaced_user('reader')
+        before = self.rows(user, source)
+        sharding.copy_user_rows(user.pk, source, target)
+        UserShard.objects.filter(user=user).update(shard=target, previous_shard=source, moved_at=timezone.now())
+        ReadingProgress.objects.using(source).filter(user=user, book=self.books[1]).update(
+            current_page=301, last_read=timezone.now() + timedelta(seconds=1),
+        )
+
+        call_command('rebalance_shards', grace=0, stdout=mock.Mock())
+
+        after = self.rows(user, target)
+        self.assertEqual(after['bookmarks'], before['bookmarks'])
+        self.assertEqual(ReadingProgress.objects.using(target).get(user=user, book=self.books[1]).current_page, 301)
+        self.assertEqual(UserShard.objects.get(user=user).previous_shard, '')
+        self.assertFalse(Bookmark.objects.using(source).filter(user=user).exists())
+
+
+class CascadeTests(ShardedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.readers = [self.make_user(f'reader-{alias}', shard=alias) for alias in SHARDS]
+        for user in self.readers:
+            self.add_rows(user)
+
+    def test_deleting_a_book_removes_its_rows_on_every_shard(self):
+        book_id = self.books[0].pk
+        self.books[0].delete()
+        for alias in SHARDS:
+            self.assertFalse(ReadingProgress.objects.using(alias).filter(book_id=book_id).exists())
+        for user, alias in zip(self.readers, SHARDS):
+            self.assertFalse(Bookmark.objects.using(alias).filter(user=user).exists())
+            self.assertEqual(ReadingProgress.objects.using(alias).filter(user=user).count(), 1)
+
+    def test_deleting_a_user_removes_their_rows(self):
+        user, alias = self.readers[0], SHARDS[0]
+        user_id = user.pk
+        user.delete()
+        self.assertEqual(self.rows(user_id, alias), {'progress': set(), 'archived': set(), 'bookmarks': set()})
+        self.assertTrue(ReadingProgress.objects.using(SHARDS[1]).filter(user=self.readers[1]).exists())
+
+    def test_deleting_a_user_mid_move_clears_both_shards(self):
+        user = self.readers[0]
+        user_id = user.pk
+        sharding.copy_user_rows(user_id, SHARDS[0], SHARDS[1])
+        UserShard.objects.filter(user=user).update(shard=SHARDS[1], previous_shard=SHARDS[0])
+        user.delete()
+        for alias in SHARDS:
+            self.assertFalse(ReadingProgress.objects.using(alias).filter(user_id=user_id).exists())
+            self.assertFalse(ArchivedReadingProgress.objects.using(alias).filter(user_id=user_id).exists())
+
+
+class LibraryTestCase(TestCase):
+    """Books, readers and stored files, in a temporary ``MEDIA_ROOT``."""
+    databases = DATABASES
+
+    @classmethod
+    def setUpClass(cls):
+        media_root = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        cls.enterClassContext(override_settings(
+            MEDIA_ROOT=media_root,
+            # Pages render with DEBUG off, before any collectstatic
+            STORAGES={**settings.STORAGES,
+                      'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'}},
+        ))
+        super().setUpClass()
+
+    def setUp(self):
+        # Manifests, placements and stamps are cached by ids that come back after each rollback
+        cache.clear()
+        self.author = Author.objects.create(name='Author')
+
+    def make_book(self, title, data=None, format='pdf', **fields):
+        fields.setdefault('isbn', f'978{Book.objects.count():010d}')
+        book = Book(title=title, author=fields.pop('author', self.author), format=format, **fields)
+        book.file.save(f'{book.slug or title.lower()}.{format}', ContentFile(data or b'%PDF-1.4 book'), save=False)
+        book.save()
+        return book
+
+    def make_reader(self, username='reader'):
+        user = User.objects.create_user(username, f'{username}@example.com', 'password')
+        self.client.force_login(user)
+        return user
+
+
+def make_epub():
+    """A two-chapter EPUB with an image, script and event handlers to sanitize."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr('mimetype', 'application/epub+zip')
+        archive.writestr('META-INF/container.xml', (
+            '<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+            '<rootfiles><rootfile full-path="OEBPS/content.opf"/></rootfiles></container>'
+        ))
+        archive.writestr('OEBPS/content.opf', (
+            '<package xmlns="http://www.idpf.org/2007/opf"><manifest>'
+            '<item id="one" href="one.xhtml"/><item id="two" href="two.xhtml"/><item id="notes" href="notes.xhtml"/>'
+            '</manifest><spine><itemref idref="one"/><itemref idref="notes" linear="no"/><itemref idref="two"/>'
+            '</spine></package>'
+        ))
+        archive.writestr('OEBPS/one.xhtml', (
+            '<html><head><title>One</title><script>alert(1)</script></head><body>'
+            '<h1 onclick="steal()">Chapter One</h1><p>Hello <a href="javascript:steal()">there</a></p>'
+            '<img src="images/map.png" alt="Map"/></body></html>'
+        ))
+        archive.writestr('OEBPS/two.xhtml', '<html><body><p>Second</p><img src="missing.png"/></body></html>')
+        archive.writestr('OEBPS/notes.xhtml', '<html><body><p>Notes</p></body></html>')
+        archive.writestr('OEBPS/images/map.png', b'\x89PNG\r\n\x1a\nmap')
+    return buffer.getvalue()
+
+
+class SanitizerTests(SimpleTestCase):
+    def test_scripts_handlers_and_unsafe_links_are_dropped(self):
+        html, title = reflow.sanitize_html(
+            '<script>alert(1)</script><h2 onclick="x()">A <em>Title</em></h2>'
+            '<p style="color:red">Text <a href="javascript:x()">bad</a> <a href="https://example.com">good</a></p>'
+            '<iframe src="https://example.com"><p>framed</p></iframe>'
+        )
+        self.assertEqual(title, 'A Title')
+        self.assertEqual(html, '<h2>A <em>Title</em></h2><p>Text <a>bad</a> <a href="https://example.com">good</a></p>')
+
+    def test_images_are_kept_only_when_resolved(self):
+        html, _ = reflow.sanitize_html('<img src="a.png" alt="A"><img src="b.png">',
+                                       resolve_src=lambda src: '/a' if src == 'a.png' else None)
+        self.assertEqual(html, '<img src="/a" alt="A"><img>')
+
+    def test_text_is_escaped(self):
+        html, _ = reflow.sanitize_html('<p>&lt;script&gt; &amp; "quotes"</p>')
+        self.assertEqual(html, '<p>&lt;script&gt; &amp; "quotes"</p>')
+
+    def test_text_is_split_between_paragraphs(self):
+        pages = reflow.split_text('\n\n'.join(['a' * 40, 'b' * 40, 'c' * 40]), size=100)
+        self.assertEqual(pages, [['a' * 40, 'b' * 40], ['c' * 40]])
+        self.assertEqual(reflow.split_text('one paragraph longer than the page', size=5),
+                         [['one paragraph longer than the page']])
+
+
+class ReflowTests(LibraryTestCase):
+    def test_epub_spine_becomes_sanitized_chunks(self):
+        book = self.make_book('Reflowed', make_epub(), format='epub')
+        manifest = reflow.ingest_book(book)
+
+        self.assertEqual([chunk['title'] for chunk in manifest['chunks']], ['Chapter One', 'Section 2'])
+        self.assertEqual(Book.objects.get(pk=book.pk).page_count, 2)
+        first = reflow.read_chunk(book, 1).decode()
+        self.assertNotIn('script', first)
+        self.assertNotIn('onclick', first)
+        self.assertNotIn('javascript', first)
+        self.assertEqual(reflow.read_chunk(book, 2).decode(), '<p>Second</p><img>')
+        self.assertEqual(reflow.load_manifest(book), manifest)
+
+    def test_txt_is_split_into_pages(self):
+        text = '\n\n'.join(f'Paragraph {number} ' + 'word ' * 400 for number in range(6))
+        book = self.make_book('Plain', text.encode(), format='txt')
+        manifest = reflow.ingest_book(book)
+        self.assertEqual(len(manifest['chunks']), 3)
+        self.assertEqual(manifest['chunks'][0]['title'], 'Page 1')
+        self.assertTrue(reflow.read_chunk(book, 1).startswith(b'<p>Paragraph 0 word'))
+
+    def test_unreadable_files_are_rejected(self):
+        book = self.make_book('Broken', b'not a zip', format='epub')
+        with self.assertRaises(reflow.IngestError):
+            reflow.ingest_book(book)
+        self.assertIsNone(reflow.load_manifest(book))
+
+    def test_manifests_of_replaced_files_are_stale(self):
+        book = self.make_book('Replaced', b'First text', format='txt')
+        reflow.ingest_book(book)
+        cache.clear()
+        book.file.save('replaced.txt', ContentFile(b'Second text'), save=False)
+        self.assertIsNone(reflow.load_manifest(book))
+
+    def test_chunks_are_served_with_etags(self):
+        book = self.make_book('Served', make_epub(), format='epub')
+        manifest = reflow.ingest_book(book)
+        url = reverse('book_chunk', kwargs={'slug': book.slug, 'number': 1})
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+        self.make_reader()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, reflow.read_chunk(book, 1))
+        self.assertEqual(response['ETag'], f'"{manifest["chunks"][0]["etag"]}"')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.client.get(reverse('book_chunk', kwargs={'slug': book.slug, 'number': 3})).status_code,
+                         404)
+
+    def test_images_are_served_to_readers_only(self):
+        book = self.make_book('Illustrated', make_epub(), format='epub')
+        reflow.ingest_book(book)
+        src = reflow.read_chunk(book, 1).decode().split('<img src="')[1].split('"')[0]
+        name = src.rsplit('/', 1)[1]
+        self.assertEqual(src, reverse('book_asset', kwargs={'slug': book.slug, 'name': name}))
+        self.assertEqual(self.client.get(src).status_code, 302)
+        self.assertNotIn('/storage/', self.client.get(src)['Location'])
+
+        self.make_reader()
+        response = self.client.get(src)
+        self.assertEqual(response.status_code, 302)
+        image = self.client.get(response['Location'])
+        self.assertEqual(b''.join(image.streaming_content), b'\x89PNG\r\n\x1a\nmap')
+        for name in ('0123456789abcdef.png', 'manifest.json'):
+            self.assertEqual(
+                self.client.get(reverse('book_asset', kwargs={'slug': book.slug, 'name': name})).status_code, 404,
+            )
+
+
+ATOM = {'atom': 'http://www.w3.org/2005/Atom', 'dc': 'http://purl.org/dc/terms/'}
+
+
+class OPDSTests(LibraryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.genre = Genre.objects.create(name='Sea & Sky')
+        self.book = self.make_book('Tides <of> "Time"', description='Waves')
+        self.book.genres.add(self.genre)
+
+    def get_feed(self, url, **headers):
+        response = self.client.get(url, **headers)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, body
+
+    def test_acquisition_feed(self):
+        response, body = self.get_feed(reverse('opds_books'))
+        self.assertEqual(response['Content-Type'], 'application/atom+xml;profile=opds-catalog;kind=acquisition')
+        entry = ElementTree.fromstring(body).find('atom:entry', ATOM)
+        self.assertEqual(entry.findtext('atom:title', namespaces=ATOM), 'Tides <of> "Time"')
+        self.assertEqual(entry.find('atom:category', ATOM).get('label'), 'Sea & Sky')
+        self.assertEqual(entry.findtext('dc:identifier', namespaces=ATOM), f'urn:isbn:{self.book.isbn}')
+        acquisition = entry.find("atom:link[@rel='http://opds-spec.org/acquisition/open-access']", ATOM)
+        self.assertEqual(acquisition.get('href'),
+                         'http://testserver' + reverse('book_file', kwargs={'slug': self.book.slug}))
+        self.assertEqual(acquisition.get('type'), 'application/pdf')
+
+    def test_json_feeds(self):
+        _, body = self.get_feed(reverse('opds_books_json'))
+        publication, = json.loads(body)['publications']
+        self.assertEqual(publication['metadata']['title'], self.book.title)
+        self.assertEqual(publication['metadata']['subject'], [{'name': 'Sea & Sky', 'code': self.genre.slug}])
+
+        _, body = self.get_feed(reverse('opds_genres_json'))
+        link, = json.loads(body)['navigation']
+        self.assertEqual(link['href'], 'http://testserver' + reverse('opds_genre_json', kwargs={'slug': self.genre.slug}))
+
+    def test_navigation_feeds_link_to_their_books(self):
+        _, body = self.get_feed(reverse('opds_authors'))
+        link = ElementTree.fromstring(body).find('atom:entry/atom:link', ATOM)
+        self.assertEqual(link.get('href'), 'http://testserver' + reverse('opds_author', kwargs={'pk': self.author.pk}))
+        _, body = self.get_feed(reverse('opds_author', kwargs={'pk': self.author.pk}))
+        self.assertEqual(len(ElementTree.fromstring(body).findall('atom:entry', ATOM)), 1)
+        self.assertEqual(self.client.get(reverse('opds_genre', kwargs={'slug': 'missing'})).status_code, 404)
+
+    def test_unchanged_catalog_answers_304(self):
+        response, _ = self.get_feed(reverse('opds_books'))
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(reverse('opds_books'), HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get(reverse('opds_books'), HTTP_IF_MODIFIED_SINCE=last_modified).status_code,
+                         304)
+
+        self.make_book('Another')
+        response, _ = self.get_feed(reverse('opds_books'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_queries_do_not_grow_with_the_catalog(self):
+        # The books with their authors, then the genres of each chunk of books
+        with self.assertNumQueries(2):
+            self.get_feed(reverse('opds_books'))
+        for number in range(4):
+            self.make_book(f'More {number}').genres.add(self.genre)
+        with self.assertNumQueries(2):
+            _, body = self.get_feed(reverse('opds_books'))
+        self.assertEqual(len(ElementTree.fromstring(body).findall('atom:entry', ATOM)), 5)
+
+
+class CatalogStatsTests(LibraryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.genre = Genre.objects.create(name='Mystery')
+        self.books = [self.make_book(f'Case {number}') for number in range(3)]
+
+    def stats(self, obj):
+        obj.refresh_from_db()
+        return obj.book_count, float(obj.average_rating)
+
+    def test_counts_follow_books_and_genre_assignments(self):
+        self.assertEqual(self.stats(self.author)[0], 3)
+        self.genre.books.add(*self.books[:2])
+        self.assertEqual(self.stats(self.genre)[0], 2)
+        self.books[2].genres.add(self.genre)
+        self.assertEqual(self.stats(self.genre)[0], 3)
+        self.books[0].genres.remove(self.genre)
+        self.assertEqual(self.stats(self.genre)[0], 2)
+        self.genre.books.clear()
+        self.assertEqual(self.stats(self.genre)[0], 0)
+
+        self.books[1].delete()
+        self.assertEqual(self.stats(self.author)[0], 2)
+
+    def test_ratings_are_weighted_by_review_count(self):
+        self.genre.books.add(*self.books)
+        Book.objects.filter(pk=self.books[0].pk).update(average_rating=5, review_count=3)
+        Book.objects.filter(pk=self.books[1].pk).update(average_rating=1, review_count=1)
+        Author.refresh_stats()
+        Genre.refresh_stats()
+        self.assertEqual(self.stats(self.author), (3, 4.0))
+        self.assertEqual(self.stats(self.genre), (3, 4.0))
+
+    def test_refresh_command_repairs_the_columns(self):
+        Author.objects.update(book_count=0)
+        call_command('refresh_catalog_stats', stdout=io.StringIO())
+        self.assertEqual(self.stats(self.author)[0], 3)
+
+    def test_browse_pages(self):
+        self.genre.books.add(self.books[0])
+        Author.objects.create(name='Unpublished')
+        response = self.client.get(reverse('author_list'))
+        self.assertEqual([author.name for author in response.context['page_obj']], ['Author'])
+        self.assertContains(self.client.get(reverse('genre_list')), 'Mystery')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('genre_detail', kwargs={'slug': self.genre.slug}))
+        self.assertEqual([book.pk for book in response.context['page_obj']], [self.books[0].pk])
+        # The paginator takes the stored count
+        self.assertFalse([query for query in queries if 'COUNT(' in query['sql']])
+
+        response = self.client.get(reverse('author_detail', kwargs={'pk': self.author.pk}))
+        self.assertEqual(response.context['page_obj'].paginator.count, 3)
+
+
+class PageCacheTests(LibraryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.book = self.make_book('Cached')
+        self.url = reverse('book_detail', kwargs={'slug': self.book.slug})
+
+    def test_anonymous_pages_are_served_from_the_cache(self):
+        self.assertEqual(self.client.get(self.url)['X-Page-Cache'], 'MISS')
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Page-Cache'], 'HIT')
+        self.assertContains(response, 'Cached')
+
+    def test_tracking_parameters_share_an_entry(self):
+        self.client.get(self.url, {'page': 1})
+        self.assertEqual(self.client.get(self.url, {'page': 1, 'utm_source': 'mail', 'fbclid': 'x'})['X-Page-Cache'],
+                         'HIT')
+        self.assertEqual(self.client.get(self.url, {'page': 2})['X-Page-Cache'], 'MISS')
+
+    def test_readers_and_errors_bypass_the_cache(self):
+        missing = reverse('book_detail', kwargs={'slug': 'missing'})
+        self.client.get(missing)
+        response = self.client.get(missing)
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn('X-Page-Cache', response)
+
+        self.make_reader()
+        self.client.get(self.url)
+        self.assertNotIn('X-Page-Cache', self.client.get(self.url))
+
+    def test_catalog_changes_mark_pages_stale(self):
+        self.client.get(self.url)
+        Book.objects.filter(pk=self.book.pk).update(title='Renamed')
+        self.book.refresh_from_db()
+        self.book.save()
+
+        # While another request re-renders the page, the stale copy is served
+        key = AnonymousPageCacheMiddleware(lambda request: None).cache_key(RequestFactory().get(self.url))
+        cache.add(f'{key}:lock', 1)
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Page-Cache'], 'STALE')
+        self.assertNotContains(response, 'Renamed')
+
+        cache.delete(f'{key}:lock')
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Page-Cache'], 'MISS')
+        self.assertContains(response, 'Renamed')
+
+
+calls = []
+
+
+@taskqueue.task
+def record_call(*args, **kwargs):
+    calls.append((args, kwargs))
+
+
+@taskqueue.task(max_attempts=2, retry_delay=30)
+def always_fail():
+    raise RuntimeError('boom')
+
+
+# The test transaction must survive the connection checks around each task
+@mock.patch('core.taskqueue.close_old_connections', mock.Mock())
+@override_settings(TASK_QUEUE={'EAGER': False})
+class TaskQueueTests(TestCase):
+    def setUp(self):
+        calls.clear()
+
+    def test_identical_pending_calls_are_queued_once(self):
+        first = record_call.delay(1, page=2)
+        self.assertEqual(record_call.delay(1, page=2), first)
+        record_call.delay(1, page=3)
+        record_call.delay_many([(1,), (4,), (4,)])
+        self.assertEqual(Task.objects.filter(name='core.tests.record_call').count(), 4)
+        self.assertEqual(calls, [])
+
+    def test_eager_tasks_run_after_commit(self):
+        with override_settings(TASK_QUEUE={'EAGER': True}):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertIsNone(record_call.delay(1))
+                self.assertEqual(calls, [])
+        self.assertEqual(calls, [((1,), {})])
+        self.assertFalse(Task.objects.exists())
+
+    def test_claimed_tasks_run_once(self):
+        record_call.delay('a')
+        record_call.delay('b')
+        claimed = taskqueue.claim(10, 'worker')
+        self.assertEqual(taskqueue.claim(10, 'other'), [])
+        self.assertEqual({(row.status, row.attempts, row.locked_by) for row in claimed}, {('running', 1, 'worker')})
+        for row in claimed:
+            self.assertTrue(taskqueue.execute(row))
+        self.assertEqual(sorted(calls), [(('a',), {}), (('b',), {})])
+        self.assertFalse(Task.objects.exists())
+
+    def test_failures_are_retried_with_backoff_then_kept(self):
+        always_fail.delay()
+        row, = taskqueue.claim(1, 'worker')
+        with self.assertLogs('core.taskqueue', 'ERROR'):
+            self.assertFalse(taskqueue.execute(row))
+        row.refresh_from_db()
+        self.assertEqual(row.status, 'pending')
+        self.assertIn('RuntimeError: boom', row.last_error)
+        self.assertAlmostEqual((row.run_at - timezone.now()).total_seconds(), 30, delta=5)
+        self.assertEqual(taskqueue.claim(1, 'worker'), [])
+
+        Task.objects.update(run_at=timezone.now())
+        row, = taskqueue.claim(1, 'worker')
+        with self.assertLogs('core.taskqueue', 'ERROR'):
+            self.assertFalse(taskqueue.execute(row))
+        row.refresh_from_db()
+        self.assertEqual((row.status, row.attempts), ('failed', 2))
+        self.assertEqual(taskqueue.retry_delay(always_fail, 3).total_seconds(), 120)
+
+    def test_tasks_of_dead_workers_are_released(self):
+        record_call.delay('a')
+        taskqueue.claim(1, 'worker')
+        taskqueue.release_expired()
+        self.assertEqual(Task.objects.get().status, 'running')
+        Task.objects.update(locked_at=timezone.now() - timedelta(hours=1))
+        taskqueue.release_expired()
+        self.assertEqual(Task.objects.get().status, 'pending')
+
+
+class CatalogStampTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_first_read_takes_the_latest_change(self):
+        author = Author.objects.create(name='Author')
+        CatalogStamp.objects.all().delete()
+        cache.clear()
+        self.assertEqual(catalog_last_modified(), author.updated_at)
+        self.assertEqual(CatalogStamp.objects.get().modified_at, author.updated_at)
+
+    def test_changes_from_other_processes_are_seen_once_the_cache_expires(self):
+        touch_catalog()
+        stamp = catalog_last_modified()
+        # Another process (a task worker, say) bumps the stamp in its own cache
+        later = stamp + timedelta(seconds=5)
+        CatalogStamp.objects.update(modified_at=later)
+        with self.assertNumQueries(0):
+            self.assertEqual(catalog_last_modified(), stamp)
+        cache.delete(LAST_MODIFIED_KEY)
+        self.assertEqual(catalog_last_modified(), later)
+
+    @override_settings(CATALOG_STAMP_TIMEOUT=5)
+    def test_the_cached_stamp_expires(self):
+        with mock.patch.object(cache, 'set', wraps=cache.set) as cache_set:
+            touch_catalog()
+        cache_set.assert_called_once_with(LAST_MODIFIED_KEY, mock.ANY, 5)
+
+
+class BlobTests(LibraryTestCase):
+    def refs(self, book):
+        return Blob.objects.get(name=book.file.name).ref_count
+
+    def test_identical_uploads_share_a_blob(self):
+        first = self.make_book('First', b'%PDF-1.4 same bytes')
+        second = self.make_book('Second', b'%PDF-1.4 same bytes')
+        digest = hashlib.sha256(b'%PDF-1.4 same bytes').hexdigest()
+        self.assertEqual(first.file.name, f'blobs/{digest[:2]}/{digest[2:4]}/{digest}.pdf')
+        self.assertEqual(second.file.name, first.file.name)
+        self.assertEqual(first.file_hash, digest)
+        self.assertEqual(self.refs(first), 2)
+
+    def test_references_follow_file_changes_and_deletes(self):
+        first = self.make_book('First', b'%PDF-1.4 one')
+        second = self.make_book('Second', b'%PDF-1.4 one')
+        old_name = first.file.name
+        first.file.save('new.pdf', ContentFile(b'%PDF-1.4 two'))
+        self.assertEqual(Blob.objects.get(name=old_name).ref_count, 1)
+        self.assertEqual(self.refs(first), 1)
+
+        second.delete()
+        self.assertEqual(Blob.objects.get(name=old_name).ref_count, 0)
+        # Reloaded books know what they pointed at
+        Book.objects.get(pk=first.pk).delete()
+        self.assertEqual(Blob.objects.get(name=first.file.name).ref_count, 0)
+
+    def test_gc_deletes_only_unreferenced_blobs(self):
+        kept = self.make_book('Kept', b'%PDF-1.4 kept')
+        dropped = self.make_book('Dropped', b'%PDF-1.4 dropped')
+        name = dropped.file.name
+        dropped.delete()
+        orphan = kept.file.storage.save('orphan.pdf', ContentFile(b'%PDF-1.4 orphan'))
+
+        call_command('gc_blobs', grace_hours=0, dry_run=True, stdout=io.StringIO())
+        self.assertTrue(kept.file.storage.exists(name))
+        call_command('gc_blobs', grace_hours=1, stdout=io.StringIO())
+        self.assertTrue(kept.file.storage.exists(name))
+
+        call_command('gc_blobs', grace_hours=0, stdout=io.StringIO())
+        self.assertFalse(kept.file.storage.exists(name))
+        self.assertFalse(kept.file.storage.exists(orphan))
+        self.assertFalse(Blob.objects.filter(name=name).exists())
+        self.assertTrue(kept.file.storage.exists(kept.file.name))
+
+    def test_reconcile_recounts_references(self):
+        book = self.make_book('Counted', b'%PDF-1.4 counted')
+        Blob.objects.all().delete()
+        call_command('gc_blobs', grace_hours=0, reconcile=True, stdout=io.StringIO())
+        self.assertEqual(self.refs(book), 1)
+        self.assertTrue(book.file.storage.exists(book.file.name))
+
+
+class RangeTests(LibraryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.book = self.make_book('Ranged', b'%PDF-1.4 ' + bytes(range(256)) * 4)
+        self.size = self.book.file.size
+
+    def serve(self, **headers):
+        request = RequestFactory().get('/', **headers)
+        response = serve_file(request, self.book.file, etag=self.book.file_hash)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, body
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(parse_range('bytes=900-', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=990-2000', 1000), (990, 999))
+        self.assertIsNone(parse_range('bytes=1000-', 1000))
+        self.assertIsNone(parse_range('bytes=0-1,5-9', 1000))
+
+    def test_whole_file_with_a_strong_etag(self):
+        response, body = self.serve()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.book.file.open('rb').read())
+        self.assertEqual(response['ETag'], f'"{self.book.file_hash}"')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(self.serve(HTTP_IF_NONE_MATCH=response['ETag'])[0].status_code, 304)
+
+    def test_single_ranges(self):
+        response, body = self.serve(HTTP_RANGE='bytes=9-18')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 9-18/{self.size}')
+        self.assertEqual(body, bytes(range(10)))
+
+        response, body = self.serve(HTTP_RANGE='bytes=-4')
+        self.assertEqual(body, bytes([252, 253, 254, 255]))
+
+    def test_unsatisfiable_ranges(self):
+        response, _ = self.serve(HTTP_RANGE=f'bytes={self.size}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{self.size}')
+
+    def test_if_range_with_an_old_validator_gets_the_whole_file(self):
+        response, _ = self.serve(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"outdated"')
+        self.assertEqual(response.status_code, 200)
+        response, _ = self.serve(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=f'"{self.book.file_hash}"')
+        self.assertEqual(response.status_code, 206)
+
+
+class MinifyTests(SimpleTestCase):
+    def test_comments_and_whitespace_go(self):
+        css = '/* note */\n.a  .b ,\n.c > p {\n  color : red;\n  margin: 0 ;\n}\n/*! License */\n'
+        self.assertEqual(assets.minify_css(css), '.a .b,.c>p{color :red;margin:0}/*! License */')
+
+    def test_strings_are_left_alone(self):
+        css = '.a::before { content: "/* not a comment */  ;" }'
+        self.assertEqual(assets.minify_css(css), '.a::before{content:"/* not a comment */  ;"}')
+
+
+@override_settings(
+    STORAGES={**settings.STORAGES, 'staticfiles': {'BACKEND': 'core.storage.CompressedManifestStaticFilesStorage'}},
+    STATICFILES_FINDERS=['django.contrib.staticfiles.finders.FileSystemFinder'],
+)
+class StaticPipelineTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        static_root = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, static_root, ignore_errors=True)
+        cls.enterClassContext(override_settings(STATIC_ROOT=static_root))
+        call_command('collectstatic', interactive=False, verbosity=0)
+
+    def test_bundles_are_minified_and_fingerprinted(self):
+        hashed = staticfiles_storage.stored_name('core/css/site.min.css')
+        self.assertRegex(hashed, r'^core/css/site\.min\.[0-9a-f]{12}\.css$')
+        with staticfiles_storage.open(hashed) as bundle:
+            css = bundle.read().decode()
+        with open(os.path.join(assets.STATIC_DIR, 'core/css/style.css')) as source:
+            self.assertLess(len(css), len(source.read()))
+        self.assertNotIn('\n    ', css)
+
+        html = Template('{% load assets %}{% stylesheet_bundle "core/css/site.min.css" %}').render(Context())
+        self.assertEqual(html, f'<link rel="stylesheet" href="/static/{hashed}">')
+
+    def test_text_assets_are_precompressed(self):
+        hashed = staticfiles_storage.stored_name('core/css/site.min.css')
+        with staticfiles_storage.open(hashed) as original, staticfiles_storage.open(hashed + '.gz') as compressed:
+            self.assertEqual(gzip.decompress(compressed.read()), original.read())
+
+    def test_middleware_serves_the_compressed_variant(self):
+        hashed = staticfiles_storage.stored_name('core/css/site.min.css')
+        response = self.client.get(f'/static/{hashed}', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertIn('Accept-Encoding', response['Vary'])
+
+        response = self.client.get('/static/core/css/style.css')
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+
+
+@override_settings(STORAGES={**settings.STORAGES,
+                             'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'}})
+class VendoredAssetTests(SimpleTestCase):
+    def setUp(self):
+        assets.is_vendored.cache_clear()
+        self.addCleanup(assets.is_vendored.cache_clear)
+
+    def render(self):
+        return Template("{% load assets %}{% vendor_script 'pdfjs' 'pdf.min.js' %}").render(Context())
+
+    def test_vendored_files_are_self_hosted_and_pinned(self):
+        with mock.patch.object(assets, 'is_vendored', return_value=True), \
+                mock.patch.object(assets, 'vendor_integrity', return_value='sha384-abc'):
+            html = self.render()
+        self.assertIn(f'src="/static/{assets.vendor_path("pdfjs", "pdf.min.js")}"', html)
+        self.assertIn('integrity="sha384-abc"', html)
+
+    def test_missing_files_fall_back_upstream_and_fail_the_deploy_check(self):
+        with mock.patch.object(assets, 'is_vendored', return_value=False):
+            with self.assertLogs('core.templatetags.assets', 'WARNING'):
+                html = self.render()
+            errors = run_checks(include_deployment_checks=True, tags=['staticfiles'])
+        self.assertIn(f'src="{assets.vendor_source_url("pdfjs", "pdf.min.js")}"', html)
+        self.assertIn('core.E001', [error.id for error in errors])
+        with mock.patch.object(assets, 'is_vendored', return_value=True):
+            self.assertNotIn('core.E001', [error.id for error in run_checks(include_deployment_checks=True,
+                                                                            tags=['staticfiles'])])
+
+
+# Without the slow-query log, which explains each statement the first time it sees it
+@override_settings(QUERY_LOG={'ENABLED': False})
+class AdminTests(LibraryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(self.admin)
+        self.books = [self.make_book(f'Book {number}', page_count=100 + number) for number in range(6)]
+
+    def add_readers(self, *usernames):
+        for username in usernames:
+            user = User.objects.create_user(username)
+            using = sharding.user_database(user)
+            for book in self.books:
+                ReadingProgress.objects.using(using).create(user=user, book=book, current_page=3)
+                Bookmark.objects.using(using).create(user=user, book=book)
+            Review.objects.create(user=user, book=self.books[0], rating=4, title='Good', content='Fine')
+        return user
+
+    def changelist(self, model, **params):
+        url = reverse(f'admin:core_{model}_changelist')
+        return f'{url}?{"&".join(f"{name}={value}" for name, value in params.items())}' if params else url
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.context['cl'].result_count
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        user = self.add_readers('first')
+        # Everyone on one shard, so each changelist shows them all
+        shard = sharding.user_database(user)
+        urls = [self.changelist('readingprogress', shard=shard), self.changelist('bookmark', shard=shard),
+                self.changelist('review')]
+        self.client.get(urls[0])
+        before = [self.count_queries(url) for url in urls]
+
+        for username in ('second', 'third', 'fourth'):
+            user = User.objects.create_user(username)
+            UserShard.objects.create(user=user, shard=shard)
+            for book in self.books:
+                ReadingProgress.objects.using(shard).create(user=user, book=book, current_page=3)
+                Bookmark.objects.using(shard).create(user=user, book=book)
+            Review.objects.create(user=user, book=self.books[1], rating=3, title='Fine', content='Fine')
+
+        after = [self.count_queries(url) for url in urls]
+        self.assertEqual([queries for queries, _ in after], [queries for queries, _ in before])
+        self.assertEqual([rows for _, rows in after], [24, 24, 4])
+
+    def test_estimated_counts_for_unfiltered_lists(self):
+        queryset = Book.objects.order_by('pk')
+        with mock.patch('core.admin.estimated_row_count', return_value=250000):
+            self.assertEqual(EstimatedCountPaginator(queryset, 50).count, 250000)
+            self.assertEqual(EstimatedCountPaginator(queryset.filter(format='pdf'), 50).count, 6)
+        with mock.patch('core.admin.estimated_row_count', return_value=None):
+            self.assertEqual(EstimatedCountPaginator(queryset, 50).count, 6)
+        with mock.patch.object(EstimatedCountPaginator, 'count_limit', 4):
+            self.assertEqual(EstimatedCountPaginator(queryset.filter(format='pdf'), 50).count, 4)
+
+    def test_mark_completed_jumps_to_the_last_page(self):
+        user = self.add_readers('reader')
+        shard = sharding.user_database(user)
+        rows = ReadingProgress.objects.using(shard).filter(user=user, book__in=[book.pk for book in self.books[:2]])
+        response = self.client.post(self.changelist('readingprogress', shard=shard), {
+            'action': 'mark_completed', '_selected_action': [row.pk for row in rows],
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(
+            sorted(ReadingProgress.objects.using(shard).filter(user=user, is_completed=True)
+                   .values_list('current_page', flat=True)),
+            [100, 101],
+        )
+
+    def test_retrying_failed_tasks(self):
+        failed = Task.objects.create(name='core.tasks.update_book_rating', args=[1], dedup_key='a', status='failed',
+                                     attempts=3, last_error='boom')
+        Task.objects.create(name='core.tasks.update_book_rating', args=[2], dedup_key='b', status='failed')
+        Task.objects.create(name='core.tasks.update_book_rating', args=[2], dedup_key='b')
+        self.client.post(self.changelist('task'), {
+            'action': 'retry_tasks', '_selected_action': list(Task.objects.values_list('pk', flat=True)),
+        })
+        failed.refresh_from_db()
+        self.assertEqual((failed.status, failed.attempts, failed.last_error), ('pending', 0, ''))
+        self.assertEqual(Task.objects.filter(dedup_key='b', status='failed').count(), 1)
+
+
+@override_settings(QUERY_LOG={'ENABLED': False})
+class AuthCacheTests(LibraryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_reader()
+        self.profile = UserProfile.objects.create(user=self.user, bio='First bio')
+        self.key = user_cache_key(self.user.pk)
+
+    def test_logged_in_request_skips_the_auth_and_session_tables(self):
+        self.client.get(reverse('profile'))
+        self.assertEqual(cache.get(self.key).profile.bio, 'First bio')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('profile'))
+        self.assertEqual(response.context['profile'].bio, 'First bio')
+        statements = ' '.join(query['sql'] for query in queries)
+        self.assertNotIn('auth_user', statements)
+        self.assertNotIn('django_session', statements)
+
+    def test_saving_the_user_or_profile_drops_the_cached_copy(self):
+        self.client.get(reverse('profile'))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.first_name = 'Ada'
+            self.user.save()
+        self.assertIsNone(cache.get(self.key))
+
+        self.client.get(reverse('profile'))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.profile.bio = 'Second bio'
+            self.profile.save()
+        self.assertIsNone(cache.get(self.key))
+        self.assertEqual(self.client.get(reverse('profile')).context['profile'].bio, 'Second bio')
+
+    def test_deactivated_user_is_logged_out(self):
+        self.client.get(reverse('profile'))
+        self.user.is_active = False
+        self.user.save()
+        response = self.client.get(reverse('profile'))
+        self.assertRedirects(response, f"{settings.LOGIN_URL}?next={reverse('profile')}", fetch_redirect_response=False)
+
+    def test_deleted_user_is_logged_out(self):
+        self.client.get(reverse('profile'))
+        self.user.delete()
+        self.assertIsNone(cache.get(self.key))
+        self.assertEqual(self.client.get(reverse('profile')).status_code, 302)
+
+
+class ExportTests(LibraryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_reader()
+        self.books = [self.make_book(f'Book {number}') for number in range(3)]
+        using = sharding.user_database(self.user)
+        ReadingProgress.objects.using(using).create(user=self.user, book=self.books[0], current_page=12)
+        ReadingProgress.objects.using(using).create(user=self.user, book=self.books[1], current_page=40,
+                                                    is_completed=True)
+        Bookmark.objects.using(using).create(user=self.user, book=self.books[2])
+        Review.objects.create(user=self.user, book=self.books[0], rating=4, title='Good', content='Liked it')
+        other = User.objects.create_user('other')
+        ReadingProgress.objects.using(sharding.user_database(other)).create(user=other, book=self.books[2])
+
+    def archive(self, chunks):
+        return zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+
+    def test_streamed_ndjson_archive(self):
+        response = self.client.get(reverse('export_data'))
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        self.assertIn('no-store', response['Cache-Control'])
+        self.assertIn(f'filename="bookreader-reader-', response['Content-Disposition'])
+
+        archive = self.archive(response.streaming_content)
+        self.assertEqual(archive.namelist(), [
+            'profile.json', 'reading_progress.ndjson', 'archived_reading_progress.ndjson', 'bookmarks.ndjson',
+            'reviews.ndjson',
+        ])
+        self.assertEqual(json.loads(archive.read('profile.json'))['username'], 'reader')
+        progress = [json.loads(line) for line in archive.read('reading_progress.ndjson').splitlines()]
+        self.assertEqual([(row['book_title'], row['author'], row['current_page'], row['is_completed'])
+                          for row in progress],
+                         [('Book 0', 'Author', 12, False), ('Book 1', 'Author', 40, True)])
+        self.assertEqual(archive.read('archived_reading_progress.ndjson'), b'')
+        self.assertEqual(json.loads(archive.read('bookmarks.ndjson'))['book_title'], 'Book 2')
+        self.assertEqual(json.loads(archive.read('reviews.ndjson'))['content'], 'Liked it')
+
+    def test_csv_archive(self):
+        archive = self.archive(self.client.get(reverse('export_data'), {'format': 'csv'}).streaming_content)
+        lines = archive.read('reading_progress.csv').decode().splitlines()
+        self.assertEqual(lines[0], 'book_title,book_isbn,author,current_page,is_completed,last_read,created_at')
+        self.assertEqual(lines[1].split(',')[:5], ['Book 0', self.books[0].isbn, 'Author', '12', 'False'])
+        self.assertEqual(len(lines), 3)
+
+    def test_unknown_format(self):
+        self.assertEqual(self.client.get(reverse('export_data'), {'format': 'xml'}).status_code, 404)
+        with self.assertRaises(ValueError):
+            next(export.iter_export(self.user, 'xml'))
+
+    def test_output_is_sent_as_it_is_compressed(self):
+        for number in range(3, 40):
+            Review.objects.create(user=self.user, book=self.make_book(f'Book {number}'), rating=3, title='Fine',
+                                  content=os.urandom(10000).hex())
+        with mock.patch.object(export, 'STREAM_CHUNK_SIZE', 4096):
+            chunks = list(export.iter_export(self.user))
+        self.assertGreater(len(chunks), 3)
+        self.assertEqual(len(self.archive(chunks).read('reviews.ndjson').splitlines()), 38)
+
+    def test_command_writes_one_archive_per_user(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        call_command('export_user_data', 'reader', 'other', output_dir=output_dir, stdout=io.StringIO())
+        self.assertEqual(sorted(os.listdir(output_dir)), ['other.zip', 'reader.zip'])
+        with zipfile.ZipFile(os.path.join(output_dir, 'other.zip')) as archive:
+            self.assertEqual(len(archive.read('reading_progress.ndjson').splitlines()), 1)
+
+
+class ReaderBootstrapTests(LibraryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_reader()
+        self.using = sharding.user_database(self.user)
+        self.book = self.make_book('Long Book', data=b'%PDF-1.4 ' + b'x' * 300000, page_count=100)
+
+    def bootstrap(self):
+        return self.client.get(reverse('reader_bootstrap', kwargs={'slug': self.book.slug})).json()
+
+    def test_saved_position_and_bookmark(self):
+        ReadingProgress.objects.using(self.using).create(user=self.user, book=self.book, current_page=60)
+        Bookmark.objects.using(self.using).create(user=self.user, book=self.book)
+        state = self.bootstrap()
+        self.assertEqual(state['book']['page_count'], 100)
+        self.assertEqual(state['progress']['current_page'], 60)
+        self.assertTrue(state['is_bookmarked'])
+        self.assertEqual(state['file']['size'], self.book.file.size)
+        # Header, trailer and the middle of the file for page 60
+        self.assertEqual([warm['range'] for warm in state['prefetch']],
+                         [[0, 65535], [131072, 196607], [262144, self.book.file.size - 1]])
+
+    def test_new_reader_starts_on_the_first_page(self):
+        state = self.bootstrap()
+        self.assertEqual(state['progress'], {'current_page': 1, 'is_completed': False, 'last_read': None})
+        self.assertFalse(state['is_bookmarked'])
+
+    def test_saved_position_is_clamped_to_the_book(self):
+        ReadingProgress.objects.using(self.using).create(user=self.user, book=self.book, current_page=250)
+        self.assertEqual(self.bootstrap()['progress']['current_page'], 100)
+
+    def test_one_catalog_query_for_the_reader_state(self):
+        from .views import _reader_book
+
+        with self.assertNumQueries(1, using='default'):
+            book = _reader_book(self.user, self.book.slug)
+            self.assertEqual(book.author.name, 'Author')
+
+    def test_read_page_embeds_the_bootstrap(self):
+        # pdf.js comes from upstream in trees without the vendored copy
+        with self.assertNoLogs('core.templatetags.assets', 'ERROR'):
+            response = self.client.get(reverse('read_book', kwargs={'slug': self.book.slug}))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, reverse('reader_bootstrap', kwargs={'slug': self.book.slug}))
+
+    def test_suggested_ranges(self):
+        self.assertEqual(suggested_ranges(0, 1, 10), [])
+        self.assertEqual(suggested_ranges(100, 1, 10, chunk_size=64), [[0, 99]])
+        self.assertEqual(suggested_ranges(1000, 5, 10, chunk_size=100), [[0, 99], [400, 499], [900, 999]])
+
+
+GOODREADS_CSV = '''Book Id,Title,Author,ISBN,ISBN13,My Rating,My Review,Exclusive Shelf
+1,"Dune (Dune, #1)",Frank Herbert,"=""0441172717""","=""""",5,Still the best,read
+2,The Hobbit,J.R.R. Tolkien,"=""""","=""""",0,,currently-reading
+3,"Émile: Or, On Education",Jean-Jacques Rousseau,,,0,,to-read
+4,Not In The Catalog,Nobody,,,3,,read
+'''
+
+
+class LibraryImportTests(LibraryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_reader()
+        self.using = sharding.user_database(self.user)
+        self.dune = self.make_book('Dune', isbn='9780441172719', page_count=600,
+                                   author=Author.objects.create(name='Frank Herbert'))
+        self.hobbit = self.make_book('The Hobbit', page_count=300, author=Author.objects.create(name='J. R. R. Tolkien'))
+        self.emile = self.make_book('Emile', author=Author.objects.create(name='Jean-Jacques Rousseau'))
+
+    def test_isbn_and_title_normalization(self):
+        self.assertEqual(library_import.clean_isbn('="0441172717"'), '9780441172719')
+        self.assertEqual(library_import.clean_isbn('978-0-441-17271-9'), '9780441172719')
+        self.assertIsNone(library_import.clean_isbn('12345'))
+        self.assertEqual(library_import.short_title('Dune (Dune, #1): A Novel'), 'dune')
+        self.assertEqual(library_import.normalize_text('J.R.R. Tolkien'), library_import.normalize_text('J R R Tolkien'))
+
+    def test_parse_csv_and_json(self):
+        entries = library_import.parse_shelf(GOODREADS_CSV.encode('utf-8-sig'))
+        self.assertEqual([entry['shelf'] for entry in entries], ['read', 'currently-reading', 'to-read', 'read'])
+        self.assertEqual(entries[0]['rating'], '5')
+        json_entries = library_import.parse_shelf(json.dumps({'books': [{'Title': 'Dune', 'Author': 'Frank Herbert'}]}))
+        self.assertEqual((json_entries[0]['title'], json_entries[0]['author']), ('Dune', 'Frank Herbert'))
+        with self.assertRaises(library_import.ImportFormatError):
+            library_import.parse_shelf('[1, 2]')
+        with self.assertRaises(library_import.ImportFormatError):
+            library_import.parse_shelf('colour,size\nred,10\n')
+
+    def test_import_view(self):
+        upload = ContentFile(GOODREADS_CSV.encode(), name='goodreads_library_export.csv')
+        summary = self.client.post(reverse('import_library'), {'file': upload}).json()
+        self.assertEqual(
+            {key: summary[key] for key in ('rows', 'matched', 'bookmarks', 'reading_progress', 'reviews')},
+            {'rows': 4, 'matched': 3, 'bookmarks': 1, 'reading_progress': 2, 'reviews': 1},
+        )
+        self.assertEqual(summary['unmatched'], ['Not In The Catalog'])
+        progress = dict(ReadingProgress.objects.using(self.using).filter(user=self.user)
+                        .values_list('book_id', 'current_page'))
+        self.assertEqual(progress, {self.dune.pk: 600, self.hobbit.pk: 1})
+        self.assertTrue(Bookmark.objects.using(self.using).filter(user=self.user, book=self.emile).exists())
+        self.dune.refresh_from_db()
+        self.assertEqual((self.dune.review_count, self.dune.average_rating), (1, 5))
+
+    def test_importing_again_changes_nothing(self):
+        entries = library_import.parse_shelf(GOODREADS_CSV)
+        library_import.import_shelf(self.user, entries)
+        ReadingProgress.objects.using(self.using).filter(book=self.hobbit).update(current_page=120)
+        summary = library_import.import_shelf(self.user, entries)
+        self.assertEqual((summary['bookmarks'], summary['reading_progress'], summary['reviews']), (0, 0, 0))
+        self.assertEqual(ReadingProgress.objects.using(self.using).get(book=self.hobbit).current_page, 120)
+
+    def test_bad_upload(self):
+        self.assertEqual(self.client.post(reverse('import_library')).status_code, 400)
+        upload = ContentFile(b'{"books": 3', name='export.json')
+        response = self.client.post(reverse('import_library'), {'file': upload})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Invalid JSON', response.json()['error'])
+
+    def test_bulk_bookmarks(self):
+        Bookmark.objects.using(self.using).create(user=self.user, book=self.emile)
+        url = reverse('bulk_bookmarks')
+        response = self.client.post(url, {'add': [self.dune.pk, self.hobbit.pk, self.dune.pk, 999999],
+                                           'remove': [self.emile.pk]}, content_type='application/json')
+        self.assertEqual(response.json(), {'status': 'success', 'added': 2, 'removed': 1})
+        self.assertEqual(
+            set(Bookmark.objects.using(self.using).filter(user=self.user).values_list('book_id', flat=True)),
+            {self.dune.pk, self.hobbit.pk},
+        )
+        response = self.client.post(url, {'add': 'all'}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class ArchiveTests(LibraryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_reader()
+        self.using = sharding.user_database(self.user)
+        self.books = [self.make_book(f'Book {number}', page_count=50) for number in range(4)]
+        progress = ReadingProgress.objects.using(self.using)
+        progress.create(user=self.user, book=self.books[0], current_page=1)
+        progress.create(user=self.user, book=self.books[1], current_page=30)
+        progress.create(user=self.user, book=self.books[2], current_page=1, is_completed=True)
+        progress.create(user=self.user, book=self.books[3], current_page=1)
+        # last_read is auto_now; age every row but the last
+        progress.exclude(book=self.books[3]).update(last_read=timezone.now() - timedelta(days=365))
+
+    def archive(self, *args):
+        call_command('archive_reading_progress', *args, stdout=io.StringIO())
+
+    def archived_books(self):
+        return set(ArchivedReadingProgress.objects.using(self.using).values_list('book_id', flat=True))
+
+    def test_only_stale_unstarted_progress_is_archived(self):
+        self.archive('--dry-run')
+        self.assertEqual(self.archived_books(), set())
+        self.archive('--batch-size', '1')
+        self.assertEqual(self.archived_books(), {self.books[0].pk})
+        self.assertEqual(
+            set(ReadingProgress.objects.using(self.using).values_list('book_id', flat=True)),
+            {book.pk for book in self.books[1:]},
+        )
+
+    def test_opening_the_book_restores_its_progress(self):
+        self.archive()
+        state = self.client.get(reverse('reader_bootstrap', kwargs={'slug': self.books[0].slug})).json()
+        self.assertEqual(state['progress']['current_page'], 1)
+        self.assertEqual(self.archived_books(), set())
+        self.assertTrue(ReadingProgress.objects.using(self.using).filter(book=self.books[0]).exists())
+
+    def test_new_progress_replaces_the_archived_row(self):
+        self.archive()
+        response = self.client.post(reverse('read_book', kwargs={'slug': self.books[0].slug}), {'page': 5})
+        self.assertEqual(response.json(), {'status': 'success'})
+        self.assertEqual(self.archived_books(), set())
+        self.assertEqual(ReadingProgress.objects.using(self.using).get(book=self.books[0]).current_page, 5)
+
+    def test_restore_without_archive(self):
+        self.assertIsNone(ReadingProgress.restore(self.user, self.books[1].pk))
+
+
+class QueryLogTests(LibraryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        querylog.clear()
+        self.addCleanup(querylog.clear)
+
+    def test_fingerprint_ignores_values(self):
+        self.assertEqual(
+            querylog.fingerprint('SELECT * FROM "t" WHERE "id" IN (%s, %s) AND "name" = \'a\' LIMIT 21'),
+            querylog.fingerprint('SELECT *  FROM "t" WHERE "id" IN (%s) AND "name" = \'b\' LIMIT 5'),
+        )
+        self.assertNotEqual(querylog.fingerprint('SELECT 1 FROM "a"'), querylog.fingerprint('SELECT 1 FROM "b"'))
+
+    def test_full_scans(self):
+        plan = ['SCAN core_author', 'SEARCH core_book USING INDEX core_book_author_id (author_id=?)',
+                'SCAN core_book USING COVERING INDEX core_book_isbn']
+        self.assertEqual(querylog.full_scans(plan), ['SCAN core_author'])
+        self.assertEqual(querylog.full_scans(['Seq Scan on core_book  (cost=0.00..1.01 rows=1)']),
+                         ['Seq Scan on core_book  (cost=0.00..1.01 rows=1)'])
+
+    @override_settings(QUERY_LOG={'THRESHOLD_MS': 0})
+    def test_slow_statements_are_recorded_with_their_plan_and_call_site(self):
+        with self.assertLogs('core.querylog', 'WARNING'):
+            with querylog.query_logging():
+                list(Author.objects.filter(bio='Ann').order_by())
+                list(Author.objects.filter(bio='Bob').order_by())
+        entries = querylog.entries()
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[0]['fingerprint'], entries[1]['fingerprint'])
+        self.assertIn("'Bob'", entries[0]['sql'])
+        self.assertEqual(entries[0]['reason'], 'slow')
+        self.assertTrue(entries[0]['code'].startswith('core/tests.py:'))
+        self.assertEqual(entries[0]['full_scans'], ['SCAN core_author'])
+
+    @override_settings(QUERY_LOG={'THRESHOLD_MS': 10000, 'WATCH_TABLES': ['core_author']})
+    def test_watched_tables_record_fast_full_scans(self):
+        with self.assertLogs('core.querylog', 'WARNING'):
+            with querylog.query_logging():
+                Author.objects.get(pk=self.author.pk)
+                list(Author.objects.filter(bio='Ann').order_by())
+                list(Author.objects.filter(bio='Bob').order_by())
+                list(Book.objects.filter(description='Dune').order_by())
+        entries = querylog.entries()
+        # The indexed lookup is fine, the scan is reported once, unwatched tables are ignored
+        self.assertEqual([(entry['reason'], entry['full_scans']) for entry in entries],
+                         [('full scan', ['SCAN core_author'])])
+
+    @override_settings(QUERY_LOG={'ENABLED': False})
+    def test_middleware_unused_when_disabled(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            querylog.QueryLogMiddleware(lambda request: None)
+
+    @override_settings(QUERY_LOG={'THRESHOLD_MS': 0})
+    def test_staff_page(self):
+        with self.assertLogs('core.querylog', 'WARNING'):
+            with querylog.query_logging():
+                list(Author.objects.filter(bio='Ann'))
+        entry = querylog.entries()[0]
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        response = self.client.get(reverse('query_log'), {'fingerprint': entry['fingerprint']})
+        self.assertEqual(response.context['total'], 1)
+        self.assertEqual(self.client.get(reverse('query_log'), {'fingerprint': 'none'}).context['total'], 0)
+        self.client.post(reverse('query_log'))
+        self.assertEqual(querylog.entries(), [])
+
+
+class ProfilingTests(LibraryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.enterContext(self.settings(PROFILING={'ENABLED': True, 'DIRECTORY': self.directory}))
+        self.store = profiling.ProfileStore()
+        self.staff = User.objects.create_user('staff', is_staff=True)
+        self.client.force_login(self.staff)
+
+    def profile(self, mode):
+        response = self.client.get(reverse('book_list'), HTTP_X_PROFILE=mode)
+        self.assertEqual(response.status_code, 200)
+        return response.headers.get('X-Profile-Id')
+
+    def test_staff_requests_are_profiled_on_demand(self):
+        self.assertIsNone(self.client.get(reverse('book_list')).headers.get('X-Profile-Id'))
+        names = [self.profile(mode) for mode in ('cprofile', 'memory', 'sample')]
+        self.assertEqual([os.path.splitext(name)[1] for name in names], ['.prof', '.txt', '.collapsed'])
+        self.assertIn('book_list-cprofile', names[0])
+        self.assertIn('function calls', profiling.describe(self.store.path(names[0])))
+        self.assertTrue(profiling.describe(self.store.path(names[1])).startswith('GET /books/'))
+        self.assertEqual(sorted(name for name, _, _ in self.store.entries()), sorted(names))
+
+    def test_header_is_ignored_for_other_users(self):
+        self.client.force_login(User.objects.create_user('reader'))
+        self.assertIsNone(self.profile('cprofile'))
+        self.client.logout()
+        self.assertIsNone(self.profile('cprofile'))
+        self.assertEqual(self.store.entries(), [])
+
+    def test_sampled_requests(self):
+        with self.settings(PROFILING={'ENABLED': True, 'DIRECTORY': self.directory, 'SAMPLE_RATE': 1.0}):
+            self.client.logout()
+            self.assertTrue(self.client.get(reverse('book_list')).headers['X-Profile-Id'].endswith('.collapsed'))
+
+    def test_store_keeps_the_newest_files(self):
+        store = profiling.ProfileStore(max_files=2, max_bytes=10)
+        first = store.save('first', '.txt', 'aaaa')
+        second = store.save('second', '.txt', 'bbbb')
+        third = store.save('third', '.txt', 'cccc')
+        self.assertEqual([name for name, _, _ in store.entries()], [third, second])
+        store.save('fourth', '.txt', 'dddddddd')
+        self.assertEqual(len(store.entries()), 1)
+        for name in (first, '../settings.py', 'notes.md'):
+            with self.assertRaises(FileNotFoundError):
+                store.path(name)
+
+    def test_memory_endpoint(self):
+        url = reverse('memory_profile')
+        self.addCleanup(profiling.stop_memory_tracing)
+        self.assertEqual(self.client.post(url, {'action': 'snapshot'}).status_code, 409)
+        self.assertTrue(self.client.post(url, {'action': 'start'}).json()['tracing'])
+        first = self.client.post(url, {'action': 'snapshot'}).json()
+        self.assertIsNone(first['diff'])
+        second = self.client.post(url, {'action': 'snapshot'}).json()
+        self.assertTrue(second['diff'].endswith('.txt'))
+        self.assertEqual(second['last_snapshot'], second['snapshot'])
+        self.assertFalse(self.client.post(url, {'action': 'stop'}).json()['tracing'])
+        self.assertEqual(self.client.post(url, {'action': 'dump'}).status_code, 400)
+        with self.settings(PROFILING={'ENABLED': False}):
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_profiles_command(self):
+        name = self.profile('cprofile')
+        output = io.StringIO()
+        call_command('profiles', 'list', stdout=output)
+        self.assertIn(name, output.getvalue())
+        call_command('profiles', 'show', name, stdout=output)
+        self.assertIn('cumulative', output.getvalue())
+        call_command('profiles', 'clear', stdout=output)
+        self.assertEqual(self.store.entries(), [])
+
+
+@override_settings(THROTTLE={'RATES': {'reading_progress': '2/min'}})
+class ThrottleTests(LibraryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.book = self.make_book('Book')
+        self.url = reverse('read_book', kwargs={'slug': self.book.slug})
+
+    def test_parse_rate(self):
+        self.assertEqual(throttle.parse_rate('30/min'), (30, 60))
+        self.assertEqual(throttle.parse_rate('5/s'), (5, 1))
+        with self.assertRaises(ValueError):
+            throttle.parse_rate('30 per minute')
+
+    def test_bucket_refills_over_time(self):
+        bucket = throttle.TokenBucket('group', 'ip:1', '2/min')
+        self.assertEqual([bucket.consume(now=100), bucket.consume(now=100)], [0, 0])
+        self.assertAlmostEqual(bucket.consume(now=100), 30)
+        self.assertAlmostEqual(bucket.consume(now=115), 15)
+        self.assertEqual(bucket.consume(now=130), 0)
+
+    def test_writes_over_the_rate_get_429(self):
+        self.make_reader()
+        statuses = [self.client.post(self.url, {'page': page}).status_code for page in (2, 3, 4)]
+        self.assertEqual(statuses, [200, 200, 429])
+        response = self.client.post(self.url, {'page': 5})
+        self.assertEqual(response.json()['error'], 'Too many requests')
+        self.assertGreater(int(response['Retry-After']), 0)
+        # Only POSTs are counted, and every client has its own bucket
+        self.assertEqual(self.client.get(reverse('reader_bootstrap', kwargs={'slug': self.book.slug})).status_code, 200)
+        self.make_reader('second')
+        self.assertEqual(self.client.post(self.url, {'page': 2}).status_code, 200)
+        self.assertEqual(throttle.metrics()['throttled:reading_progress'], 2)
+
+    def test_disabled(self):
+        self.make_reader()
+        with self.settings(THROTTLE={'ENABLED': False, 'RATES': {'reading_progress': '1/min'}}):
+            statuses = {self.client.post(self.url, {'page': page}).status_code for page in range(1, 5)}
+        self.assertEqual(statuses, {200})
+
+
+@override_settings(ADMISSION_CONTROL={'ENABLED': True, 'MAX_IN_FLIGHT': 2, 'MAX_DB_LATENCY_MS': 50,
+                                      'LOW_PRIORITY_VIEWS': ['book_list']})
+class AdmissionControlTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.responses = []
+        self.middleware = throttle.AdmissionControlMiddleware(lambda request: self.responses.pop(0))
+        self.middleware.load = throttle.WorkerLoad()
+
+    def call(self, path=None, response=None, **extra):
+        self.responses.append(response or HttpResponse('ok'))
+        return self.middleware(self.factory.get(path or reverse('book_list'), **extra))
+
+    def test_busy_worker_sheds_anonymous_low_priority_requests(self):
+        self.middleware.load.in_flight = 2
+        response = self.call()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '5')
+        self.assertEqual(self.call(HTTP_COOKIE=f'{settings.SESSION_COOKIE_NAME}=abc').status_code, 200)
+        self.assertEqual(self.call(reverse('genre_list')).status_code, 200)
+        self.assertEqual(throttle.metrics()['shed:in_flight'], 1)
+        self.assertEqual(self.middleware.load.in_flight, 2)
+
+    def test_slow_database_sheds_until_the_average_is_stale(self):
+        load = self.middleware.load
+        load.latency_ms, load.latency_at = 80, time.monotonic()
+        self.assertEqual(self.call().status_code, 503)
+        self.assertEqual(throttle.metrics()['shed:db_latency'], 1)
+        load.latency_at -= throttle.LATENCY_WINDOW + 1
+        self.assertEqual(self.call().status_code, 200)
+
+    def test_streamed_response_stays_in_flight_until_closed(self):
+        response = self.call(response=StreamingHttpResponse(iter([b'a', b'b'])))
+        self.assertEqual(self.middleware.load.in_flight, 1)
+        self.assertEqual(b''.join(response.streaming_content), b'ab')
+        self.assertEqual(self.middleware.load.in_flight, 1)
+        response.close()
+        response.close()
+        self.assertEqual(self.middleware.load.in_flight, 0)
+
+    def test_failed_request_is_released(self):
+        def fail(request):
+            raise RuntimeError('boom')
+
+        self.middleware.get_response = fail
+        with self.assertRaises(RuntimeError):
+            self.middleware(self.factory.get('/'))
+        self.assertEqual(self.middleware.load.in_flight, 0)
+
+    def test_statements_are_timed(self):
+        def query(request):
+            Author.objects.count()
+            return HttpResponse()
+
+        self.middleware.get_response = query
+        self.middleware(self.factory.get('/'))
+        self.assertGreater(self.middleware.load.latency_at, 0)
+
+    def test_disabled(self):
+        with self.settings(ADMISSION_CONTROL={'ENABLED': False}):
+            with self.assertRaises(MiddlewareNotUsed):
+                throttle.AdmissionControlMiddleware(lambda request: None)
+
+    def test_traffic_page(self):
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        data = self.client.get(reverse('traffic')).json()
+        self.assertTrue(data['admission_control'])
+        self.assertEqual(set(data['worker']), {'in_flight', 'db_latency_ms'})
+
+
+class SynchronousPool:
+    """Stands in for ``ThreadPoolExecutor``: pool threads could not see the test's transaction."""
+
+    def __init__(self, max_workers=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def map(self, func, items):
+        return map(func, items)
+
+
+class StartupTests(LibraryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Closing connections would end the test's transaction
+        self.enterContext(mock.patch('core.startup.connections'))
+        self.enterContext(mock.patch('core.startup.ThreadPoolExecutor', SynchronousPool))
+        self.popular = self.make_book('Popular', is_popular=True, review_count=10)
+        self.featured = self.make_book('Featured', is_featured=True)
+        self.plain = self.make_book('Plain')
+        self.genre = Genre.objects.create(name='Fiction')
+
+    def test_preload(self):
+        timings = startup.preload()
+        self.assertEqual(set(timings), {'models', 'urls', 'templates', 'facets'})
+        counts = {name: count for name, (count, _) in timings.items()}
+        self.assertGreater(counts['templates'], 10)
+        self.assertGreater(counts['urls'], 10)
+
+    def test_hot_paths(self):
+        config = {**startup.startup_settings(), 'WARM_BOOKS': 2, 'WARM_AUTHORS': 1, 'WARM_GENRES': 1}
+        self.assertEqual(startup.hot_paths(config), [
+            reverse('home'), reverse('author_list'), reverse('genre_list'),
+            self.featured.get_absolute_url(), self.popular.get_absolute_url(),
+            reverse('author_detail', args=[self.author.pk]), reverse('genre_detail', args=[self.genre.slug]),
+        ])
+
+    def test_warmed_pages_are_cache_hits(self):
+        paths = startup.hot_paths()
+        results = startup.warm_pages(paths, startup.default_host())
+        self.assertEqual([(path, status, state) for path, status, state, _ in results],
+                         [(path, 200, 'MISS') for path in paths])
+        with self.assertNumQueries(0):
+            response = self.client.get(self.plain.get_absolute_url())
+        self.assertEqual(response['X-Page-Cache'], 'HIT')
+
+    def test_warm_caches_command(self):
+        output, errors = io.StringIO(), io.StringIO()
+        call_command('warm_caches', '--books', '1', '--authors', '0', '--genres', '0', stdout=output, stderr=errors)
+        self.assertTrue(output.getvalue().startswith('Warmed 4 of 4 pages for testserver ('))
+        self.assertIn('private to this process', errors.getvalue())
+        self.assertEqual(self.client.get(self.featured.get_absolute_url())['X-Page-Cache'], 'HIT')
+
+
+@override_settings(QUERY_LOG={'ENABLED': False})
+class ReviewPageTests(LibraryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.book = self.make_book('Reviewed')
+        self.url = reverse('book_reviews', kwargs={'slug': self.book.slug})
+        start = timezone.now() - timedelta(days=30)
+        for number in range(25):
+            user = User.objects.create(username=f'user{number}')
+            review = Review.objects.create(user=user, book=self.book, rating=number % 5 + 1, title=f'Review {number}',
+                                           content='Text', is_public=number != 24)
+            # Pairs of reviews share a timestamp, so the id breaks ties
+            Review.objects.filter(pk=review.pk).update(created_at=start + timedelta(hours=number // 2))
+        self.book.update_rating()
+
+    def walk(self, limit):
+        pages, cursor = [], None
+        while True:
+            data = self.client.get(self.url, {'limit': limit, **({'cursor': cursor} if cursor else {})}).json()
+            pages.append(data)
+            cursor = data['next_cursor']
+            if cursor is None:
+                return pages
+
+    def test_cursor_pages_cover_every_public_review_once(self):
+        pages = self.walk(limit=10)
+        self.assertEqual([len(page['reviews']) for page in pages], [10, 10, 4])
+        titles = [review['title'] for page in pages for review in page['reviews']]
+        self.assertEqual(titles, [f'Review {number}' for number in range(23, -1, -1)])
+
+    def test_histogram_on_the_first_page_only(self):
+        first, second = self.walk(limit=20)
+        self.assertEqual(first['review_count'], 25)
+        self.assertEqual(first['average_rating'], 3.0)
+        self.assertEqual([(bar['stars'], bar['count'], bar['percent']) for bar in first['histogram']],
+                         [(5, 5, 20), (4, 5, 20), (3, 5, 20), (2, 5, 20), (1, 5, 20)])
+        self.assertNotIn('histogram', second)
+
+    def test_deep_pages_cost_the_same_queries(self):
+        cursor = self.walk(limit=1)[-2]['next_cursor']
+        with self.assertNumQueries(3):
+            # The ETag state, the book and one page of reviews with their users
+            response = self.client.get(self.url, {'cursor': cursor, 'limit': 1})
+        self.assertEqual(response.json()['reviews'][0]['title'], 'Review 0')
+
+    def test_invalid_cursor_or_limit(self):
+        for params in ({'cursor': 'not-a-cursor'}, {'limit': 'ten'}):
+            self.assertEqual(self.client.get(self.url, params).status_code, 400)
+        self.assertEqual(self.client.get(reverse('book_reviews', kwargs={'slug': 'missing'})).status_code, 404)
+
+    def test_etag_follows_the_books_reviews(self):
+        etag = self.client.get(self.url)['ETag']
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        Review.objects.create(user=User.objects.create(username='late'), book=self.book, rating=1, title='Late',
+                              content='Text')
+        self.book.update_rating()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['reviews'][0]['title'], 'Late')
+
+
+class SignedURLTests(LibraryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.book = self.make_book('Signed', data=b'%PDF-1.4 ' + b'0123456789' * 100)
+        self.make_reader()
+
+    def file_url(self):
+        response = self.client.get(reverse('book_file', kwargs={'slug': self.book.slug}))
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('no-cache', response['Cache-Control'])
+        return response['Location']
+
+    def token(self, url):
+        match = resolve(url)
+        self.assertEqual(match.url_name, 'signed_media')
+        return match.kwargs['token']
+
+    def test_book_file_redirects_to_a_signed_link(self):
+        url = self.file_url()
+        self.assertTrue(url.endswith(f'/{self.book.slug}.pdf'))
+        self.client.logout()
+        # The link itself is the access check
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.book.file.open().read())
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertIn(f'filename="{self.book.slug}.pdf"', response['Content-Disposition'])
+        self.assertIn('private', response['Cache-Control'])
+        self.assertLessEqual(int(response['Cache-Control'].split('max-age=')[1].split(',')[0]), 360)
+
+        partial = self.client.get(url, HTTP_RANGE='bytes=9-18')
+        self.assertEqual(partial.status_code, 206)
+        self.assertEqual(b''.join(partial.streaming_content), b'0123456789')
+
+    def test_links_are_stable_within_a_window(self):
+        with mock.patch('core.storage.time.time', return_value=1_000_021):
+            first = self.file_url()
+        with mock.patch('core.storage.time.time', return_value=1_000_079):
+            self.assertEqual(self.file_url(), first)
+        self.assertEqual(signing.Signer(salt=SIGNED_URL_SALT).unsign_object(self.token(first))['e'], 1_000_380)
+
+    def test_tampered_expired_and_missing_links(self):
+        url = self.file_url()
+        token = self.token(url)
+        tampered = url.replace(token, token[:-2] + ('AA' if token[-2:] != 'AA' else 'BB'))
+        self.assertEqual(self.client.get(tampered).status_code, 404)
+
+        with mock.patch('core.storage.time.time', return_value=load_signed_url(token)[2] + 1):
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+        for payload in ({'s': 'nowhere', 'n': self.book.file.name, 'e': 2 ** 40},
+                        {'s': 'blobs', 'n': 'blobs/missing.pdf', 'e': 2 ** 40}):
+            forged = signing.Signer(salt=SIGNED_URL_SALT).sign_object(payload, compress=True)
+            self.assertEqual(self.client.get(url.replace(token, forged)).status_code, 404)
+
+    def test_reader_link_lasts_the_reading_session(self):
+        state = self.client.get(reverse('reader_bootstrap', kwargs={'slug': self.book.slug})).json()
+        _, name, expires_at, content_type = load_signed_url(self.token(state['file']['url']))
+        self.assertEqual((name, content_type), (self.book.file.name, 'application/pdf'))
+        self.assertGreaterEqual(expires_at - time.time(), settings.READER_FILE_URL_EXPIRES - 1)
+        self.assertEqual(state['prefetch'][0]['url'], state['file']['url'])
+
+    def test_covers_redirect_for_a_minute(self):
+        self.book.cover_image.save('cover.png', ContentFile(b'\x89PNG\r\n\x1a\ncover'))
+        response = self.client.get(reverse('book_cover', kwargs={'slug': self.book.slug}))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Cache-Control'], 'private, max-age=60')
+        self.assertEqual(self.client.get(response['Location']).status_code, 200)
+
+
+class FacetTests(LibraryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Ids come back after each test's rollback; start every test without an index
+        self.enterContext(mock.patch.object(facets, '_index', None))
+        self.fiction = Genre.objects.create(name='Fiction')
+        self.history = Genre.objects.create(name='History')
+        self.english = self.make_book('English', language='en', publication_date=date(1999, 1, 1),
+                                      average_rating=4.5, review_count=2)
+        self.french = self.make_book('French', language='fr', format='epub', publication_date=date(2010, 1, 1),
+                                     average_rating=2, review_count=1)
+        self.unrated = self.make_book('Unrated', language='en')
+        self.english.genres.add(self.fiction, self.history)
+        self.french.genres.add(self.fiction)
+
+    def pks(self, bits):
+        return set(facets.ids_descending(bits))
+
+    def test_ids_descending_and_matches(self):
+        bits = sum(1 << pk for pk in (1, 7, 8, 64, 300))
+        self.assertEqual(facets.ids_descending(bits), [300, 64, 8, 7, 1])
+        self.assertEqual(facets.ids_descending(bits, offset=2, limit=2), [8, 7])
+        matches = facets.Matches(bits)
+        self.assertEqual(len(matches), 5)
+        self.assertEqual(matches[3:10], [7, 1])
+        with self.assertRaises(TypeError):
+            matches[0]
+
+    def test_select_and_disjunctive_counts(self):
+        index = facets.FacetIndex.build()
+        self.assertEqual(self.pks(index.select({'genre': {self.fiction.pk}, 'language': {'en'}})), {self.english.pk})
+        self.assertEqual(self.pks(index.select({'language': {'en', 'fr'}, 'rating': (3, None)})), {self.english.pk})
+        self.assertEqual(self.pks(index.select({'year': (2000, 2020)})), {self.french.pk})
+        self.assertEqual(self.pks(index.select({'format': {'mobi'}})), set())
+
+        counts = index.counts({'language': {'en'}})
+        # The language counts ignore the language selection, the others apply it
+        self.assertEqual(counts['language'], {'en': 2, 'fr': 1})
+        self.assertEqual(counts['genre'], {self.fiction.pk: 1, self.history.pk: 1})
+        self.assertEqual(counts['rating'], {4: 1, 2: 0})
+
+    def test_signals_keep_the_loaded_index_current(self):
+        index = facets.get_index()
+        self.french.language = 'en'
+        self.french.save()
+        self.unrated.genres.add(self.history)
+        self.english.genres.remove(self.history)
+        self.english.delete()
+        self.assertEqual(self.pks(index.select({'language': {'en'}})), {self.french.pk, self.unrated.pk})
+        self.assertEqual(self.pks(index.select({'genre': {self.history.pk}})), {self.unrated.pk})
+        self.assertEqual(len(index), 2)
+
+    def test_sync_reads_changes_made_elsewhere(self):
+        # Not the process's loaded index, so only sync() can update it
+        index = facets.FacetIndex.build()
+        self.assertFalse(index.sync())
+        Book.objects.filter(pk=self.unrated.pk).update(language='de', updated_at=timezone.now())
+        late = self.make_book('Late', language='de')
+        with mock.patch.object(facets, 'loaded_index', return_value=None):
+            self.french.delete()
+        touch_catalog()
+        self.assertTrue(index.sync())
+        self.assertEqual(self.pks(index.select({'language': {'de'}})), {self.unrated.pk, late.pk})
+        self.assertNotIn(self.french.pk, index.books)
+
+    def test_snapshots(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'facets.bin')
+        output = io.StringIO()
+        call_command('build_facets', path=path, stdout=output)
+        self.assertIn('Indexed 3 books', output.getvalue())
+        loaded = facets.FacetIndex.load(path)
+        built = facets.FacetIndex.build()
+        self.assertEqual((loaded.books, loaded.bitsets, loaded.all), (built.books, built.bitsets, built.all))
+
+        with open(path, 'wb') as snapshot:
+            snapshot.write(b'garbage')
+        with self.settings(FACETS={'SNAPSHOT_PATH': path}), self.assertLogs('core.facets', 'WARNING'):
+            self.assertEqual(len(facets.load_index()), 3)
+        # The rebuilt index replaced the broken snapshot
+        self.assertEqual(len(facets.FacetIndex.load(path)), 3)
+
+    @override_settings(QUERY_LOG={'ENABLED': False})
+    def test_browse_filters_in_memory(self):
+        url = reverse('book_list_json')
+        data = self.client.get(url, {'genre': self.fiction.slug, 'rating_min': 2}).json()
+        self.assertEqual([book['title'] for book in data['books']], ['French', 'English'])
+        self.assertEqual(data['count'], 2)
+        languages = {option['value']: option['count'] for option in data['facets']['language']}
+        self.assertEqual(languages, {'en': 1, 'fr': 1})
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url, {'language': 'en'})
+        self.assertFalse([query for query in queries if 'COUNT(' in query['sql']])
+
+
+@override_settings(PREFETCH={'FLUSH_INTERVAL': 10 ** 9, 'FLUSH_SIZE': 1000}, TASK_QUEUE={'EAGER': False})
+class PrefetchTests(LibraryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.enterContext(mock.patch.object(prefetch, '_buffer', {}))
+        self.enterContext(mock.patch.object(prefetch, '_buffered', 0))
+        self.book = self.make_book('Manual', data=b'%PDF-1.4 ' + b'x' * 640000, page_count=100)
+
+    def test_derive_pattern(self):
+        self.assertEqual(prefetch.derive_pattern({'1': 5}, {}, 5), prefetch.DEFAULT_PATTERN)
+        # Mostly one page on, rarely back: warm one page ahead only
+        self.assertEqual(prefetch.derive_pattern({'1': 95, '2': 3, '-1': 2}, {}, 100),
+                         {'ahead': 1, 'behind': False, 'jumps': [], 'turns': 100})
+        # Skimming two at a time, often back
+        pattern = prefetch.derive_pattern({'1': 20, '2': 50, '-1': 30}, {}, 100)
+        self.assertEqual((pattern['ahead'], pattern['behind']), (2, True))
+        self.assertEqual(prefetch.derive_pattern({'5': 100}, {}, 100)['ahead'], 3)
+        # Landing pages most jumps reach; one-offs are not targets
+        jumps = {'3': 40, '90': 30, '50': 2, '61': 1}
+        self.assertEqual(prefetch.derive_pattern({'1': 30}, jumps, 103)['jumps'], [3, 90])
+
+    def test_page_hints(self):
+        pattern = {'ahead': 2, 'behind': True, 'jumps': [3, 90, 11], 'turns': 100}
+        self.assertEqual(prefetch.page_hints(pattern, 10, page_count=100), [
+            {'page': 11, 'reason': 'ahead'}, {'page': 12, 'reason': 'ahead'}, {'page': 9, 'reason': 'behind'},
+            {'page': 3, 'reason': 'jump'}, {'page': 90, 'reason': 'jump'},
+        ])
+        self.assertEqual([hint['page'] for hint in prefetch.page_hints(pattern, 1, page_count=2)], [2])
+        self.assertEqual(len(prefetch.page_hints(pattern, 10, limit=2)), 2)
+
+    def test_page_turns_are_buffered_and_merged(self):
+        self.make_reader()
+        url = reverse('read_book', kwargs={'slug': self.book.slug})
+        for page in (1, 2, 3, 2, 40, 41, 41):
+            self.client.post(url, {'page': page})
+        self.assertEqual(prefetch._buffer, {str(self.book.pk): {
+            'steps': {'1': 3, '-1': 1}, 'jumps': {'40': 1},
+        }})
+
+        prefetch.flush()
+        task = Task.objects.get(name='core.tasks.merge_page_stats')
+        self.assertEqual(prefetch._buffer, {})
+        self.assertEqual(prefetch.page_pattern(self.book.pk), prefetch.DEFAULT_PATTERN)
+
+        samples = task.args[0]
+        for _ in range(5):
+            prefetch.merge(samples)
+        stats = PageAccessStats.objects.get(book=self.book)
+        self.assertEqual((stats.steps, stats.jumps, stats.turns), ({'1': 15, '-1': 5}, {'40': 5}, 25))
+        # Merging dropped the cached default pattern
+        self.assertEqual(prefetch.page_pattern(self.book.pk),
+                         {'ahead': 1, 'behind': True, 'jumps': [40], 'turns': 25})
+
+    def test_hints_view(self):
+        self.make_reader()
+        PageAccessStats.objects.create(book=self.book, steps={'1': 30}, jumps={'50': 10}, turns=40)
+        url = reverse('prefetch_hints', kwargs={'slug': self.book.slug})
+        data = self.client.get(url, {'page': 10}).json()
+        self.assertEqual([(hint['page'], hint['reason']) for hint in data['hints']], [(11, 'ahead'), (50, 'jump')])
+        self.assertEqual(data['hints'][1]['range'], [262144, 327679])
+        self.assertEqual(self.client.get(url, {'page': 'ten'}).status_code, 400)
@@ -0,0 +1,285 @@
+"""
+Write throttling and admission control.
+
+``throttle(group)`` is a view decorator with a token bucket per user (or,
+for anonymous requests, per client address) and endpoint group, kept in the
+cache. A bucket holds up to ``N`` tokens for a rate of ``"N/period"`` and
+refills continuously; a request that finds it empty gets a 429 with
+``Retry-After``. The read-modify-write of a bucket is not atomic, so two
+workers racing on one bucket may each let a request through. That is fine
+for its purpose, which is stopping a runaway client rather than exact
+accounting.
+
+``AdmissionControlMiddleware`` limits the work a worker takes on while it is
+overloaded. When the worker has ``MAX_IN_FLIGHT`` requests running, or its
+recent statements average more than ``MAX_DB_LATENCY_MS`` (on SQLite that is
+mostly time spent waiting for the write lock), anonymous requests to the
+``LOW_PRIORITY_VIEWS`` get a 503 before they touch the database. Logged-in
+readers are never shed.
+
+Both count what they reject in cache counters, shown to staff at
+``/admin/traffic/``.
+"""
+import functools
+import logging
+import math
+import threading
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import HttpResponse, JsonResponse
+from django.urls import Resolver404, resolve
+
+logger = logging.getLogger(__name__)
+
+THROTTLE_DEFAULTS = {
+    'ENABLED': True,
+    'CACHE_ALIAS': 'default',
+    # Endpoint group -> "requests/period", period one of s, min, h
+    'RATES': {},
+}
+
+ADMISSION_DEFAULTS = {
+    'ENABLED': False,
+    # Concurrent requests per worker before low-priority work is shed
+    'MAX_IN_FLIGHT': 8,
+    # Moving average of statement time before low-priority work is shed
+    'MAX_DB_LATENCY_MS': 250,
+    # URL names whose anonymous requests may be shed
+    'LOW_PRIORITY_VIEWS': [],
+    # Seconds suggested to shed clients in Retry-After
+    'RETRY_AFTER': 5,
+}
+
+PERIODS = {'s': 1, 'sec': 1, 'm': 60, 'min': 60, 'h': 3600, 'hour': 3600}
+ADMISSION_REASONS = ('in_flight', 'db_latency')
+# Weight of the newest statement in the latency moving average
+LATENCY_WEIGHT = 0.05
+# Seconds after which the latency average is considered out of date
+LATENCY_WINDOW = 10
+METRICS_TIMEOUT = 7 * 24 * 3600
+
+
+def throttle_settings():
+    return {**THROTTLE_DEFAULTS, **getattr(settings, 'THROTTLE', {})}
+
+
+def admission_settings():
+    return {**ADMISSION_DEFAULTS, **getattr(settings, 'ADMISSION_CONTROL', {})}
+
+
+def parse_rate(rate):
+    """``"30/min"`` -> ``(30, 60)``."""
+    count, _, period = rate.partition('/')
+    try:
+        return int(count), PERIODS[period.strip().lower()]
+    except (KeyError, ValueError):
+        raise ValueError(f'Invalid rate {rate!r}; expected e.g. "30/min"') from None
+
+
+def _cache():
+    return caches[throttle_settings()['CACHE_ALIAS']]
+
+
+def count_metric(name):
+    cache = _cache()
+    key = f'metrics:{name}'
+    if not cache.add(key, 1, METRICS_TIMEOUT):
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Expired between add() and incr()
+            cache.set(key, 1, METRICS_TIMEOUT)
+
+
+def metrics():
+    """Counts of throttled and shed requests since the counters last expired."""
+    names = [f'throttled:{group}' for group in throttle_settings()['RATES']]
+    names += [f'shed:{reason}' for reason in ADMISSION_REASONS]
+    values = _cache().get_many([f'metrics:{name}' for name in names])
+    return {name: values.get(f'metrics:{name}', 0) for name in names}
+
+
+class TokenBucket:
+    """Token bucket of one client for one endpoint group, stored in the cache."""
+
+    def __init__(self, group, ident, rate):
+        self.capacity, self.period = parse_rate(rate)
+        self.refill = self.capacity / self.period
+        self.key = f'throttle:{group}:{ident}'
+
+    def consume(self, now=None):
+        """Take a token; return ``0`` on success or the seconds until one is available."""
+        now = time.time() if now is None else now
+        cache = _cache()
+        tokens, stamp = cache.get(self.key) or (self.capacity, now)
+        tokens = min(self.capacity, tokens + (now - stamp) * self.refill)
+        if tokens < 1:
+            return (1 - tokens) / self.refill
+        # An idle bucket is full again after one period, so it may expire then
+        cache.set(self.key, (tokens - 1, now), self.period)
+        return 0
+
+
+def client_ident(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return f'user:{user.pk}'
+    return f'ip:{request.META.get("REMOTE_ADDR", "")}'
+
+
+def throttle(group, methods=None):
+    """Limit how often one client may call the decorated view.
+
+    ``group`` names an entry of ``THROTTLE['RATES']``; views sharing a group
+    share a bucket. With ``methods``, only those HTTP methods are counted.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            config = throttle_settings()
+            rate = config['RATES'].get(group)
+            if not config['ENABLED'] or rate is None or (methods and request.method not in methods):
+                return view(request, *args, **kwargs)
+            wait = TokenBucket(group, client_ident(request), rate).consume()
+            if wait:
+                count_metric(f'throttled:{group}')
+                logger.info('Throttled %s for %s (%.1fs)', group, client_ident(request), wait)
+                response = JsonResponse(
+                    {'status': 'error', 'error': 'Too many requests', 'retry_after': math.ceil(wait)},
+                    status=429,
+                )
+                response['Retry-After'] = str(math.ceil(wait))
+                return response
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class WorkerLoad:
+    """In-flight requests and recent statement latency of this process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.latency_ms = 0.0
+        self.latency_at = 0.0
+
+    def time_statement(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            # Unlocked on purpose: a lost update only nudges an average
+            self.latency_ms += (elapsed - self.latency_ms) * LATENCY_WEIGHT
+            self.latency_at = time.monotonic()
+
+    def recent_latency_ms(self):
+        """The latency average, or 0 when no statement ran lately.
+
+        Shed requests run no statements, so without this an idle worker
+        would keep its last (high) average and shed forever.
+        """
+        if time.monotonic() - self.latency_at > LATENCY_WINDOW:
+            return 0.0
+        return self.latency_ms
+
+    def snapshot(self):
+        return {'in_flight': self.in_flight, 'db_latency_ms': round(self.recent_latency_ms(), 2)}
+
+
+worker_load = WorkerLoad()
+
+
+class HeldStream:
+    """Streaming content that keeps its request in flight until the response is closed."""
+
+    def __init__(self, content, middleware):
+        self.content = content
+        self.middleware = middleware
+        self.released = False
+
+    def __iter__(self):
+        with self.middleware.timed_statements():
+            yield from self.content
+
+    def close(self):
+        # Called by the response's close(), even if the body was never read
+        if not self.released:
+            self.released = True
+            self.middleware.release()
+
+
+class AdmissionControlMiddleware:
+    """Shed anonymous low-priority requests while this worker is overloaded.
+
+    Belongs after ``AnonymousPageCacheMiddleware`` (cache hits are cheap and
+    always served) and before the session middleware. A streamed response
+    counts as in flight, and its statements are timed, until it is closed.
+    """
+
+    def __init__(self, get_response):
+        self.config = admission_settings()
+        if not self.config['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.low_priority = set(self.config['LOW_PRIORITY_VIEWS'])
+        self.load = worker_load
+
+    def __call__(self, request):
+        reason = self.overload_reason() if self.is_low_priority(request) else None
+        if reason is not None:
+            count_metric(f'shed:{reason}')
+            logger.info('Shed %s (%s)', request.path, reason)
+            response = HttpResponse('The server is busy; please try again shortly.', status=503,
+                                    content_type='text/plain')
+            response['Retry-After'] = str(self.config['RETRY_AFTER'])
+            return response
+
+        with self.load.lock:
+            self.load.in_flight += 1
+        try:
+            with self.timed_statements():
+                response = self.get_response(request)
+        except BaseException:
+            self.release()
+            raise
+        if response.streaming and not response.is_async:
+            # Streamed bodies (the OPDS feeds) run their queries after the view returns
+            response.streaming_content = HeldStream(response.streaming_content, self)
+        else:
+            self.release()
+        return response
+
+    def timed_statements(self):
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(self.load.time_statement))
+        return stack
+
+    def release(self):
+        with self.load.lock:
+            self.load.in_flight -= 1
+
+    def is_low_priority(self, request):
+        if request.method not in ('GET', 'HEAD'):
+            return False
+        if settings.SESSION_COOKIE_NAME in request.COOKIES:
+            return False
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return False
+        return match.url_name in self.low_priority
+
+    def overload_reason(self):
+        if self.load.in_flight >= self.config['MAX_IN_FLIGHT']:
+            return 'in_flight'
+        if self.load.recent_latency_ms() > self.config['MAX_DB_LATENCY_MS']:
+            return 'db_latency'
+        return None
@@ -8,7 +8,31 @@ public_patterns = [
     path('login/', views.login_view, name='login'),
     path('signup/', views.signup_view, name='signup'),
     path('logout/', views.custom_logout, name='logout'),
+    path('books/', views.book_list, name='book_list'),
+    path('books.json', views.book_list, {'fmt': 'json'}, name='book_list_json'),
     path('books/<slug:slug>/', views.book_detail, name='book_detail'),
+    path('books/<slug:slug>/reviews/', views.book_reviews, name='book_reviews'),
+    path('books/<slug:slug>/cover/', views.book_cover, name='book_cover'),
+    path('authors/', views.author_list, name='author_list'),
+    path('authors/<int:pk>/', views.author_detail, name='author_detail'),
+    path('genres/', views.genre_list, name='genre_list'),
+    path('genres/<slug:slug>/', views.genre_detail, name='genre_detail'),
+]
+
+# OPDS catalog feeds; every Atom feed has an OPDS 2.0 JSON twin at <path>.json
+opds_patterns = [
+    path('opds/', views.opds_root, name='opds_root'),
+    path('opds.json', views.opds_root, {'fmt': 'json'}, name='opds_root_json'),
+    path('opds/new/', views.opds_books, name='opds_books'),
+    path('opds/new.json', views.opds_books, {'fmt': 'json'}, name='opds_books_json'),
+    path('opds/genres/', views.opds_genres, name='opds_genres'),
+    path('opds/genres.json', views.opds_genres, {'fmt': 'json'}, name='opds_genres_json'),
+    path('opds/genres/<slug:slug>/', views.opds_genre, name='opds_genre'),
+    path('opds/genres/<slug:slug>.json', views.opds_genre, {'fmt': 'json'}, name='opds_genre_json'),
+    path('opds/authors/', views.opds_authors, name='opds_authors'),
+    path('opds/authors.json', views.opds_authors, {'fmt': 'json'}, name='opds_authors_json'),
+    path('opds/authors/<int:pk>/', views.opds_author, name='opds_author'),
+    path('opds/authors/<int:pk>.json', views.opds_author, {'fmt': 'json'}, name='opds_author_json'),
 ]
 
 # Protected URLs (require login)
@@ -18,6 +42,7 @@ protected_patterns = [
     
     # Profile
     path('profile/', login_required(views.profile_view), name='profile'),
+    path('profile/export/', login_required(views.export_data), name='export_data'),
     
     # Library
     path('my-library/', login_required(views.my_library_view), name='my_library'),
@@ -27,11 +52,35 @@ protected_patterns = [
     path('toggle-bookmark/<int:book_id>/', 
          login_required(views.toggle_bookmark), 
          name='toggle_bookmark'),
+    path('bookmarks/bulk/', 
+         login_required(views.bulk_bookmarks), 
+         name='bulk_bookmarks'),
+    path('my-library/import/', 
+         login_required(views.import_library), 
+         name='import_library'),
     
     # Reading
     path('books/<slug:slug>/read/', 
          login_required(views.read_book), 
          name='read_book'),
+    path('books/<slug:slug>/bootstrap/', 
+         login_required(views.reader_bootstrap), 
+         name='reader_bootstrap'),
+    path('books/<slug:slug>/prefetch/', 
+         login_required(views.prefetch_hints), 
+         name='prefetch_hints'),
+    path('books/<slug:slug>/file/', 
+         login_required(views.book_file), 
+         name='book_file'),
+    path('storage/<str:token>/<str:filename>', 
+         views.signed_media, 
+         name='signed_media'),
+    path('books/<slug:slug>/chunks/<int:number>/', 
+         login_required(views.book_chunk), 
+         name='book_chunk'),
+    path('books/<slug:slug>/assets/<str:name>', 
+         login_required(views.book_asset), 
+         name='book_asset'),
          # Settings
 path('settings/', login_required(views.settings_view), name='settings'),
 
@@ -39,5 +88,5 @@ path('settings/', login_required(views.settings_view), name='settings'),
 
 
 # Combine all URL patterns
-urlpatterns = public_patterns + protected_patterns
+urlpatterns = public_patterns + opds_patterns + protected_patterns
     
\ No newline at end of file
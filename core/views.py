@@ -1,18 +1,150 @@
+import base64
+import json
+from datetime import datetime
+
+from django.conf import settings
 from django.shortcuts import render, get_object_or_404
+from django.core import signing
+from django.core.files.storage import InvalidStorageError, default_storage
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.contrib.auth import authenticate, login, logout, update_session_auth_hash
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
+from django.contrib import admin
 from django.contrib import messages
 from django.shortcuts import redirect
 from django.utils import timezone
-from django.db.models import Count, Avg
+from django.db.models import Count, Avg, Exists, OuterRef, Q, Subquery, Sum
 from django.contrib.auth.forms import PasswordChangeForm
+from django.core.paginator import Paginator
 from .forms import LoginForm, SignUpForm, ProfileForm, UserForm
-from .models import Book, UserProfile, ReadingProgress, Bookmark, Review
-from django.views.decorators.http import require_http_methods
+from .models import RATING_STARS, ArchivedReadingProgress, Author, Book, Genre, UserProfile, ReadingProgress, Bookmark, Review
+from . import export, facets, feeds, library_import, prefetch, profiling, querylog, reflow, throttle as throttling
+from .sharding import book_ids, catalog_database, user_database
+from .http import page_range, serve_file, serve_stored, suggested_ranges
+from .storage import content_hash, load_signed_url, signed_url
+from .catalog import catalog_last_modified
+from .throttle import throttle
+from django.urls import reverse
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import require_http_methods, condition
 def home(request):
     books = Book.objects.all()
     return render(request, 'core/home.html', {'books': books})
 
+BROWSE_PAGE_SIZE = 24
+
+
+def _paginate(request, queryset, count, per_page=BROWSE_PAGE_SIZE):
+    """Paginate using a precomputed row count instead of a COUNT(*) query."""
+    paginator = Paginator(queryset, per_page)
+    paginator.count = count
+    return paginator.get_page(request.GET.get('page'))
+
+
+def author_list(request):
+    """Browse authors with their book counts and average ratings."""
+    authors = Author.objects.filter(book_count__gt=0).order_by('name', 'pk')
+    page_obj = Paginator(authors, BROWSE_PAGE_SIZE).get_page(request.GET.get('page'))
+    return render(request, 'authors/list.html', {'page_obj': page_obj})
+
+
+def author_detail(request, pk):
+    """Author profile with a paginated list of their books."""
+    author = get_object_or_404(Author, pk=pk)
+    books = author.books.select_related('author').order_by('-created_at', '-pk')
+    page_obj = _paginate(request, books, author.book_count)
+    return render(request, 'authors/detail.html', {'author': author, 'page_obj': page_obj})
+
+
+def genre_list(request):
+    """Browse genres with their book counts and average ratings."""
+    genres = Genre.objects.filter(book_count__gt=0).order_by('-book_count', 'name')
+    return render(request, 'genres/list.html', {'genres': genres})
+
+
+def genre_detail(request, slug):
+    """Genre page with a paginated list of its books."""
+    genre = get_object_or_404(Genre, slug=slug)
+    books = genre.books.select_related('author').order_by('-created_at', '-pk')
+    page_obj = _paginate(request, books, genre.book_count)
+    return render(request, 'genres/detail.html', {'genre': genre, 'page_obj': page_obj})
+
+
+def _facet_groups(counts, selection, genres):
+    """Facet values with labels, counts and whether they are selected, in display order."""
+    labels = {
+        'language': dict(Book.LANGUAGE_CHOICES),
+        'format': dict(Book.FORMAT_CHOICES),
+        'genre': {pk: genre.name for pk, genre in genres.items()},
+    }
+    groups = {}
+    for name in ('language', 'format', 'genre'):
+        order = list(labels[name])
+        values = sorted(
+            (value for value in counts[name] if value in labels[name]),
+            key=lambda value: labels[name][value] if name == 'genre' else order.index(value),
+        )
+        groups[name] = [{
+            'value': genres[value].slug if name == 'genre' else value,
+            'label': labels[name][value],
+            'count': counts[name][value],
+            'selected': value in selection.get(name, ()),
+        } for value in values]
+    # Ratings are offered as "n stars & up"
+    low = selection.get('rating', (None, None))[0]
+    groups['rating'] = [{
+        'value': stars,
+        'label': f'{stars}+',
+        'count': sum(count for value, count in counts['rating'].items() if value >= stars),
+        'selected': low == stars,
+    } for stars in range(5, 0, -1)]
+    groups['year'] = [
+        {'value': year, 'label': str(year), 'count': count}
+        for year, count in sorted(counts['year'].items(), reverse=True)
+    ]
+    return groups
+
+
+def book_list(request, fmt='html'):
+    """Browse the catalog filtered by any combination of facets, with live counts.
+
+    Filtering and counting run on the in-memory facet index (see
+    ``core.facets``); the database is only asked for the books on the page.
+    """
+    index = facets.get_index()
+    genres = Genre.objects.filter(pk__in=index.values('genre')).only('pk', 'name', 'slug').in_bulk()
+    selection = facets.parse_selection(request.GET, {genre.slug: pk for pk, genre in genres.items()})
+    page_obj = Paginator(facets.Matches(index.select(selection)), BROWSE_PAGE_SIZE).get_page(request.GET.get('page'))
+    books = Book.objects.select_related('author').in_bulk(page_obj.object_list)
+    page_obj.object_list = [books[pk] for pk in page_obj.object_list if pk in books]
+    groups = _facet_groups(index.counts(selection), selection, genres)
+
+    if fmt == 'json':
+        return JsonResponse({
+            'count': page_obj.paginator.count,
+            'page': page_obj.number,
+            'num_pages': page_obj.paginator.num_pages,
+            'books': [{
+                'id': book.pk,
+                'title': book.title,
+                'author': book.author.name,
+                'language': book.language,
+                'format': book.format,
+                'average_rating': float(book.average_rating),
+                'url': reverse('book_detail', args=[book.slug]),
+            } for book in page_obj],
+            'facets': groups,
+        })
+    return render(request, 'books/list.html', {
+        'page_obj': page_obj,
+        'facets': groups,
+        'rating_min': selection.get('rating', (None, None))[0],
+        'year_min': request.GET.get('year_min', ''),
+        'year_max': request.GET.get('year_max', ''),
+    })
+
+
 def login_view(request):
     if request.method == 'POST':
         form = LoginForm(request, data=request.POST)
@@ -41,18 +173,20 @@ def signup_view(request):
 @login_required
 def dashboard_view(request):
     """User dashboard view showing reading statistics and recent activity."""
+    progress = ReadingProgress.objects.using(user_database(request.user)).filter(user=request.user)
+    # One pass over the user's (user, last_read) index instead of three
+    stats = progress.aggregate(
+        total_books=Count('pk'),
+        completed_books=Count('pk', filter=Q(is_completed=True)),
+    )
+    stats['in_progress'] = stats['total_books'] - stats['completed_books']
+    # Books live on the catalog database, which may not be the user's shard
+    stats['total_pages'] = Book.objects.filter(pk__in=book_ids(progress)).aggregate(
+        total=Sum('page_count'),
+    )['total'] or 0
     context = {
-        'recent_books': Book.objects.filter(reading_progress__user=request.user)
-                                  .order_by('-reading_progress__last_read')[:5],
-        'reading_stats': {
-            'total_books': Book.objects.filter(reading_progress__user=request.user).count(),
-            'completed_books': Book.objects.filter(reading_progress__user=request.user, 
-                                                reading_progress__is_completed=True).count(),
-            'in_progress': Book.objects.filter(reading_progress__user=request.user, 
-                                            reading_progress__is_completed=False).count(),
-            'total_pages': sum(book.page_count or 0 for book in 
-                             Book.objects.filter(reading_progress__user=request.user))
-        },
+        'recent_books': _progress_books(progress.order_by('-last_read')[:5]),
+        'reading_stats': stats,
         'recent_activity': [],  # You can add recent activity tracking here
     }
     return render(request, 'profile/dashboard.html', context)
@@ -61,7 +195,7 @@ def dashboard_view(request):
 def profile_view(request):
     """User profile view and update form."""
     try:
-        profile = UserProfile.objects.get(user=request.user)
+        profile = request.user.profile
     except UserProfile.DoesNotExist:
         # If profile doesn't exist, redirect to settings to create one
         return redirect('settings')
@@ -81,24 +215,36 @@ def profile_view(request):
     }
     return render(request, 'profile/profile.html', context)
 
+def _progress_books(rows):
+    """Books of the user's progress ``rows``, in their order, with the row as ``book.progress``.
+
+    Progress rows may be on another database than the books (see
+    ``core.sharding``), so the two are read separately and matched up here.
+    """
+    rows = list(rows)
+    books = Book.objects.select_related('author').in_bulk([row.book_id for row in rows])
+    result = []
+    for row in rows:
+        book = books.get(row.book_id)
+        if book is not None:
+            row.book = book
+            book.progress = row
+            result.append(book)
+    return result
+
+
 @login_required
 def my_library_view(request):
     """View showing user's library with reading progress."""
-    # Get books with reading progress
-    books = Book.objects.filter(reading_progress__user=request.user)
-    
-    # Get bookmarked books through the Bookmark model
-    bookmarked_books = Book.objects.filter(
-        id__in=Bookmark.objects.filter(user=request.user).values('book_id')
-    ).order_by('-bookmarked_by__created_at')
+    using = user_database(request.user)
+    progress = ReadingProgress.objects.using(using).filter(user=request.user).order_by('-last_read')
+    bookmarks = Bookmark.objects.using(using).filter(user=request.user).order_by('-created_at')
     
     # Group books by status
     reading_lists = {
-        'currently_reading': books.filter(reading_progress__is_completed=False)
-                                .order_by('-reading_progress__last_read'),
-        'completed': books.filter(reading_progress__is_completed=True)
-                        .order_by('-reading_progress__last_read'),
-        'bookmarked': bookmarked_books,
+        'currently_reading': _progress_books(progress.filter(is_completed=False)),
+        'completed': _progress_books(progress.filter(is_completed=True)),
+        'bookmarked': _progress_books(bookmarks),
     }
     
     return render(request, 'profile/mylibrary.html', {
@@ -106,29 +252,38 @@ def my_library_view(request):
     })
 
 @login_required
+@throttle('reading_progress')
 def update_reading_progress(request, book_id, page):
     """Update reading progress for a book."""
     book = get_object_or_404(Book, id=book_id)
-    reading_progress, created = ReadingProgress.objects.get_or_create(
+    using = user_database(request.user)
+    reading_progress, created = ReadingProgress.objects.using(using).get_or_create(
         user=request.user,
         book=book,
         defaults={'current_page': page}
     )
     
-    if not created:
+    if created:
+        ArchivedReadingProgress.objects.using(using).filter(user=request.user, book=book).delete()
+    else:
         reading_progress.current_page = page
         if book.page_count and page >= book.page_count * 0.95:  # Consider 95% as completed
             reading_progress.is_completed = True
             reading_progress.completed_at = timezone.now()
         reading_progress.save()
     
-    return redirect('my_library')
+    return JsonResponse({
+        'status': 'success',
+        'current_page': reading_progress.current_page,
+        'is_completed': reading_progress.is_completed,
+    })
 
 @login_required
+@throttle('bookmarks')
 def toggle_bookmark(request, book_id):
     """Add or remove a bookmark for a book."""
     book = get_object_or_404(Book, id=book_id)
-    bookmark, created = Bookmark.objects.get_or_create(
+    bookmark, created = Bookmark.objects.using(user_database(request.user)).get_or_create(
         user=request.user,
         book=book
     )
@@ -141,6 +296,50 @@ def toggle_bookmark(request, book_id):
     
     return redirect('book_detail', slug=book.slug)
 
+@login_required
+@require_http_methods(['POST'])
+@throttle('bookmarks')
+def bulk_bookmarks(request):
+    """Add and remove many bookmarks at once.
+
+    Expects a JSON body such as ``{"add": [1, 2], "remove": [3]}`` with book ids.
+    """
+    try:
+        payload = json.loads(request.body or b'{}')
+        add = [int(pk) for pk in payload.get('add', [])]
+        remove = [int(pk) for pk in payload.get('remove', [])]
+    except (AttributeError, TypeError, ValueError):
+        return JsonResponse({'status': 'error', 'error': 'Expected {"add": [ids], "remove": [ids]}'}, status=400)
+    
+    bookmarks = Bookmark.objects.using(user_database(request.user))
+    existing = bookmarks.filter(user=request.user).count()
+    valid_ids = Book.objects.filter(pk__in=add).values_list('pk', flat=True)
+    bookmarks.bulk_create(
+        [Bookmark(user=request.user, book_id=book_id) for book_id in valid_ids],
+        batch_size=library_import.IMPORT_BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+    added = bookmarks.filter(user=request.user).count() - existing
+    removed, _ = bookmarks.filter(user=request.user, book_id__in=remove).delete()
+    return JsonResponse({'status': 'success', 'added': added, 'removed': removed})
+
+@login_required
+@require_http_methods(['POST'])
+def import_library(request):
+    """Import a Goodreads-style CSV or JSON shelf export."""
+    upload = request.FILES.get('file')
+    if upload is None:
+        return JsonResponse({'status': 'error', 'error': 'No file uploaded'}, status=400)
+    try:
+        entries = library_import.parse_shelf(upload.read(), request.POST.get('format') or None)
+    except (library_import.ImportFormatError, UnicodeDecodeError) as exc:
+        return JsonResponse({'status': 'error', 'error': str(exc)}, status=400)
+    
+    summary = library_import.import_shelf(request.user, entries)
+    # Only report a sample of the misses; an export can be thousands of rows
+    summary['unmatched'] = summary['unmatched'][:100]
+    return JsonResponse({'status': 'success', **summary})
+
 def custom_logout(request):
     """Custom logout view to handle logout and redirect."""
     logout(request)
@@ -152,8 +351,11 @@ def settings_view(request):
     """View for user settings and preferences."""
     user = request.user
     
-    # Get or create user profile
-    user_profile, created = UserProfile.objects.get_or_create(user=user)
+    # The profile usually comes with the (cached) user; create it on first visit
+    try:
+        user_profile, created = user.profile, False
+    except UserProfile.DoesNotExist:
+        user_profile, created = UserProfile.objects.get_or_create(user=user)
     
     # Initialize forms with POST data if available
     if request.method == 'POST':
@@ -210,56 +412,598 @@ def book_detail(request, slug):
     is_bookmarked = False
     
     if request.user.is_authenticated:
-        reading_progress = ReadingProgress.objects.filter(
+        using = user_database(request.user)
+        reading_progress = ReadingProgress.objects.using(using).filter(
             user=request.user, 
             book=book
         ).first()
         
-        is_bookmarked = Bookmark.objects.filter(
+        is_bookmarked = Bookmark.objects.using(using).filter(
             user=request.user, 
             book=book
         ).exists()
     
+    reviews, next_cursor = _review_page(book)
     context = {
         'book': book,
         'reading_progress': reading_progress,
         'is_bookmarked': is_bookmarked,
+        'reviews': reviews,
+        'reviews_next': next_cursor,
     }
     
     return render(request, 'books/detail.html', context)
 
-@login_required
-def read_book(request, slug):
-    """View for reading a book using PDF.js."""
-    book = get_object_or_404(Book, slug=slug)
+
+REVIEW_PAGE_SIZE = 10
+REVIEW_PAGE_MAX = 50
+
+
+def _encode_review_cursor(review):
+    raw = f'{review.created_at.isoformat()}|{review.pk}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def _decode_review_cursor(cursor):
+    """Return ``(created_at, pk)`` of the last review already shown.
+
+    Raises ``ValueError`` (base64, unicode and ISO-date errors all are) for
+    a malformed cursor.
+    """
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+    created_at, pk = raw.rsplit('|', 1)
+    return datetime.fromisoformat(created_at), int(pk)
+
+
+def _review_page(book, cursor=None, limit=REVIEW_PAGE_SIZE):
+    """One page of ``book``'s public reviews, newest first, and the cursor of the next page.
+
+    Keyset pagination on ``(created_at, id)``: each page is an index range
+    scan however deep the reader pages, where OFFSET would re-read every
+    earlier review.
+    """
+    reviews = Review.objects.filter(book=book, is_public=True).select_related('user', 'user__profile')
+    if cursor:
+        created_at, pk = _decode_review_cursor(cursor)
+        # The redundant created_at__lte gives the index a range to seek into
+        reviews = reviews.filter(created_at__lte=created_at).filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk),
+        )
+    page = list(reviews.order_by('-created_at', '-pk')[:limit + 1])
+    next_cursor = _encode_review_cursor(page[limit - 1]) if len(page) > limit else None
+    return page[:limit], next_cursor
+
+
+def _review_json(review):
+    try:
+        avatar_url = review.user.profile.avatar_url
+    except UserProfile.DoesNotExist:
+        avatar_url = None
+    return {
+        'id': review.pk,
+        'user': {'username': review.user.username, 'avatar_url': avatar_url},
+        'rating': review.rating,
+        'title': review.title,
+        'content': review.content,
+        'created_at': review.created_at.isoformat(),
+    }
+
+
+def _reader_book(user, slug):
+    """The book ``slug`` with ``user``'s saved position and bookmark.
+
+    One query when the user's shard is the catalog database; otherwise the
+    per-user rows are read from the shard by primary-key lookups.
+    """
+    using = user_database(user)
+    progress = ReadingProgress.objects.using(using).filter(user=user)
+    bookmarks = Bookmark.objects.using(using).filter(user=user)
+    archived = ArchivedReadingProgress.objects.using(using).filter(user=user)
+    books = Book.objects.select_related('author')
+    if using == catalog_database():
+        progress = progress.filter(book=OuterRef('pk'))
+        return get_object_or_404(books.annotate(
+            saved_page=Subquery(progress.values('current_page')[:1]),
+            saved_completed=Subquery(progress.values('is_completed')[:1]),
+            saved_at=Subquery(progress.values('last_read')[:1]),
+            is_bookmarked=Exists(bookmarks.filter(book=OuterRef('pk'))),
+            is_archived=Exists(archived.filter(book=OuterRef('pk'))),
+        ), slug=slug)
     
-    # Update or create reading progress
-    reading_progress, created = ReadingProgress.objects.get_or_create(
-        user=request.user,
-        book=book,
-        defaults={'current_page': 1, 'is_completed': False}
+    book = get_object_or_404(books, slug=slug)
+    saved = progress.filter(book=book).values('current_page', 'is_completed', 'last_read').first() or {}
+    book.saved_page = saved.get('current_page')
+    book.saved_completed = saved.get('is_completed')
+    book.saved_at = saved.get('last_read')
+    book.is_bookmarked = bookmarks.filter(book=book).exists()
+    book.is_archived = not saved and archived.filter(book=book).exists()
+    return book
+
+
+def _restore_archived_progress(user, book):
+    """Bring archived progress back when a book is opened again."""
+    if book.saved_page is None and book.is_archived:
+        progress = ReadingProgress.restore(user, book.pk)
+        if progress is not None:
+            book.saved_page = progress.current_page
+            book.saved_completed = progress.is_completed
+            book.saved_at = progress.last_read
+
+
+def _book_filename(book):
+    extension = book.file.name.rsplit('.', 1)[-1] if '.' in book.file.name else book.format
+    return f'{book.slug}.{extension}'
+
+
+def _signed_book_url(book, expires=None):
+    """A short-lived direct-download URL of the book's file, if its storage signs URLs."""
+    if not book.file:
+        return None
+    return signed_url(
+        book.file, filename=_book_filename(book), content_type=feeds.FORMAT_MIME_TYPES.get(book.format), expires=expires,
     )
+
+
+def _reader_bootstrap(book, manifest=None):
+    """Everything the reader needs to open ``book`` at the saved position."""
+    page_count = len(manifest['chunks']) if manifest else book.page_count
+    current_page = max(book.saved_page or 1, 1)
+    if page_count:
+        current_page = min(current_page, page_count)
+    
+    # Readers fetch the bytes straight from storage when it can sign a URL,
+    # through a link that lasts while the book is open
+    expires = getattr(settings, 'READER_FILE_URL_EXPIRES', 4 * 60 * 60)
+    file_url = _signed_book_url(book, expires) or reverse('book_file', kwargs={'slug': book.slug})
+    try:
+        size = book.file.size if book.file else None
+    except OSError:
+        size = None
+    
+    if manifest:
+        warm = [
+            {'url': reverse('book_chunk', kwargs={'slug': book.slug, 'number': number})}
+            for number in (current_page, current_page + 1) if number <= page_count
+        ]
+    else:
+        warm = [{'url': file_url, 'range': byte_range} for byte_range in suggested_ranges(size, current_page, page_count)]
     
+    return {
+        'book': {
+            'id': book.pk,
+            'slug': book.slug,
+            'title': book.title,
+            'author': {'id': book.author_id, 'name': book.author.name},
+            'format': book.format,
+            'language': book.language,
+            'page_count': page_count,
+        },
+        'file': {
+            'url': file_url,
+            'size': size,
+            'sha256': book.file_hash,
+            'content_type': feeds.FORMAT_MIME_TYPES.get(book.format),
+        },
+        'progress': {
+            'current_page': current_page,
+            'is_completed': bool(book.saved_completed),
+            'last_read': book.saved_at,
+        },
+        'is_bookmarked': book.is_bookmarked,
+        'urls': {
+            'progress': reverse('read_book', kwargs={'slug': book.slug}),
+            'bookmark': reverse('toggle_bookmark', kwargs={'book_id': book.pk}),
+            'detail': book.get_absolute_url(),
+            'prefetch': reverse('prefetch_hints', kwargs={'slug': book.slug}),
+        },
+        'prefetch': warm,
+        # How readers move through this book; the reader pre-renders accordingly
+        'pages': {**prefetch.page_pattern(book.pk), 'cache_size': prefetch.prefetch_settings()['CACHE_SIZE']},
+    }
+
+
+@login_required
+def reader_bootstrap(request, slug):
+    """Reader state for a book as JSON, in a single query."""
+    book = _reader_book(request.user, slug)
+    _restore_archived_progress(request.user, book)
+    manifest = reflow.load_manifest(book) if reflow.is_reflowable(book) else None
+    response = JsonResponse(_reader_bootstrap(book, manifest))
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+@login_required
+@throttle('reading_progress', methods=['POST'])
+def read_book(request, slug):
+    """View for reading a book using PDF.js."""
     # If this is a POST request, update the reading progress
     if request.method == 'POST':
+        book = get_object_or_404(Book, slug=slug)
         page = int(request.POST.get('page', 1))
         is_completed = request.POST.get('is_completed', 'false').lower() == 'true'
-        
-        reading_progress.current_page = page
-        reading_progress.is_completed = is_completed
-        reading_progress.last_read = timezone.now()
-        reading_progress.save()
-        
+        using = user_database(request.user)
+        _, created = ReadingProgress.objects.using(using).update_or_create(
+            user=request.user,
+            book=book,
+            defaults={'current_page': page, 'is_completed': is_completed},
+        )
+        if created:
+            # The live row supersedes anything archived for this book
+            ArchivedReadingProgress.objects.using(using).filter(user=request.user, book=book).delete()
         return JsonResponse({'status': 'success'})
     
-    # For GET request, render the read template
+    # Opening a book only reads the saved position; the reader writes it back
+    # once the user actually turns a page
+    book = _reader_book(request.user, slug)
+    _restore_archived_progress(request.user, book)
+    manifest = reflow.load_manifest(book) if reflow.is_reflowable(book) else None
+    bootstrap = _reader_bootstrap(book, manifest)
     context = {
         'book': book,
-        'current_page': reading_progress.current_page,
-        'is_bookmarked': Bookmark.objects.filter(user=request.user, book=book).exists(),
+        'current_page': bootstrap['progress']['current_page'],
+        'is_bookmarked': book.is_bookmarked,
+        'bootstrap': bootstrap,
     }
     
+    if reflow.is_reflowable(book):
+        # EPUB/TXT books are read chunk by chunk from the ingest manifest
+        context['manifest'] = manifest
+        return render(request, 'books/read_reflow.html', context)
+    
     return render(request, 'books/read.html', context)
-def settings_view(request):
-    """View for user settings."""
-    return render(request, 'profile/settings.html')
\ No newline at end of file
+
+
+@login_required
+def prefetch_hints(request, slug):
+    """Pages a reader on ``?page=`` should warm next, learned from how others read the book.
+
+    PDF pages come with the byte range they probably start at, reflowed
+    books' with the URL of their chunk.
+    """
+    book = get_object_or_404(Book, slug=slug)
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        return JsonResponse({'status': 'error', 'error': 'Invalid page'}, status=400)
+    
+    pattern = prefetch.page_pattern(book.pk)
+    manifest = reflow.load_manifest(book) if reflow.is_reflowable(book) else None
+    page_count = len(manifest['chunks']) if manifest else book.page_count
+    hints = prefetch.page_hints(pattern, page, page_count)
+    if manifest:
+        for hint in hints:
+            hint['url'] = reverse('book_chunk', kwargs={'slug': book.slug, 'number': hint['page']})
+    elif book.file and page_count:
+        file_url = _signed_book_url(book) or reverse('book_file', kwargs={'slug': book.slug})
+        try:
+            size = book.file.size
+        except OSError:
+            size = None
+        for hint in hints:
+            hint['url'] = file_url
+            if size:
+                hint['range'] = page_range(size, hint['page'], page_count)
+    
+    response = JsonResponse({'page': page, 'hints': hints, 'pattern': pattern})
+    # Patterns change slowly; signed URLs expire, so keep it short
+    patch_cache_control(response, private=True, max_age=60)
+    return response
+
+
+@login_required
+def book_file(request, slug):
+    """Redirect to a signed URL of a book's file, or serve it with its content hash as a strong ETag."""
+    book = get_object_or_404(Book, slug=slug)
+    if not book.file:
+        raise Http404('This book has no file')
+    
+    url = _signed_book_url(book)
+    if url:
+        response = redirect(url)
+        # The signed URL expires, so the redirect must not be reused
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+    
+    digest = book.file_hash
+    # Content-addressed files never change under the same hash
+    cache_control = {'private': True, 'max_age': 31536000, 'immutable': True} if digest else {'private': True, 'no_cache': True}
+    return serve_file(
+        request,
+        book.file,
+        etag=digest,
+        filename=_book_filename(book),
+        cache_control=cache_control,
+    )
+
+
+def book_cover(request, slug):
+    """Redirect to a signed URL of a book's cover, or serve it with its content hash as a strong ETag."""
+    book = get_object_or_404(Book, slug=slug)
+    if not book.cover_image:
+        raise Http404('This book has no cover')
+    
+    url = signed_url(book.cover_image)
+    if url:
+        response = redirect(url)
+        # Signed links outlive this by minutes; list pages skip a round trip per cover
+        patch_cache_control(response, private=True, max_age=60)
+        return response
+    
+    digest = content_hash(book.cover_image.name)
+    cache_control = {'max_age': 31536000, 'immutable': True} if digest else {'no_cache': True}
+    return serve_file(request, book.cover_image, etag=digest, cache_control=cache_control)
+
+
+def signed_media(request, token, filename):
+    """Serve a file through a signed URL of ``SignedFileSystemStorage``.
+
+    The token is the access check, as with an object store's pre-signed URL.
+    """
+    try:
+        storage, name, expires_at, content_type = load_signed_url(token)
+    except (signing.BadSignature, InvalidStorageError):
+        raise Http404('Invalid or expired link')
+    if not storage.exists(name):
+        raise Http404('File not found')
+    
+    # The bytes behind a link never change; keep them until the link expires
+    max_age = max(int(expires_at - timezone.now().timestamp()), 0)
+    return serve_stored(
+        request,
+        storage,
+        name,
+        etag=content_hash(name),
+        filename=filename,
+        content_type=content_type,
+        cache_control={'private': True, 'max_age': max_age},
+    )
+
+
+@login_required
+def export_data(request):
+    """Stream a zip of the user's profile, progress, bookmarks and reviews."""
+    fmt = request.GET.get('format', 'ndjson')
+    if fmt not in export.EXPORT_FORMATS:
+        raise Http404('Unknown export format')
+    
+    response = StreamingHttpResponse(export.iter_export(request.user, fmt), content_type='application/zip')
+    response['Content-Disposition'] = f'attachment; filename="{export.export_filename(request.user)}"'
+    patch_cache_control(response, private=True, no_store=True)
+    return response
+
+
+def _chunk_etag(request, slug, number):
+    book = get_object_or_404(Book, slug=slug)
+    manifest = reflow.load_manifest(book) if reflow.is_reflowable(book) else None
+    if manifest is None or not 1 <= number <= len(manifest['chunks']):
+        return None
+    return manifest['chunks'][number - 1]['etag']
+
+
+@condition(etag_func=_chunk_etag)
+def book_chunk(request, slug, number):
+    """Serve a single sanitized HTML chunk of an EPUB or TXT book."""
+    book = get_object_or_404(Book, slug=slug)
+    manifest = reflow.load_manifest(book) if reflow.is_reflowable(book) else None
+    if manifest is None or not 1 <= number <= len(manifest['chunks']):
+        raise Http404('Chunk not found')
+    
+    response = HttpResponse(reflow.read_chunk(book, number), content_type='text/html; charset=utf-8')
+    # Chunks are immutable for a given ETag; only the browser may keep them
+    patch_cache_control(response, private=True, max_age=86400)
+    return response
+
+
+def book_asset(request, slug, name):
+    """Serve an image embedded in the chunks of an EPUB book."""
+    book = get_object_or_404(Book, slug=slug)
+    path = reflow.asset_path(book, name)
+    if not reflow.ASSET_NAME_RE.match(name) or not default_storage.exists(path):
+        raise Http404('Asset not found')
+    
+    sign = getattr(default_storage, 'signed_url', None)
+    if sign:
+        response = redirect(sign(path))
+        # Signed links outlive this by minutes; rereading a chapter skips a round trip
+        patch_cache_control(response, private=True, max_age=60)
+        return response
+    # Assets are rewritten only with their chunks, whose ETags change then
+    return serve_stored(request, default_storage, path, cache_control={'private': True, 'max_age': 86400})
+
+
+def _catalog_etag(request, *args, **kwargs):
+    return catalog_last_modified().isoformat()
+
+
+def _catalog_last_modified(request, *args, **kwargs):
+    return catalog_last_modified()
+
+
+# Unchanged catalogs are answered with a 304 before any rows are read
+catalog_condition = condition(etag_func=_catalog_etag, last_modified_func=_catalog_last_modified)
+
+
+def _reviews_state(request, slug):
+    # Read once for both the ETag and Last-Modified
+    if not hasattr(request, '_reviews_state'):
+        request._reviews_state = Book.objects.filter(slug=slug).values_list('updated_at', 'review_count').first()
+    return request._reviews_state
+
+
+def _reviews_etag(request, slug):
+    state = _reviews_state(request, slug)
+    # updated_at moves whenever the book's ratings are recomputed after a review changes
+    return f'{state[0].isoformat()}:{state[1]}' if state else None
+
+
+def _reviews_last_modified(request, slug):
+    state = _reviews_state(request, slug)
+    return state[0] if state else None
+
+
+@condition(etag_func=_reviews_etag, last_modified_func=_reviews_last_modified)
+def book_reviews(request, slug):
+    """Public reviews of a book as JSON, ``?cursor=`` paginated.
+
+    The first page also carries the per-star histogram, read from the
+    counts stored on the book.
+    """
+    book = get_object_or_404(
+        Book.objects.only('pk', 'slug', 'average_rating', 'review_count', *(
+            f'rating_{stars}_count' for stars in RATING_STARS
+        )),
+        slug=slug,
+    )
+    cursor = request.GET.get('cursor')
+    try:
+        limit = min(max(int(request.GET.get('limit', REVIEW_PAGE_SIZE)), 1), REVIEW_PAGE_MAX)
+        reviews, next_cursor = _review_page(book, cursor, limit)
+    except ValueError:
+        return JsonResponse({'status': 'error', 'error': 'Invalid cursor or limit'}, status=400)
+    
+    data = {'reviews': [_review_json(review) for review in reviews], 'next_cursor': next_cursor}
+    if not cursor:
+        data['average_rating'] = float(book.average_rating)
+        data['review_count'] = book.review_count
+        data['histogram'] = book.rating_histogram
+    return JsonResponse(data)
+
+
+def _feed_response(feed, fmt):
+    if fmt == 'json':
+        response = StreamingHttpResponse(feeds.iter_json(feed), content_type=feeds.JSON_CONTENT_TYPE)
+    else:
+        response = StreamingHttpResponse(feeds.iter_atom(feed), content_type=feed.feed_type)
+    patch_cache_control(response, public=True, no_cache=True)
+    return response
+
+
+def _feed_urls(name, **kwargs):
+    return reverse(name, kwargs=kwargs), reverse(f'{name}_json', kwargs=kwargs)
+
+
+@catalog_condition
+def opds_root(request, fmt='atom'):
+    """OPDS navigation root linking to the book, genre and author feeds."""
+    updated = catalog_last_modified()
+    entries = [
+        {'id': 'urn:bookreader:new', 'title': 'New books', 'summary': 'All books, newest first',
+         'updated': updated, 'href': reverse('opds_books'), 'type': feeds.ACQUISITION_TYPE},
+        {'id': 'urn:bookreader:genres', 'title': 'Genres', 'summary': 'Browse books by genre',
+         'updated': updated, 'href': reverse('opds_genres'), 'type': feeds.NAVIGATION_TYPE},
+        {'id': 'urn:bookreader:authors', 'title': 'Authors', 'summary': 'Browse books by author',
+         'updated': updated, 'href': reverse('opds_authors'), 'type': feeds.NAVIGATION_TYPE},
+    ]
+    feed = feeds.Feed(request, 'urn:bookreader:root', 'BookReader Catalog', 'navigation',
+                      entries, updated, *_feed_urls('opds_root'))
+    return _feed_response(feed, fmt)
+
+
+@catalog_condition
+def opds_books(request, fmt='atom'):
+    """Acquisition feed of every book in the catalog."""
+    feed = feeds.Feed(request, 'urn:bookreader:new', 'New books', 'acquisition',
+                      feeds.book_entries(Book.objects.all()), catalog_last_modified(),
+                      *_feed_urls('opds_books'))
+    return _feed_response(feed, fmt)
+
+
+@catalog_condition
+def opds_genres(request, fmt='atom'):
+    """Navigation feed with one entry per genre."""
+    feed = feeds.Feed(request, 'urn:bookreader:genres', 'Genres', 'navigation',
+                      feeds.genre_entries(Genre.objects.all()), catalog_last_modified(),
+                      *_feed_urls('opds_genres'))
+    return _feed_response(feed, fmt)
+
+
+@catalog_condition
+def opds_genre(request, slug, fmt='atom'):
+    """Acquisition feed of the books in a genre."""
+    genre = get_object_or_404(Genre, slug=slug)
+    feed = feeds.Feed(request, f'urn:bookreader:genre:{genre.pk}', genre.name, 'acquisition',
+                      feeds.book_entries(genre.books.all()), catalog_last_modified(),
+                      *_feed_urls('opds_genre', slug=slug))
+    return _feed_response(feed, fmt)
+
+
+@catalog_condition
+def opds_authors(request, fmt='atom'):
+    """Navigation feed with one entry per author."""
+    feed = feeds.Feed(request, 'urn:bookreader:authors', 'Authors', 'navigation',
+                      feeds.author_entries(Author.objects.all()), catalog_last_modified(),
+                      *_feed_urls('opds_authors'))
+    return _feed_response(feed, fmt)
+
+
+@catalog_condition
+def opds_author(request, pk, fmt='atom'):
+    """Acquisition feed of the books by an author."""
+    author = get_object_or_404(Author, pk=pk)
+    feed = feeds.Feed(request, f'urn:bookreader:author:{author.pk}', author.name, 'acquisition',
+                      feeds.book_entries(author.books.all()), catalog_last_modified(),
+                      *_feed_urls('opds_author', pk=pk))
+    return _feed_response(feed, fmt)
+
+
+@staff_member_required
+@require_http_methods(['GET', 'POST'])
+def query_log(request):
+    """Slow and full-scan statements recorded by core.querylog in this process."""
+    if request.method == 'POST':
+        querylog.clear()
+        messages.success(request, 'Query log cleared.')
+        return redirect('query_log')
+
+    entries = querylog.entries()
+    fingerprint = request.GET.get('fingerprint')
+    if fingerprint:
+        entries = [entry for entry in entries if entry['fingerprint'] == fingerprint]
+    context = {
+        **admin.site.each_context(request),
+        'title': 'Query log',
+        'entries': entries[:200],
+        'total': len(entries),
+        'fingerprint': fingerprint,
+        'config': querylog.query_log_settings(),
+    }
+    return render(request, 'admin/query_log.html', context)
+
+
+@staff_member_required
+@require_http_methods(['GET', 'POST'])
+def memory_profile(request):
+    """Start, snapshot or stop tracemalloc in the worker serving the request.
+
+    Snapshots are per process; each one is stored by core.profiling and
+    diffed against the previous snapshot of the same worker.
+    """
+    if not profiling.profiling_settings()['ENABLED']:
+        raise Http404('Profiling is disabled')
+
+    result = {}
+    if request.method == 'POST':
+        action = request.POST.get('action')
+        if action == 'start':
+            profiling.start_memory_tracing()
+        elif action == 'snapshot':
+            try:
+                result['snapshot'], result['diff'] = profiling.take_memory_snapshot()
+            except RuntimeError as exc:
+                return JsonResponse({'error': str(exc)}, status=409)
+        elif action == 'stop':
+            profiling.stop_memory_tracing()
+        else:
+            return JsonResponse({'error': 'action must be start, snapshot or stop'}, status=400)
+    return JsonResponse({**profiling.memory_status(), **result})
+
+
+@staff_member_required
+def traffic(request):
+    """Throttled and shed request counts, and this worker's current load."""
+    return JsonResponse({
+        'metrics': throttling.metrics(),
+        'worker': throttling.worker_load.snapshot(),
+        'admission_control': throttling.admission_settings()['ENABLED'],
+    })